@@ -0,0 +1,260 @@
+# CARD GUARD
+# Benchmark Suite
+# Times the scoring and ingestion hot paths against a throwaway PostgreSQL cluster created with initdb,
+# so runs never touch the real database and every commit is measured on the same data
+# Each table size seeds the cluster up to that many transactions, then times every benchmark and writes
+# the results (with the git commit they were measured on) to a JSON file for comparing commits
+# Usage:
+#   python benchmark.py                                        (BENCHMARK_SIZES, results in BENCHMARK_OUTPUT)
+#   python benchmark.py --sizes 1000 10000 --output before.json
+#   python benchmark.py --pg-bin /usr/lib/postgresql/16/bin    (when initdb and pg_ctl are not on PATH)
+
+# Import libraries
+from config import *
+from models import *
+from utils import *
+from customer_cache import customer_cache
+from id_registry import transaction_id_registry
+from verdict_writer import verdict_writer
+from customer_functions import find_customer
+from spending_stats import create_spending_stats_table, rebuild_spending_stats
+from location_profiles import create_location_counts_table, rebuild_location_counts
+from transaction_functions import (add_transaction, add_transactions_bulk, create_duplicate_index, find_customer_age,
+                                   find_customer_location, flag_fraud, flag_fraud_batch, generate_transaction)
+from transaction_generator import TransactionGenerator
+from verdicts import create_transaction_scores_table
+from contextlib import redirect_stdout
+from datetime import datetime
+from psycopg2.extras import execute_values
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+# Tables the application expects, created in the throwaway database
+SCHEMA_SQL = """
+    CREATE TABLE {customers_table} (
+        customer_id VARCHAR PRIMARY KEY,
+        first_name VARCHAR,
+        last_name VARCHAR,
+        age INTEGER,
+        location VARCHAR,
+        phone_number VARCHAR
+    );
+    CREATE TABLE {transactions_table} (
+        transaction_id VARCHAR PRIMARY KEY,
+        customer_id VARCHAR,
+        timestamp TIMESTAMP,
+        merchant_name VARCHAR,
+        category VARCHAR,
+        amount NUMERIC(10, 2),
+        location VARCHAR,
+        card_type VARCHAR,
+        approval_status VARCHAR,
+        payment_method VARCHAR,
+        is_fraud VARCHAR,
+        note VARCHAR
+    );
+""".format(customers_table=CUSTOMERS_TABLE, transactions_table=TRANSACTIONS_TABLE)
+
+# Runs a throwaway PostgreSQL cluster in a temporary directory for the duration of a with-block
+# Yields the connection settings for its database, the cluster and its files are removed on exit
+class EphemeralPostgres:
+    def __init__(self, pg_bin=PG_BIN_DIR, dbname="cardguard_benchmark"):
+        self.pg_bin = pg_bin
+        self.dbname = dbname
+
+    # Helper function that finds a PostgreSQL program in pg_bin or on PATH
+    def _program(self, name):
+        path = os.path.join(self.pg_bin, name) if self.pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise FileNotFoundError(f"Could not find {name}, install PostgreSQL or pass --pg-bin")
+        return path
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="cardguard_pg_")
+        self.data_dir = os.path.join(self.directory, "data")
+        with socket.socket() as probe:  # Let the OS pick a free port
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        try:
+            subprocess.run([self._program("initdb"), "-D", self.data_dir, "-U", "postgres", "-A", "trust", "--no-sync"],
+                           check=True, capture_output=True)
+            # Unix socket only, fsync off - durability does not matter for a cluster that is deleted afterwards
+            options = f"-k {self.directory} -p {self.port} -c listen_addresses='' -c fsync=off -c synchronous_commit=off"
+            subprocess.run([self._program("pg_ctl"), "-D", self.data_dir, "-o", options, "-l", os.path.join(self.directory, "postgres.log"), "-w", "start"],
+                           check=True, capture_output=True)
+            connection = psycopg2.connect(dbname="postgres", user="postgres", host=self.directory, port=self.port)
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE DATABASE {self.dbname}")
+            connection.close()
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return {"dbname": self.dbname, "user": "postgres", "host": self.directory, "port": self.port}
+
+    def __exit__(self, *exc_info):
+        if os.path.exists(os.path.join(self.data_dir, "postmaster.pid")):
+            subprocess.run([self._program("pg_ctl"), "-D", self.data_dir, "-m", "immediate", "stop"], capture_output=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return False
+
+# Creates the tables and inserts customers with reproducible random profiles
+def seed_customers(cursor, count, seed=0):
+    rng = np.random.default_rng(seed)
+    cities = [f"City {i}, ST" for i in range(max(1, count // 20))]
+    rows = [(f"{i:08d}", f"First{i}", f"Last{i}", int(rng.integers(18, 91)), cities[int(rng.integers(0, len(cities)))], f"555-{i:07d}")
+            for i in range(count)]
+    cursor.execute(SCHEMA_SQL)
+    insert_sql = "INSERT INTO {table_name} VALUES %s".format(table_name=CUSTOMERS_TABLE)
+    execute_values(cursor, insert_sql, rows, page_size=BULK_INSERT_CHUNK_SIZE)
+    create_spending_stats_table(cursor)
+    create_location_counts_table(cursor)
+    create_transaction_scores_table(cursor)
+
+# Tops the transactions table up to size rows, then refreshes the statistics, counts, index and planner stats the hot paths rely on
+def seed_transactions(cursor, generator, size):
+    cursor.execute("SELECT COUNT(*) FROM {table_name}".format(table_name=TRANSACTIONS_TABLE))
+    missing = size - cursor.fetchone()[0]
+    while missing > 0:
+        batch = generator.generate(min(missing, 100000))
+        add_transactions_bulk(cursor, batch)
+        missing -= len(batch)
+    rebuild_spending_stats(cursor)
+    rebuild_location_counts(cursor)
+    create_duplicate_index(cursor)
+    cursor.connection.autocommit = True
+    cursor.execute("VACUUM ANALYZE")
+    cursor.connection.autocommit = False
+
+# Helper function that returns a sample of stored transactions that flag_fraud would still score
+def sample_transactions(cursor, count):
+    sample_sql = """
+        SELECT * FROM {table_name}
+        WHERE amount > 0 AND approval_status IN ('Approved', 'Pending') AND is_fraud = 'Undetermined'
+        LIMIT %s
+    """.format(table_name=TRANSACTIONS_TABLE)
+    cursor.execute(sample_sql, (count,))
+    return [Transaction(*row) for row in cursor.fetchall()]
+
+# Times function once per item - returns a result dict of latency percentiles and throughput
+# Console output of the timed function is discarded so printing to a terminal does not skew the numbers
+def time_calls(name, rows, function, items):
+    latencies = []
+    with redirect_stdout(io.StringIO()):
+        for item in items:
+            start = time.perf_counter()
+            function(item)
+            latencies.append(time.perf_counter() - start)
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        "benchmark": name,
+        "rows": rows,
+        "calls": len(latencies),
+        "total_seconds": round(total, 6),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 4),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 4),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 4),
+        "ops_per_sec": round(len(latencies) / total, 2) if total else None,
+    }
+
+# Times one call that processes many items - returns a result dict with per-item throughput
+def time_batch(name, rows, function, items):
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        function(items)
+        total = time.perf_counter() - start
+    return {
+        "benchmark": name,
+        "rows": rows,
+        "calls": 1,
+        "items": len(items),
+        "total_seconds": round(total, 6),
+        "ops_per_sec": round(len(items) / total, 2) if total else None,
+    }
+
+# Runs every benchmark against a table of size transactions - returns a list of result dicts
+def run_benchmarks(cursor, generator, size, samples):
+    results = []
+    customer_ids = [str(customer_id) for customer_id in generator.rng.choice(generator.customer_ids, size=samples)]
+
+    # Customer lookups - uncached reads of the customers table, then the same IDs served by the profile cache
+    results.append(time_calls("find_customer", size, lambda customer_id: find_customer(cursor, customer_id), customer_ids))
+    customer_cache.clear()
+    results.append(time_calls("find_customer_location_cold", size, lambda customer_id: find_customer_location(cursor, customer_id), customer_ids))
+    results.append(time_calls("find_customer_age_warm", size, lambda customer_id: find_customer_age(cursor, customer_id), customer_ids))
+
+    # Ingestion - the ID registry is loaded up front so its one-off load is not timed as a generated transaction
+    transaction_id_registry.load(cursor)
+    results.append(time_calls("generate_transaction", size, lambda _: generate_transaction(cursor), range(samples)))
+    results.append(time_calls("add_transaction", size, lambda transaction: add_transaction(cursor, transaction), generator.generate(samples)))
+    results.append(time_batch("add_transactions_bulk", size, lambda transactions: add_transactions_bulk(cursor, transactions), generator.generate(samples * 10)))
+
+    # Scoring - each sampled transaction is scored once, so the two paths use separate samples
+    customer_cache.clear()
+    to_score = sample_transactions(cursor, samples * 11)
+    results.append(time_calls("flag_fraud", size, lambda transaction: flag_fraud(cursor, transaction), to_score[:samples]))
+    verdict_writer.flush()  # Queued verdicts are written before the batch path is timed
+    customer_cache.clear()
+    results.append(time_batch("flag_fraud_batch", size, lambda transactions: flag_fraud_batch(cursor, transactions), to_score[samples:]))
+    return results
+
+# Helper function that returns the current git commit, or None outside a git checkout
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Seeds a throwaway cluster at each size, runs the benchmarks and writes the results to output
+def main(sizes=BENCHMARK_SIZES, customers=BENCHMARK_CUSTOMERS, samples=BENCHMARK_SAMPLES, output=BENCHMARK_OUTPUT, pg_bin=PG_BIN_DIR, seed=0):
+    report = {
+        "commit": current_commit(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "customers": customers,
+        "samples": samples,
+        "results": [],
+    }
+    with EphemeralPostgres(pg_bin) as connect_kwargs:
+        configure_pool(**connect_kwargs)
+        try:
+            with pooled_cursor() as cursor:
+                seed_customers(cursor, customers, seed)
+                generator = TransactionGenerator(cursor, seed=seed)
+                for size in sorted(sizes):
+                    with redirect_stdout(io.StringIO()):
+                        seed_transactions(cursor, generator, size)
+                    results = run_benchmarks(cursor, generator, size, samples)
+                    report["results"].extend(results)
+                    for result in results:
+                        print(f"{highlight('blue', result['benchmark'])} at {highlight('blue', size)} rows: {highlight('yellow', result['ops_per_sec'])} ops/sec")
+        finally:
+            configure_pool()  # Back to DATABASE_CONFIG, the throwaway cluster is about to be removed
+
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark results written to {highlight('blue', output)}")
+    return report
+
+# Running this file directly runs the benchmark suite
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Card Guard benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(BENCHMARK_SIZES), help="Transaction table sizes to benchmark")
+    parser.add_argument("--customers", type=int, default=BENCHMARK_CUSTOMERS, help="Customers to seed")
+    parser.add_argument("--samples", type=int, default=BENCHMARK_SAMPLES, help="Calls timed per benchmark")
+    parser.add_argument("--output", default=BENCHMARK_OUTPUT, help="JSON file the results are written to")
+    parser.add_argument("--pg-bin", default=PG_BIN_DIR, help="Directory holding initdb and pg_ctl")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated data")
+    args = parser.parse_args()
+    main(args.sizes, args.customers, args.samples, args.output, args.pg_bin, args.seed)
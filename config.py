@@ -10,4 +10,140 @@ DATABASE_CONFIG = {
 }
 
 TRANSACTIONS_TABLE = "transactions"
-CUSTOMERS_TABLE = "customers"
\ No newline at end of file
+CUSTOMERS_TABLE = "customers"
+SPENDING_STATS_TABLE = "customer_spending_stats"
+LOCATION_COUNTS_TABLE = "customer_location_counts"
+TRANSACTION_SCORES_TABLE = "transaction_scores"
+
+# Connection pool settings shared by every module (see utils.get_pool)
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_CHECKOUT_TIMEOUT = 30  # Seconds to wait for a free connection before giving up
+POOL_HEALTH_CHECK_INTERVAL = 30  # Seconds a connection may sit idle before it is pinged on checkout
+
+# Hot lookup queries run as server-side prepared statements, planned once per pooled connection (see utils.execute_prepared)
+# Turn off behind a pooler in transaction mode (e.g. PgBouncer), where a session's prepared statements are not kept
+PREPARED_STATEMENTS = True
+
+BULK_INSERT_CHUNK_SIZE = 5000  # Rows written per commit by add_transactions_bulk
+
+# In-memory registries of existing transaction and customer IDs (see id_registry.py)
+ID_REGISTRY_FALSE_POSITIVE_RATE = 0.001  # Share of new IDs still confirmed with a query, lower costs more memory
+ID_REGISTRY_MIN_CAPACITY = 100000  # IDs a registry is sized for at least, it is rebuilt larger once it fills up
+
+# Spark settings used by data_processing.py
+SPARK_APP_NAME = "Card Guard"
+SPARK_MASTER = "local[*]"  # Use every local core
+SPARK_JDBC_PACKAGE = "org.postgresql:postgresql:42.7.5"  # PostgreSQL JDBC driver, fetched by Spark on first run
+SPARK_JARS = None  # Path to a local driver jar instead, e.g. "file:///C:/PostgreSQL/postgresql-42.7.5.jar"
+SPARK_SETTINGS = {
+    "spark.driver.memory": "8g",
+    "spark.executor.memory": "8g",
+    "spark.driver.maxResultSize": "4g",
+    "spark.executor.extraJavaOptions": "-XX:+UseG1GC",
+    "spark.executor.heartbeatInterval": "60s",
+}
+
+# Parallel JDBC reads - "hash" splits rows on a hash of the table's id column, "timestamp" splits
+# transactions into timestamp ranges, None reads through a single connection
+JDBC_PARTITION_MODE = "hash"
+JDBC_NUM_PARTITIONS = None  # None uses one partition per available core
+JDBC_LOWER_BOUND = None  # Timestamp range bounds, looked up with MIN/MAX when None
+JDBC_UPPER_BOUND = None
+JDBC_FETCHSIZE = 10000  # Rows fetched per round-trip by each JDBC connection
+
+# Parquet snapshot settings used by snapshot.py
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_BATCH_SIZE = 100000  # Rows streamed from the database per Parquet write
+SNAPSHOT_LOG_TABLE = "transaction_inserts"  # IDs of inserted transactions, filled by a trigger, read by incremental refreshes
+
+# In-process customer profile cache (see customer_cache.py)
+CUSTOMER_CACHE_MAX_SIZE = 100000  # Profiles kept before the least recently used are evicted
+CUSTOMER_CACHE_TTL = 300  # Seconds a cached profile is trusted before it is reloaded
+
+# Asyncio scoring service settings (see scoring_service.py)
+SCORING_WORKERS = 8  # Transactions scored concurrently, keep at or below POOL_MAX_SIZE
+SCORING_QUEUE_SIZE = 1000  # Pending transactions before callers are made to wait
+SCORING_TIMEOUT = 1.0  # Seconds a caller waits for a decision, including time spent queued
+SCORING_LATENCY_WINDOW = 10000  # Most recent latencies kept for the p50/p99 report
+
+# FRAUD RULE SETTINGS - defaults loaded by rule_config.py, a RULE_CONFIG_FILE can override any of them
+# Maximum expected amount for each category (including "Other", used for any unexpected category)
+CATEGORY_BOUNDS = {
+    "Groceries": 300.00,
+    "Utilities": 300.00,
+    "Charity": 300.00,
+    "Insurance": 300.00,
+    "Miscellaneous": 300.00,
+    "Dining": 500.00,
+    "Travel": 3000.00,
+    "Retail": 500.00,
+    "Healthcare": 1500.00,
+    "Subscriptions": 100.00,
+    "Education": 2500.00,
+    "Automobile": 1000.00,
+    "Entertainment": 300.00,
+    "Luxury Items": 5000.00,
+    "Financial Services": 200.00,
+    "Night Club": 500.00,
+    "Bar Service": 500.00,
+    "Gambling": 500.00,
+    "Car Rental": 500.00,
+    "Other": 500.00,
+}
+# Categories that are unexpected for customers under MINIMUM_AGE
+AGE_RESTRICTED_CATEGORIES = ("Night Club", "Bar Service", "Gambling", "Car Rental")
+MINIMUM_AGE = 21
+Z_SCORE_THRESHOLD = 2.0  # Amounts more than this many standard deviations from the customer's average are outliers
+
+# Location profiles (see location_profiles.py) - besides the customer's home location, the LOCATION_TOP_K locations
+# the customer uses most are expected, as long as at least LOCATION_MIN_SHARE of their earlier transactions were there
+LOCATION_TOP_K = 3
+LOCATION_MIN_SHARE = 0.1
+
+# Duplicate transaction detection - repeats only count within this time window and amount difference
+DUPLICATE_WINDOW_MINUTES = 60
+DUPLICATE_AMOUNT_TOLERANCE = 0.01  # Dollars
+
+RULE_CONFIG_FILE = None  # JSON or TOML file overriding the rule settings above, reloaded when it changes
+RULE_CONFIG_CHECK_INTERVAL = 5  # Seconds between checks of RULE_CONFIG_FILE for changes
+
+# Fraud rule engine (see fraud_rules.py) - rules stop running once the fraud_score reaches this value
+# None runs every rule so the full fraud_score is reported, 1 stops at the first reason since one is enough for FRAUD
+FRAUD_SCORE_THRESHOLD = None
+
+# Write-behind verdicts (see verdict_writer.py) - flag_fraud queues its verdict and a background thread writes the
+# queued verdicts with one UPDATE per batch, so scoring does not wait for a commit
+VERDICT_WRITE_BEHIND = True  # False writes and commits each verdict before flag_fraud returns
+VERDICT_BATCH_SIZE = 500  # Verdicts written per commit
+VERDICT_MAX_LATENCY = 0.2  # Seconds a verdict may wait for its batch to fill before the batch is written anyway
+VERDICT_QUEUE_SIZE = 10000  # Pending verdicts before flag_fraud is made to wait
+VERDICT_SUBMIT_TIMEOUT = 1.0  # Seconds flag_fraud waits for room in a full queue before writing its verdict itself
+VERDICT_WRITE_RETRIES = 3  # Attempts at a batch before it is saved to VERDICT_SPILL_FILE
+VERDICT_SPILL_FILE = "unwritten_verdicts.jsonl"  # Replayed by running verdict_writer.py
+
+# Metrics (see metrics.py) - per-rule timings, query counts and cache hit rates in the Prometheus text format
+METRICS_ENABLED = False  # Off by default, the disabled path costs one attribute check per call
+METRICS_FILE = "metrics.prom"  # Written by metrics.write()
+METRICS_PORT = 9108  # Served by metrics.serve()
+
+# Benchmark suite settings (see benchmark.py)
+BENCHMARK_SIZES = (1000, 10000, 100000, 1000000)  # Transactions in the table for each round
+BENCHMARK_CUSTOMERS = 1000
+BENCHMARK_SAMPLES = 200  # Calls timed per benchmark
+BENCHMARK_OUTPUT = "benchmark_results.json"
+PG_BIN_DIR = None  # Directory holding initdb and pg_ctl, None searches PATH
+
+# Server-side cursor streaming (see utils.stream_rows) - rows fetched per round-trip by maintenance jobs
+STREAM_ITERSIZE = 10000
+
+# Parallel rescoring of historical transactions (see rescore.py)
+RESCORE_PROCESSES = None  # Worker processes, None uses one per core - each opens its own pooled connection
+RESCORE_BATCH_SIZE = 5000  # Transactions scored and checkpointed per step
+RESCORE_CHECKPOINT_TABLE = "rescore_checkpoints"
+
+# Streaming ingestion of transaction events (see ingestion.py)
+INGESTION_BATCH_SIZE = 1000  # Events persisted and scored per micro-batch
+INGESTION_MAX_LATENCY = 0.5  # Seconds an event may wait for its batch to fill before the batch is flushed anyway
+INGESTION_POLL_INTERVAL = 0.1  # Seconds between checks of a JSONL file for new events
+INGESTION_OFFSETS_TABLE = "ingestion_offsets"
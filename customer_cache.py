@@ -0,0 +1,134 @@
+# CARD GUARD
+# Customer Profile Cache
+# Customer attributes almost never change, so the fraud rules read them from an in-process LRU cache
+# instead of querying the customers table for every scored transaction
+
+# Import libraries
+from config import *
+from models import *
+from metrics import metrics
+from collections import OrderedDict
+import threading
+import time
+
+# LRU cache of Customer objects keyed by customer_id, entries expire after ttl seconds
+# Customers missing from the database are cached as None so repeated lookups of unknown IDs stay cheap
+class CustomerProfileCache:
+    def __init__(self, max_size=CUSTOMER_CACHE_MAX_SIZE, ttl=CUSTOMER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # customer_id -> (expires_at, Customer or None)
+        self._lock = threading.Lock()
+        # Invalidations that happen while profiles are being loaded - a load only stores the customers that were not
+        # invalidated (or cleared) after it started, so it never puts back a profile that has since changed
+        self._generation = 0
+        self._invalidated = {}  # customer_id -> generation of its last invalidation, kept only while loads run
+        self._cleared = 0  # Generation of the last clear
+        self._loading = 0  # Loads in progress
+
+    # Helper function that returns (found, customer) for a cached, unexpired entry
+    def _lookup(self, customer_id, now):
+        entry = self._entries.get(customer_id)
+        if entry is None:
+            return False, None
+        if entry[0] < now:
+            del self._entries[customer_id]
+            return False, None
+        self._entries.move_to_end(customer_id)
+        return True, entry[1]
+
+    # Helper function that stores an entry and evicts the least recently used ones, the caller holds the lock
+    def _store(self, customer_id, customer):
+        self._entries[customer_id] = (time.monotonic() + self.ttl, customer)
+        self._entries.move_to_end(customer_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    # Registers a load of customers read outside the cache - call before the query, and pass the returned
+    # generation to finish_load once it is done (with {} if it failed)
+    def start_load(self):
+        with self._lock:
+            self._loading += 1
+            return self._generation
+
+    # Stores the loaded customers ({customer_id: Customer or None}), leaving out any that were invalidated or cleared
+    # after the load started
+    def finish_load(self, started, customers):
+        with self._lock:
+            for customer_id, customer in customers.items():
+                if self._cleared <= started and self._invalidated.get(customer_id, started) <= started:
+                    self._store(customer_id, customer)
+            self._loading -= 1
+            if not self._loading:
+                self._invalidated.clear()
+
+    # Returns the Customer for customer_id, or None if it is not in the database - queries only on a miss
+    def get(self, cursor, customer_id):
+        return self.get_many(cursor, [customer_id])[customer_id]
+
+    # Returns a dict of customer_id -> Customer (or None) - every miss is loaded with a single query
+    def get_many(self, cursor, customer_ids):
+        profiles = {}
+        missing = {}  # Ordered set of customer_ids to load
+        now = time.monotonic()
+        with self._lock:
+            for customer_id in customer_ids:
+                found, customer = self._lookup(customer_id, now)
+                if found:
+                    self.hits += 1
+                    profiles[customer_id] = customer
+                elif customer_id not in missing:
+                    self.misses += 1
+                    missing[customer_id] = True
+            if missing:
+                self._loading += 1
+                started = self._generation
+
+        if missing:
+            load_sql = """
+                SELECT customer_id, first_name, last_name, age, location, phone_number
+                FROM {table_name}
+                WHERE customer_id = ANY(%s)
+            """.format(table_name=CUSTOMERS_TABLE)
+            try:
+                cursor.execute(load_sql, (list(missing),))
+                loaded = {row[0]: Customer(*row) for row in cursor.fetchall()}
+            except Exception:
+                self.finish_load(started, {})
+                raise
+            for customer_id in missing:
+                profiles[customer_id] = loaded.get(customer_id)
+            self.finish_load(started, {customer_id: profiles[customer_id] for customer_id in missing})
+        return profiles
+
+    # Drops a customer so the next lookup reloads it, called whenever a customer is added, updated or deleted
+    def invalidate(self, customer_id):
+        with self._lock:
+            self._entries.pop(customer_id, None)
+            self._generation += 1
+            if self._loading:
+                self._invalidated[customer_id] = self._generation
+
+    # Drops every cached customer
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._cleared = self._generation
+
+    # Returns the hit/miss counters and current size
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+# Cache shared by every module in this process
+customer_cache = CustomerProfileCache()
+
+# Cache counters exported with the rest of the metrics
+metrics.gauge("cardguard_customer_cache_hits", "Customer cache lookups answered from memory", lambda: customer_cache.stats()["hits"])
+metrics.gauge("cardguard_customer_cache_misses", "Customer cache lookups that queried the database", lambda: customer_cache.stats()["misses"])
+metrics.gauge("cardguard_customer_cache_hit_rate", "Share of customer cache lookups answered from memory", lambda: customer_cache.stats()["hit_rate"])
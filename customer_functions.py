@@ -5,90 +5,98 @@
 from config import *
 from models import *
 from utils import *
+from customer_cache import customer_cache
+from id_registry import customer_id_registry
 import random
 import uuid
 from faker import Faker
 
-# Connect to PostgreSQL Database using the helper function
-main_connection = database_connect(**DATABASE_CONFIG)  # Database connection passed into functions
-main_cursor = main_connection.cursor()  # Cursor to execute SQL commands passed into functions
-
-# Stores all transactions for a given customer_id in a list
-def list_of_transactions(cursor, customerID):
+# Helper function that lists a customer's transactions in one round-trip - the EXISTS tells an unknown customer
+# apart from a customer without matching transactions, so no separate check of the customers table is needed
+# Returns (customer_exists, rows) where rows hold the requested columns, in transaction_id order
+def _customer_transactions(cursor, customerID, columns, fraud_only, limit, after):
+    list_sql = """
+        SELECT c.found, t.matched, {columns}
+        FROM (SELECT EXISTS (SELECT 1 FROM {customers_table} WHERE customer_id = %s) AS found) AS c
+        LEFT JOIN LATERAL (
+            SELECT TRUE AS matched, {columns} FROM {transactions_table}
+            WHERE customer_id = %s AND transaction_id > %s {fraud_filter}
+            ORDER BY transaction_id
+            LIMIT %s
+        ) AS t ON c.found
+    """.format(columns=select_columns(Transaction, columns), customers_table=CUSTOMERS_TABLE, transactions_table=TRANSACTIONS_TABLE,
+               fraud_filter="AND is_fraud = 'FRAUD'" if fraud_only else "")
+    execute_prepared(cursor, list_sql, (customerID, customerID, after or "", limit))
+    rows = cursor.fetchall()
+    # A customer without matching transactions still comes back as one row, with NULL transaction columns
+    return rows[0][0], [row[2:] for row in rows if row[1]]
+
+# Stores all transactions for a given customer_id in a list of (transaction_id,) rows
+# columns selects other fields instead, e.g. ("transaction_id", "amount"), and limit/after page through a long
+# history in transaction_id order - pass the last transaction_id of one page as after to get the next
+def list_of_transactions(cursor, customerID, columns=("transaction_id",), limit=None, after=None):
     try:
-        # Check if the customer exists in customers table
-        check_sql = "SELECT * FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-        cursor.execute(check_sql, (customerID,))
-        
-        # Use fetchone to get a single result
-        result = cursor.fetchone()
-
-        # If customer exists, find and return a list of their transactions from the transactions table
-        if result:
-            get_transactions_sql = "SELECT transaction_id FROM {table_name} WHERE customer_id = %s".format(table_name=TRANSACTIONS_TABLE)
-            cursor.execute(get_transactions_sql, (customerID,))
-            transactions_list = cursor.fetchall()
-            if transactions_list: return transactions_list
-            else: 
-                print(f"Customer ID: {highlight("blue",customerID)} does not have any transactions")
-                return []
-        # If customer does not exist, return an empty list
+        customer_exists, transactions_list = _customer_transactions(cursor, customerID, columns, False, limit, after)
+        if transactions_list:
+            return transactions_list
+        # Tell a customer without transactions apart from one that does not exist
+        elif customer_exists:
+            print(f"Customer ID: {highlight('blue', customerID)} does not have any transactions")
         else:
-            print(f"Customer ID: {highlight("blue",customerID)} is not in the database.")
-            return []
-        
+            print(f"Customer ID: {highlight('blue', customerID)} is not in the database.")
+        return []
+
     except Exception as e:
         print(f"Error finding customer: {e}")
         raise  # Re-raise the exception for better error propagation
 
-# Lists all of the transactions marked as fraud for a given customer_id
-def list_fraud(cursor, customerID):
+# Lists all of the transactions marked as fraud for a given customer_id, same options as list_of_transactions
+def list_fraud(cursor, customerID, columns=("transaction_id",), limit=None, after=None):
     try:
-        # Check if the customer exists in customers table
-        check_sql = "SELECT * FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-        cursor.execute(check_sql, (customerID,))
-        
-        # Use fetchone to get a single result
-        result = cursor.fetchone()
-
-        # If customer exists, find and return a list of their fraudulent transactions from the transactions table
-        if result:
-            get_transactions_sql = """
-                                    SELECT transaction_id 
-                                    FROM {table_name} 
-                                    WHERE customer_id = %s AND is_fraud = 'FRAUD'
-                                    """.format(table_name=TRANSACTIONS_TABLE)
-            cursor.execute(get_transactions_sql, (customerID,))
-            transactions_list = cursor.fetchall()
-            if transactions_list: return transactions_list
-            else: 
-                print(f"Customer ID: {highlight("blue",customerID)} does not have any fraudulent transactions")
-                return []
-        # If customer does not exist, return an empty list
+        customer_exists, transactions_list = _customer_transactions(cursor, customerID, columns, True, limit, after)
+        if transactions_list:
+            return transactions_list
+        elif customer_exists:
+            print(f"Customer ID: {highlight('blue', customerID)} does not have any fraudulent transactions")
         else:
-            print(f"Customer ID: {highlight("blue",customerID)} is not in the database.")
-            return []
-        
+            print(f"Customer ID: {highlight('blue', customerID)} is not in the database.")
+        return []
+
     except Exception as e:
         print(f"Error finding customer: {e}")
         raise  # Re-raise the exception for better error propagation
 
-# Helper function to find a customer_id in database from customer ID
-def find_customer(cursor, customerID):
+# Streaming versions of list_of_transactions and list_fraud for customers with very long histories
+# Yield (transaction_id,) rows through a server-side cursor instead of building the whole list in memory
+def stream_transactions(cursor, customerID, itersize=STREAM_ITERSIZE):
+    get_transactions_sql = "SELECT transaction_id FROM {table_name} WHERE customer_id = %s".format(table_name=TRANSACTIONS_TABLE)
+    yield from stream_rows(cursor, get_transactions_sql, (customerID,), itersize)
+
+def stream_fraud(cursor, customerID, itersize=STREAM_ITERSIZE):
+    get_transactions_sql = """
+                            SELECT transaction_id 
+                            FROM {table_name} 
+                            WHERE customer_id = %s AND is_fraud = 'FRAUD'
+                            """.format(table_name=TRANSACTIONS_TABLE)
+    yield from stream_rows(cursor, get_transactions_sql, (customerID,), itersize)
+
+# Helper function to find a customer_id in database from customer ID - returns a Customer
+# columns fetches only those fields instead and returns them as a tuple, e.g. find_customer(cursor, id, ("age",))
+def find_customer(cursor, customerID, columns=None):
     try:
-        # Check if the customer_id exists
-        check_sql = "SELECT * FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-        cursor.execute(check_sql, (customerID,))
+        find_sql = "SELECT {columns} FROM {table_name} WHERE customer_id = %s".format(
+            columns=select_columns(Customer, columns or Customer.__slots__), table_name=CUSTOMERS_TABLE)
+        execute_prepared(cursor, find_sql, (customerID,))
         
         # Use fetchone to get a single result
         result = cursor.fetchone()
 
         # Return the result if found, otherwise return None
         if result:
-            # Create a Customer object from the tuple result
-            return Customer(*result)  # Unpacks the result tuple into the Customer constructor
+            # Create a Customer object from the tuple result when every column was fetched
+            return result if columns else Customer(*result)
         else:
-            print(f"Customer ID: {highlight("blue",customerID)} is not in the database.")
+            print(f"Customer ID: {highlight('blue', customerID)} is not in the database.")
             return None
 
     except Exception as e:
@@ -96,60 +104,58 @@ def find_customer(cursor, customerID):
         raise  # Re-raise the exception for better error propagation
 
 # Adds a customer to database, allows for manual customer entry
+# An existing customer_id is skipped by the INSERT itself, so no separate existence check is needed
 def add_customer(cursor, customer):
     try:
-        # Check if the customer_id already exists
-        check_sql = "SELECT 1 FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-        cursor.execute(check_sql, (customer.customer_id,))
-        result = cursor.fetchone()
+        # SQL to insert new customer
+        insert_sql = """
+            INSERT INTO {table_name} (
+                customer_id, first_name, last_name, age, location, phone_number
+            )
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (customer_id) DO NOTHING
+        """.format(table_name=CUSTOMERS_TABLE)
+        # Execute the SQL Query
+        cursor.execute(insert_sql, (
+            customer.customer_id, customer.first_name, customer.last_name, 
+            customer.age, customer.location, customer.phone_number
+        ))
 
-        if result:
+        if not cursor.rowcount:
             print(f"Customer ID: {highlight('blue', customer.customer_id)} already exists in the database. Skipping insertion.")
         else:
-            # SQL to insert new customer
-            insert_sql = """
-                INSERT INTO {table_name} (
-                    customer_id, first_name, last_name, age, location, phone_number
-                )
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """.format(table_name=CUSTOMERS_TABLE)
-            # Execute the SQL Query
-            cursor.execute(insert_sql, (
-                customer.customer_id, customer.first_name, customer.last_name, 
-                customer.age, customer.location, customer.phone_number
-            ))
-            # Commit the addition
-            main_connection.commit()
+            # Commit the addition, record the new ID and drop any cached 'not found' entry for this customer
+            cursor.connection.commit()
+            customer_id_registry.add([customer.customer_id])
+            customer_cache.invalidate(customer.customer_id)
             print(f"Customer ID: {highlight('blue', customer.customer_id)} ({highlight('blue', customer.last_name)}, {highlight('blue', customer.first_name)}) successfully added to database!")
 
     except Exception as e:
         print("Failed to insert customer into table:", e)
-        main_connection.rollback()  # Roll back the query in case of an error
+        cursor.connection.rollback()  # Roll back the query in case of an error
 
 # Removes a customer from database, allows for manual customer deletion via provided customerID
+# The DELETE reports whether the customer existed, so no separate existence check is needed
 def delete_customer(cursor, customer):    
     try:
-        # Check if the customer_id exists
-        check_sql = "SELECT 1 FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-        cursor.execute(check_sql, (customer.customer_id,))
-        result = cursor.fetchone()
+        # SQL FUNCTION to delete a customer by customer_id
+        remove_sql = "DELETE FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
+        # Execute the SQL Query
+        execute_prepared(cursor, remove_sql, (customer.customer_id,))
 
-        if result:
-            # SQL FUNCTION to delete a customer by customer_id
-            remove_sql = "DELETE FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-            # Execute the SQL Query
-            cursor.execute(remove_sql, (customer.customer_id,))
-        
-            # Commit the deletion
-            main_connection.commit()
+        if cursor.rowcount:
+            # Commit the deletion and drop the customer's cached profile
+            cursor.connection.commit()
+            customer_id_registry.remove([customer.customer_id])
+            customer_cache.invalidate(customer.customer_id)
             print(f"Customer ID: {highlight('blue', customer.customer_id)} ({highlight('blue', customer.last_name)}, {highlight('blue', customer.first_name)}) successfully removed from database!")
 
         else:
-            print(f"Customer ID: {highlight("blue",customer.customer_id)} is not in the database.")
+            print(f"Customer ID: {highlight('blue', customer.customer_id)} is not in the database.")
     
     except Exception as e:
         print(f"Failed to delete customer from table: {e}")
-        main_connection.rollback()  # Roll back the query in case of an error
+        cursor.connection.rollback()  # Roll back the query in case of an error
 
 # Function to generate a randomized customer - returns a Customer
 def generate_customer(cursor):
@@ -157,19 +163,10 @@ def generate_customer(cursor):
     fake = Faker()
 
     # Helper function to generate a unique customer ID
+    # The ID registry answers for new IDs without a query, only possible matches are checked in the database
     def generate_unique_customer_id():
         try:
-            while True:
-                # Generate a new customer ID
-                customer_id = str(uuid.uuid4())[:10].replace('-', '')
-
-                # Check if the customer ID exists
-                check_sql = "SELECT 1 FROM {table_name} WHERE customer_id = %s".format(table_name=CUSTOMERS_TABLE)
-                cursor.execute(check_sql, (customer_id,))
-                result = cursor.fetchone()
-
-                if not result:  # If no match found
-                    return customer_id  # Unique ID found, return it
+            return customer_id_registry.new_id(cursor, lambda: str(uuid.uuid4())[:10].replace('-', ''))
 
         except Exception as e:
             print(f"Error generating customer ID: {e}")
@@ -202,12 +199,9 @@ def update_customer(cursor, customer):
                 customer.customer_id,
         ))
         
-        # Commit changes and close connections
-        main_connection.commit()
+        # Commit changes and drop the customer's cached profile
+        cursor.connection.commit()
+        customer_cache.invalidate(customer.customer_id)
         print(f"Customer ID: {highlight("blue",customer.customer_id)} successfully updated.")
     except Exception as e:
         print(f"Error updating Customer ID:  {highlight("blue",customer.customer_id)}: {e}")
-
-
-# Close the connection to the PostgreSQL database
-database_close(main_connection, main_cursor)
\ No newline at end of file
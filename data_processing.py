@@ -1,17 +1,25 @@
 # CARD GUARD
 # Data Processing File
+# Distributed fraud scoring job - applies the same rules as flag_fraud to a whole table at once with Apache Spark
+# Usage:
+#   python data_processing.py                                  (read from PostgreSQL, write verdicts back to PostgreSQL)
+#   python data_processing.py --parquet snapshots/             (read a Parquet snapshot instead of PostgreSQL)
+#   python data_processing.py --parquet snapshots/ --output scored/   (write scores to Parquet instead of PostgreSQL)
+#   python data_processing.py --start 2024-01-01 --end 2024-02-01      (only score one period)
 
 # Import libraries
 from config import *
-from models import *
 from utils import *
-
-# Import class functions
-from transaction_functions import *
-from customer_functions import *
+from rule_config import get_rule_config
+from verdicts import create_transaction_scores_table, write_verdicts
+from fraud_rules import fraud_rules, REASON_CODES, REASON_AMOUNT_BOUNDS, REASON_Z_SCORE, REASON_DUPLICATE, REASON_LOCATION, REASON_AGE_CATEGORY
+import argparse
+import json
+import math
 
 # IMPLEMENT PYSPARK
-from pyspark.sql import SparkSession
+from pyspark.sql import SparkSession, Window
+from pyspark.sql import functions as F
 
 
 # Set database connection details
@@ -22,23 +30,205 @@ db_properties = {
     "driver": "org.postgresql.Driver"
 }
 
-# Initialize SparkSession with the JDBC driver on the local machine (No need for Hadoop implementation)
-spark = SparkSession.builder \
-    .appName("Card Guard") \
-    .master("local[*]") \
-    .config("spark.jars", "file:///C:/PostgreSQL/postgresql-42.7.5.jar") \
-    .config("spark.driver.memory", "8g") \
-    .config("spark.executor.memory", "8g") \
-    .config("spark.driver.maxResultSize", "4g") \
-    .config("spark.executor.extraJavaOptions", "-XX:+UseG1GC") \
-    .config("spark.executor.heartbeatInterval", "60s") \
-    .getOrCreate()
-
-# Load data from PostgreSQL into Spark
-df = spark.read.jdbc(url=db_url, table=TRANSACTIONS_TABLE, properties=db_properties)
-
-# Reduce number of partitions
-df = df.repartition(10)
-
-# Show a preview of the data
-df.limit(5).show()
\ No newline at end of file
+# Initialize SparkSession from the settings in config.py (No need for Hadoop implementation)
+def build_spark_session():
+    builder = SparkSession.builder.appName(SPARK_APP_NAME).master(SPARK_MASTER)
+    if SPARK_JARS:
+        builder = builder.config("spark.jars", SPARK_JARS)
+    elif SPARK_JDBC_PACKAGE:
+        builder = builder.config("spark.jars.packages", SPARK_JDBC_PACKAGE)
+    for key, value in SPARK_SETTINGS.items():
+        builder = builder.config(key, value)
+    return builder.getOrCreate()
+
+# Column used to split each table into hash partitions
+ID_COLUMNS = {TRANSACTIONS_TABLE: "transaction_id", CUSTOMERS_TABLE: "customer_id"}
+
+# Helper function that finds the MIN and MAX timestamp of the transactions table for range partitioning
+def find_timestamp_bounds(start_date=None, end_date=None):
+    with pooled_cursor() as cursor:
+        bounds_sql = "SELECT MIN(timestamp), MAX(timestamp) FROM {table_name}".format(table_name=TRANSACTIONS_TABLE)
+        cursor.execute(bounds_sql)
+        lower, upper = cursor.fetchone()
+    return start_date or lower, end_date or upper
+
+# Reads a table from PostgreSQL over several JDBC connections in parallel, one per partition
+# Hash mode gives every partition an equal share of rows, timestamp mode gives every partition a time range
+def read_jdbc(spark, table_name, start_date=None, end_date=None):
+    num_partitions = JDBC_NUM_PARTITIONS or spark.sparkContext.defaultParallelism
+    reader = spark.read.format("jdbc") \
+        .option("url", db_url) \
+        .option("dbtable", table_name) \
+        .option("fetchsize", JDBC_FETCHSIZE) \
+        .options(**db_properties)
+
+    if JDBC_PARTITION_MODE == "timestamp" and table_name == TRANSACTIONS_TABLE:
+        lower, upper = JDBC_LOWER_BOUND, JDBC_UPPER_BOUND
+        if lower is None or upper is None:
+            lower, upper = find_timestamp_bounds(start_date, end_date)
+        if lower is not None and upper is not None:
+            reader = reader \
+                .option("partitionColumn", "timestamp") \
+                .option("lowerBound", str(lower)) \
+                .option("upperBound", str(upper)) \
+                .option("numPartitions", num_partitions)
+        return reader.load()
+
+    if JDBC_PARTITION_MODE == "hash" and table_name in ID_COLUMNS:
+        # Each partition reads the rows whose id hashes to its bucket - the sign bit is masked off rather than using
+        # abs(), which overflows when hashtext returns the smallest integer
+        predicates = [f"mod(hashtext({ID_COLUMNS[table_name]}) & 2147483647, {num_partitions}) = {bucket}" for bucket in range(num_partitions)]
+        properties = dict(db_properties, fetchsize=str(JDBC_FETCHSIZE))
+        return spark.read.jdbc(url=db_url, table=table_name, predicates=predicates, properties=properties)
+
+    return reader.load()
+
+# Load a table from PostgreSQL, or from <parquet_path>/<table> when a Parquet snapshot (see snapshot.py) is given
+# A start_date/end_date range on transactions is pushed down to PostgreSQL or the Parquet reader
+def load_table(spark, table_name, parquet_path=None, start_date=None, end_date=None):
+    if parquet_path:
+        df = spark.read.parquet(f"{parquet_path.rstrip('/')}/{table_name}")
+    else:
+        df = read_jdbc(spark, table_name, start_date, end_date)
+
+    if table_name == TRANSACTIONS_TABLE:
+        # Plain string bounds are cast to the column's own timestamp type, which keeps the filter pushable
+        if start_date:
+            df = df.where(F.col("timestamp") >= start_date)
+        if end_date:
+            df = df.where(F.col("timestamp") < end_date)
+        # Snapshots written by snapshot.py are partitioned by date, so whole directories outside the range are skipped
+        if "date" in df.columns:
+            if start_date:
+                df = df.where(F.col("date") >= F.to_date(F.lit(start_date)))
+            if end_date:
+                df = df.where(F.col("date") <= F.to_date(F.lit(end_date)))
+    return df
+
+# Applies every flag_fraud rule as column expressions - returns transaction_id, is_fraud, fraud_score, rule_version,
+# reason_mask and params (JSON) for each transaction flag_fraud would process (positive amount, undetermined status, approved or pending)
+# rules is the RuleConfig to score with, the current one when None
+def score_transactions(spark, transactions, customers, rules=None):
+    rules = rules or get_rule_config()
+    transactions = transactions.withColumn("amount", F.col("amount").cast("double"))
+
+    # Per-customer average and sample standard deviation over the customer's whole history
+    by_customer = Window.partitionBy("customer_id")
+    transactions = transactions \
+        .withColumn("avg_spent", F.avg("amount").over(by_customer)) \
+        .withColumn("std_dev", F.coalesce(F.stddev_samp("amount").over(by_customer), F.lit(0.0)))
+
+    # Duplicates share customer_id, merchant_name, location and card_type with another transaction within the
+    # duplicate time window and amount tolerance - NULL keys never match in the join, just like the per-row SQL lookup
+    # Amounts are compared in whole cents, as doubles an exact one-cent difference can come out just over 0.01
+    duplicate_key = ["customer_id", "merchant_name", "location", "card_type"]
+    tolerance_cents = math.floor(round(rules.duplicate_amount_tolerance * 100, 6))
+    left = transactions.select(*duplicate_key, "transaction_id", "timestamp", "amount")
+    right = left.select(*duplicate_key, *[F.col(c).alias(f"other_{c}") for c in ("transaction_id", "timestamp", "amount")])
+    duplicate_counts = left.join(right, duplicate_key) \
+        .where((F.col("transaction_id") != F.col("other_transaction_id"))
+               & (F.abs(F.unix_timestamp("timestamp") - F.unix_timestamp("other_timestamp")) <= rules.duplicate_window_minutes * 60)
+               & (F.abs(F.round(F.col("amount") * 100) - F.round(F.col("other_amount") * 100)) <= tolerance_cents)) \
+        .groupBy("transaction_id").agg(F.count("*").alias("duplicate_count"))
+    transactions = transactions.join(duplicate_counts, "transaction_id", "left")
+
+    # Customer location and age, missing customers fall back to 'Unknown' and 0 like the per-row lookups
+    profiles = customers.select("customer_id", F.col("location").alias("common_location"), "age",
+                                F.lit(True).alias("has_profile"))
+    transactions = transactions.join(profiles, "customer_id", "left") \
+        .withColumn("common_location", F.when(F.col("has_profile").isNull(), F.lit("Unknown")).otherwise(F.col("common_location"))) \
+        .withColumn("age", F.when(F.col("has_profile").isNull(), F.lit(0)).otherwise(F.col("age")))
+
+    # Location profiles - the same counts location_profiles.py keeps, over the customer's whole history
+    # Only the top-K locations (ties included) count, and the share leaves out the transaction being scored
+    location_counts = transactions.where(F.col("customer_id").isNotNull() & F.col("location").isNotNull()) \
+        .groupBy("customer_id", "location").agg(F.count("*").alias("location_count")) \
+        .withColumn("location_total", F.sum("location_count").over(by_customer)) \
+        .withColumn("location_rank", F.rank().over(Window.partitionBy("customer_id").orderBy(F.desc("location_count"))))
+    location_totals = location_counts.select("customer_id", "location_total").distinct()
+    top_locations = location_counts.where(F.col("location_rank") <= rules.location_top_k).select("customer_id", "location", "location_count")
+    transactions = transactions.join(location_totals, "customer_id", "left") \
+        .join(top_locations, ["customer_id", "location"], "left") \
+        .withColumn("location_share", F.when(F.col("location_total") > 1,
+                                             F.greatest(F.coalesce(F.col("location_count"), F.lit(0)) - 1, F.lit(0)) / (F.col("location_total") - 1))
+                                       .otherwise(F.lit(0.0)))
+
+    # Category bounds are tiny, so they are broadcast to every executor instead of shuffled
+    bounds = spark.createDataFrame(list(rules.category_bounds.items()), ["category", "max_allowed"])
+    transactions = transactions.join(F.broadcast(bounds), "category", "left") \
+        .withColumn("max_allowed", F.coalesce(F.col("max_allowed"), F.lit(rules.other_bound)))
+
+    # Only score transactions that flag_fraud would process
+    eligible = (F.col("amount") > 0) \
+        & (F.col("is_fraud").isNull() | (F.col("is_fraud") == "Undetermined")) \
+        & F.col("approval_status").isin("Pending", "Approved")
+
+    # One flag per rule, each adding its registered weight to fraud_score, with its reason code and the param flag_fraud records for it
+    z_score = (F.col("amount") - F.col("avg_spent")) / F.col("std_dev")
+    flags = [
+        (REASON_AMOUNT_BOUNDS, F.col("amount") > F.col("max_allowed"), "max_amount", F.col("max_allowed")),
+        (REASON_Z_SCORE, (F.col("std_dev") > 0) & (F.abs(z_score) > rules.z_score_threshold), "z_score", F.round(z_score, 4)),
+        (REASON_DUPLICATE, F.coalesce(F.col("duplicate_count"), F.lit(0)) > 0, "duplicate_count", F.col("duplicate_count")),
+        (REASON_LOCATION, ~(F.col("location").eqNullSafe(F.col("common_location")) | F.col("location").eqNullSafe(F.lit("Unknown")))
+            & (F.col("location_share") < rules.location_min_share), "location_share", F.round("location_share", 4)),
+        (REASON_AGE_CATEGORY, (F.col("age") < rules.minimum_age) & F.col("category").isin(*sorted(rules.age_restricted)), "customer_age", F.col("age")),
+    ]
+    flags = [(code, F.coalesce(flag, F.lit(False)), name, param) for code, flag, name, param in flags]
+    weights = {REASON_CODES[name]: weight for name, weight in fraud_rules.reason_weights().items()}
+    fraud_score = sum(F.when(flag, F.lit(weights[code])).otherwise(F.lit(0)) for code, flag, _, _ in flags)
+    reason_mask = sum(F.when(flag, F.lit(code)).otherwise(F.lit(0)) for code, flag, _, _ in flags)
+    # to_json leaves out NULL fields, so only the params of rules that fired are kept
+    params = F.to_json(F.struct(*[F.when(flag, param).alias(name) for _, flag, name, param in flags]))
+
+    return transactions.where(eligible) \
+        .withColumn("fraud_score", fraud_score) \
+        .withColumn("is_fraud", F.when(F.col("fraud_score") > 0, F.lit("FRAUD")).otherwise(F.lit("NOT FRAUD"))) \
+        .withColumn("rule_version", F.lit(rules.version)) \
+        .withColumn("reason_mask", reason_mask) \
+        .withColumn("params", F.when(F.col("reason_mask") > 0, params)) \
+        .select("transaction_id", "is_fraud", "fraud_score", "rule_version", "reason_mask", "params")
+
+# Writes one partition of scored rows back to PostgreSQL, runs on the executors so partitions are written in parallel
+# Each partition opens its own connection, the shared pool can not cross process boundaries
+def write_partition(rows, chunk_size=5000):
+    connection = database_connect(**DATABASE_CONFIG)
+    cursor = connection.cursor()
+    try:
+        for chunk in chunk_data(((row.transaction_id, row.is_fraud, row.fraud_score, row.rule_version, row.reason_mask,
+                                  json.loads(row.params) if row.params else None) for row in rows), chunk_size):
+            write_verdicts(cursor, chunk)
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        database_close(connection, cursor)
+
+# Runs the whole scoring job
+# With a date range only that period is loaded, so spending statistics and duplicates are computed within it
+def main(parquet_path=None, output_path=None, start_date=None, end_date=None):
+    spark = build_spark_session()
+    transactions = load_table(spark, TRANSACTIONS_TABLE, parquet_path, start_date, end_date)
+    customers = load_table(spark, CUSTOMERS_TABLE, parquet_path)
+
+    scored = score_transactions(spark, transactions, customers)
+
+    if output_path:
+        scored.write.mode("overwrite").parquet(output_path)
+        print(f"Scores written to {highlight('blue', output_path)}")
+    else:
+        with pooled_cursor() as cursor:
+            create_transaction_scores_table(cursor)
+        scored.foreachPartition(write_partition)
+        print("Verdicts and fraud scores written back to the database.")
+
+    spark.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Card Guard distributed fraud scoring job")
+    parser.add_argument("--parquet", help="Read transactions and customers from this Parquet snapshot directory instead of PostgreSQL")
+    parser.add_argument("--output", help="Write scores to this Parquet directory instead of back to PostgreSQL")
+    parser.add_argument("--start", help="Only load transactions on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="Only load transactions before this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    main(args.parquet, args.output, args.start, args.end)
@@ -0,0 +1,152 @@
+# CARD GUARD
+# Fraud Rule Engine
+# Registry of fraud rules - each rule declares the customer data it needs, how expensive it is and how much it
+# adds to the fraud_score, so new rules can be added without editing flag_fraud
+# Rules run cheapest first, data is loaded at most once per transaction and only when a rule asks for it,
+# and evaluation stops as soon as the score reaches the threshold (FRAUD_SCORE_THRESHOLD, None runs every rule)
+
+# Import libraries
+from config import *
+from metrics import metrics
+from rule_config import get_rule_config
+import time
+
+# Bit of each built-in rule in a reason-code mask, shared by every scoring path
+REASON_AMOUNT_BOUNDS = 1
+REASON_Z_SCORE = 2
+REASON_DUPLICATE = 4
+REASON_LOCATION = 8
+REASON_AGE_CATEGORY = 16
+REASON_CODES = {
+    "amount_bounds": REASON_AMOUNT_BOUNDS,
+    "z_score": REASON_Z_SCORE,
+    "duplicates": REASON_DUPLICATE,
+    "location": REASON_LOCATION,
+    "age_category": REASON_AGE_CATEGORY,
+}
+
+# Helper function that turns a reason-code mask back into rule names
+def reason_names(mask):
+    return [name for name, code in REASON_CODES.items() if mask & code]
+
+# A single fraud rule - check(transaction, data) returns a reason string when the rule fires, otherwise None
+# A firing rule may also record the values behind its decision in data.params, e.g. data.params["z_score"] = 2.7
+class FraudRule:
+    def __init__(self, name, check, cost=1, weight=1, requires=(), code=None):
+        self.name = name
+        self.check = check
+        self.cost = cost  # Relative cost, 0 for pure checks and higher for rules that need database data
+        self.weight = weight  # Added to the fraud_score when the rule fires
+        self.requires = tuple(requires)  # Names of the data loaders the rule reads
+        self.code = REASON_CODES.get(name, 0) if code is None else code  # Bit set in the reason-code mask when the rule fires
+
+    def __repr__(self):
+        return f"FraudRule({self.name!r}, cost={self.cost}, weight={self.weight}, requires={self.requires}, code={self.code})"
+
+# Data for one transaction - values come from the prefetched dict, otherwise their loader runs on first access
+# rules is the RuleConfig the transaction is scored with, so every rule sees the same thresholds
+class RuleData:
+    def __init__(self, registry, cursor, transaction, prefetched=None, rules=None):
+        self.registry = registry
+        self.cursor = cursor
+        self.transaction = transaction
+        self.rules = rules or get_rule_config()
+        self.values = dict(prefetched) if prefetched else {}
+        self.params = {}  # Values recorded by the rules that fired, saved with the score
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            self.values[name] = self.registry.loaders[name](self.cursor, self.transaction)
+        return self.values[name]
+
+# Holds the registered rules and data loaders, and evaluates transactions against them
+class RuleRegistry:
+    def __init__(self):
+        self.rules = {}
+        self.loaders = {}  # name -> loader(cursor, transaction)
+        self.batch_loaders = {}  # name -> loader(cursor, transactions) returning {transaction_id: value}
+        self._ordered = None
+
+    # Decorator that registers a rule under name, replacing any rule already registered with that name
+    # code is the rule's reason-code bit, looked up in REASON_CODES when None (0 leaves it out of the mask)
+    def rule(self, name, cost=1, weight=1, requires=(), code=None):
+        def register(check):
+            self.add_rule(FraudRule(name, check, cost, weight, requires, code))
+            return check
+        return register
+
+    def add_rule(self, rule):
+        self.rules[rule.name] = rule
+        self._ordered = None
+
+    def remove_rule(self, name):
+        self.rules.pop(name, None)
+        self._ordered = None
+
+    # Decorator that registers the loader for a piece of customer data, batch=True registers the set-based version
+    def loader(self, name, batch=False):
+        def register(load):
+            (self.batch_loaders if batch else self.loaders)[name] = load
+            return load
+        return register
+
+    # Rules sorted cheapest first, registration order breaks ties
+    def ordered_rules(self):
+        if self._ordered is None:
+            self._ordered = sorted(self.rules.values(), key=lambda rule: rule.cost)
+        return self._ordered
+
+    # fraud_score weight of each built-in rule by reason name, for the scoring paths that apply the rules as column
+    # operations - a rule that is not registered (yet) counts the default 1 point
+    def reason_weights(self):
+        return {name: self.rules[name].weight if name in self.rules else 1 for name in REASON_CODES}
+
+    # Names of every data loader the registered rules read
+    def requirements(self):
+        return {name for rule in self.rules.values() for name in rule.requires}
+
+    # Loads every required piece of data for a list of transactions with the batch loaders
+    # Returns {transaction_id: {name: value}}, data without a batch loader is left to the per-row loaders
+    def prefetch(self, cursor, transactions):
+        prefetched = {transaction.transaction_id: {} for transaction in transactions}
+        for name in self.requirements():
+            if name in self.batch_loaders:
+                with metrics.timer("cardguard_prefetch_seconds", "Wall time of each batch data loader", loader=name):
+                    values = self.batch_loaders[name](cursor, transactions)
+                for transaction_id, value in values.items():
+                    prefetched[transaction_id][name] = value
+        return prefetched
+
+    # Runs the rules cheapest first - returns the fraud_score and list of reasons
+    # Stops once the fraud_score reaches threshold, so the remaining rules and their data are skipped
+    # With metrics on, each rule's wall time (including any data it loads) and how often it fires are recorded
+    def evaluate(self, cursor, transaction, prefetched=None, threshold=FRAUD_SCORE_THRESHOLD, rules=None):
+        return self.evaluate_detailed(cursor, transaction, prefetched, threshold, rules)[:2]
+
+    # Same as evaluate, but also returns the reason-code mask of the rules that fired and the params they recorded
+    # Returns (fraud_score, reasons, reason_mask, params), params is None when no rule recorded any
+    def evaluate_detailed(self, cursor, transaction, prefetched=None, threshold=FRAUD_SCORE_THRESHOLD, rules=None):
+        data = RuleData(self, cursor, transaction, prefetched, rules)
+        timed = metrics.enabled
+        fraud_score = 0
+        reason_mask = 0
+        reasons = []
+        for rule in self.ordered_rules():
+            if threshold is not None and fraud_score >= threshold:
+                break
+            if timed:
+                start = time.perf_counter()
+                reason = rule.check(transaction, data)
+                metrics.observe("cardguard_rule_seconds", "Wall time of each fraud rule", time.perf_counter() - start, rule=rule.name)
+                if reason:
+                    metrics.inc("cardguard_rule_fired_total", "Times each fraud rule fired", rule=rule.name)
+            else:
+                reason = rule.check(transaction, data)
+            if reason:
+                reasons.append(reason)
+                fraud_score += rule.weight
+                reason_mask |= rule.code
+        return fraud_score, reasons, reason_mask, data.params or None
+
+# Registry used by flag_fraud and flag_fraud_batch, the built-in rules are registered in transaction_functions
+fraud_rules = RuleRegistry()
@@ -0,0 +1,179 @@
+# CARD GUARD
+# ID Registry
+# Remembers every transaction and customer ID in a Bloom filter, so a freshly generated ID can be told apart from the
+# existing ones without a query - only the rare possible hit (an existing ID or a false positive) is confirmed in the database
+# The filter is loaded once per process on first use and kept up to date by the insert and delete functions
+# Usage:
+#   transaction_id = transaction_id_registry.new_id(cursor, lambda: uuid.uuid4().hex)
+
+# Import libraries
+from config import *
+from utils import *
+from metrics import metrics
+import hashlib
+import math
+import threading
+import numpy as np
+
+# Fixed-size set of strings that can answer "definitely not present" or "possibly present"
+# Sized for capacity keys at the given false positive rate, adding keys beyond capacity raises the rate
+class BloomFilter:
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = max(int(capacity), 1)
+        self.size = max(int(math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    # Helper function that yields the bit positions of a key - double hashing over the two 64-bit halves of one
+    # blake2b digest, wrapping at 64 bits like the numpy arithmetic in add_many
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield ((first + i * second) & 0xFFFFFFFFFFFFFFFF) % self.size
+
+    def add(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    # Adds many keys at once - only the hashing runs per key in Python, the bit positions are set with numpy
+    def add_many(self, keys):
+        digests = b"".join(hashlib.blake2b(key.encode(), digest_size=16).digest() for key in keys)
+        if not digests:
+            return
+        halves = np.frombuffer(digests, dtype="<u8").reshape(-1, 2)
+        first, second = halves[:, 0], halves[:, 1] | np.uint64(1)
+        with np.errstate(over="ignore"):
+            positions = np.concatenate([(first + np.uint64(i) * second) % np.uint64(self.size) for i in range(self.hashes)])
+        np.bitwise_or.at(np.frombuffer(self._bits, dtype=np.uint8), positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.count += len(halves)
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+# The IDs of one table's id column, answers exists() locally for new IDs and with one query for possible hits
+# Bloom filters cannot forget a key, so deleted IDs stay in the filter and only cost a confirming query - once
+# they make up half the filter, or it holds more IDs than it was sized for, it is rebuilt from the table
+# IDs inserted by other processes are not seen until the next rebuild, the table's primary key stays the final guard
+class IdRegistry:
+    def __init__(self, table_name, column, false_positive_rate=ID_REGISTRY_FALSE_POSITIVE_RATE, min_capacity=ID_REGISTRY_MIN_CAPACITY):
+        self.table_name = table_name
+        self.column = column
+        self.false_positive_rate = false_positive_rate
+        self.min_capacity = min_capacity
+        self.definitely_new = 0
+        self.confirmed = 0
+        self.false_positives = 0
+        self._filter = None  # Loaded on first use
+        self._removed = 0
+        self._pending = None  # IDs added while a load runs, put into the new filter when it is swapped in
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # Held for a whole load, so only one thread rebuilds the filter at a time
+
+    # (Re)builds the filter from every ID in the table, sized for twice the current row count so it can grow
+    def load(self, cursor):
+        with self._load_lock:
+            return self._load(cursor)
+
+    # Helper function that loads the filter, the caller holds _load_lock
+    # IDs added or removed while the table is read may be missing from what the load sees, so they are carried over
+    def _load(self, cursor):
+        with self._lock:
+            self._pending = []
+            removed = self._removed
+        try:
+            cursor.execute("SELECT COUNT(*) FROM {table_name}".format(table_name=self.table_name))
+            bloom = BloomFilter(max(self.min_capacity, 2 * cursor.fetchone()[0]), self.false_positive_rate)
+            ids_sql = "SELECT {column} FROM {table_name}".format(column=self.column, table_name=self.table_name)
+            for rows in stream_batches(cursor, ids_sql):
+                bloom.add_many([key for (key,) in rows])
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            bloom.add_many(self._pending)
+            self._filter = bloom
+            self._removed -= removed
+            self._pending = None
+        return bloom.count
+
+    # Helper function that returns True when the filter is missing or has gone stale
+    def _needs_load(self, bloom):
+        return bloom is None or bloom.count > bloom.capacity or self._removed * 2 > bloom.count
+
+    # Helper function that returns the filter, loading it first when it is missing or has gone stale
+    # Threads that find it stale together wait for one load instead of each rebuilding it
+    def _current(self, cursor):
+        bloom = self._filter
+        if self._needs_load(bloom):
+            with self._load_lock:
+                if self._needs_load(self._filter):
+                    self._load(cursor)
+            bloom = self._filter
+        return bloom
+
+    # Returns True if the ID is in the table - IDs the filter has never seen are answered without a query
+    def exists(self, cursor, key):
+        bloom = self._current(cursor)
+        with self._lock:
+            possible = key in bloom
+            if not possible:
+                self.definitely_new += 1
+        if not possible:
+            return False
+
+        exists_sql = "SELECT 1 FROM {table_name} WHERE {column} = %s".format(table_name=self.table_name, column=self.column)
+        execute_prepared(cursor, exists_sql, (key,))
+        found = cursor.fetchone() is not None
+        with self._lock:
+            self.confirmed += 1
+            if not found:
+                self.false_positives += 1
+        return found
+
+    # Calls make_id until it returns an ID that is not in the table yet
+    def new_id(self, cursor, make_id):
+        while True:
+            key = make_id()
+            if not self.exists(cursor, key):
+                return key
+
+    # Records inserted IDs, called by the insert functions - ignored until the filter is loaded, the load reads them anyway
+    def add(self, keys):
+        keys = list(keys)
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add_many(keys)
+            if self._pending is not None:
+                self._pending.extend(keys)
+
+    # Records deleted IDs, which stay in the filter until the next rebuild
+    def remove(self, keys):
+        with self._lock:
+            if self._filter is not None:
+                self._removed += len(keys)
+
+    # Returns the lookup counters and the size of the filter
+    def stats(self):
+        with self._lock:
+            lookups = self.definitely_new + self.confirmed
+            return {"ids": self._filter.count if self._filter else 0, "definitely_new": self.definitely_new,
+                    "confirmed": self.confirmed, "false_positives": self.false_positives,
+                    "local_rate": self.definitely_new / lookups if lookups else 0.0}
+
+# Registries shared by every module in this process
+transaction_id_registry = IdRegistry(TRANSACTIONS_TABLE, "transaction_id")
+customer_id_registry = IdRegistry(CUSTOMERS_TABLE, "customer_id")
+
+# Registry counters exported with the rest of the metrics
+metrics.gauge("cardguard_transaction_id_lookups_local", "Generated transaction IDs accepted without a query", lambda: transaction_id_registry.stats()["definitely_new"])
+metrics.gauge("cardguard_transaction_id_false_positives", "Transaction ID lookups the filter wrongly sent to the database", lambda: transaction_id_registry.stats()["false_positives"])
+metrics.gauge("cardguard_customer_id_lookups_local", "Generated customer IDs accepted without a query", lambda: customer_id_registry.stats()["definitely_new"])
+metrics.gauge("cardguard_customer_id_false_positives", "Customer ID lookups the filter wrongly sent to the database", lambda: customer_id_registry.stats()["false_positives"])
@@ -0,0 +1,390 @@
+# CARD GUARD
+# Streaming Ingestion
+# Consumes transaction events - one JSON object per line - from an append-only JSONL file or a local TCP/Unix socket
+# Events are gathered into micro-batches that are flushed when full or when their oldest event has waited
+# INGESTION_MAX_LATENCY seconds; each batch is COPYed into the transactions table, scored with set-based queries,
+# and committed together with the consumer's offset, so a restarted consumer never loses or repeats a batch
+# Socket producers get an "ACK <count>" line back once their events are committed
+# Usage:
+#   python ingestion.py --file events.jsonl                  (tail the file, resuming from the saved offset)
+#   python ingestion.py --tcp 127.0.0.1:9200 --batch-size 5000
+#   python ingestion.py --unix /tmp/cardguard.sock
+
+# Import libraries
+from config import *
+from models import *
+from utils import *
+from metrics import metrics
+from rule_config import get_rule_config
+from spending_stats import record_amounts
+from location_profiles import record_locations
+from id_registry import transaction_id_registry
+from verdicts import create_transaction_scores_table
+from transaction_functions import copy_transaction_chunk, insert_transaction_chunk, transaction_row, is_scoreable, score_batch
+from datetime import datetime
+import argparse
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+
+# Turns a decoded event into a Transaction - fields are named like the Transaction attributes, the timestamp is
+# ISO 8601 and defaults to now; raises ValueError for events that are not transactions
+def event_to_transaction(event):
+    if not isinstance(event, dict) or not event.get("transaction_id") or not event.get("customer_id"):
+        raise ValueError("event needs a transaction_id and customer_id")
+    unknown = set(event) - set(Transaction.__slots__)
+    if unknown:
+        raise ValueError(f"unknown field(s) {', '.join(sorted(unknown))}")
+    fields = dict(event)
+    fields["timestamp"] = datetime.fromisoformat(fields["timestamp"]) if fields.get("timestamp") else datetime.now()
+    fields["amount"] = float(fields.get("amount", 0))
+    return Transaction(**fields)
+
+# Turns a Transaction into an event dict, the inverse of event_to_transaction
+def transaction_to_event(transaction):
+    event = {name: getattr(transaction, name) for name in Transaction.__slots__}
+    timestamp = transaction.timestamp
+    event["timestamp"] = timestamp.isoformat() if isinstance(timestamp, datetime) else str(timestamp)
+    event["amount"] = float(transaction.amount)
+    return event
+
+# Appends transactions to a JSONL event log, e.g. to replay a day of transactions through the pipeline
+def append_events(path, transactions):
+    with open(path, "a") as file:
+        for transaction in transactions:
+            file.write(json.dumps(transaction_to_event(transaction), default=str) + "\n")
+
+## EVENT SOURCES
+# Sources hand out (line, token) pairs - the token is what the source needs to resume or acknowledge after the
+# line's batch is committed: a byte offset for a file, the sending connection for a socket
+class EventSource:
+    resumable = False  # True when offset() positions can be saved and passed back to seek() after a restart
+
+    # Waits up to wait seconds for new lines - returns up to limit (line, token) pairs, [] when none arrived
+    def _poll(self, limit, wait):
+        raise NotImplementedError
+
+    # Returns the next micro-batch: waits up to timeout seconds (forever when None) for a first line, then keeps
+    # reading until max_events lines are in hand or the first line has waited max_latency seconds
+    def read(self, max_events, max_latency, timeout=None):
+        lines = []
+        started = time.monotonic()
+        deadline = None
+        while len(lines) < max_events:
+            now = time.monotonic()
+            if deadline is None:
+                if timeout is not None and now - started >= timeout:
+                    break
+                wait = INGESTION_POLL_INTERVAL if timeout is None else min(INGESTION_POLL_INTERVAL, started + timeout - now)
+            elif now >= deadline:
+                break
+            else:
+                wait = deadline - now
+            new_lines = self._poll(max_events - len(lines), wait)
+            if new_lines and deadline is None:
+                deadline = time.monotonic() + max_latency
+            lines.extend(new_lines)
+        return lines
+
+    # Position to save once the batch holding these tokens is committed, None for sources that cannot resume
+    def offset(self, tokens):
+        return None
+
+    # Called after the batch holding these tokens is committed
+    def acknowledge(self, tokens):
+        pass
+
+    def close(self):
+        pass
+
+# Tails an append-only JSONL file - tokens are the byte offset just past each line
+# A line is only handed out once its newline has been written, so a half-written event is never read
+class JsonlFileSource(EventSource):
+    resumable = True
+
+    def __init__(self, path):
+        self.path = path
+        self.name = f"file:{os.path.abspath(path)}"
+        self.position = 0
+        self._file = None
+
+    # Continues reading from a saved offset
+    def seek(self, position):
+        self.position = position or 0
+        if self._file:
+            self._file.seek(self.position)
+
+    def _poll(self, limit, wait):
+        if self._file is None:
+            if not os.path.exists(self.path):
+                time.sleep(wait)
+                return []
+            self._file = open(self.path, "rb")
+            self._file.seek(self.position)
+        # A file shorter than the saved offset was truncated or replaced, start again from its beginning
+        if os.fstat(self._file.fileno()).st_size < self.position:
+            print(f"Event log {highlight('blue', self.path)} was truncated, reading it from the start.")
+            self.seek(0)
+
+        lines = []
+        while len(lines) < limit:
+            line = self._file.readline()
+            if not line.endswith(b"\n"):
+                self._file.seek(self.position)  # Incomplete last line, read it again once it is finished
+                break
+            self.position += len(line)
+            lines.append((line, self.position))
+        if not lines:
+            time.sleep(wait)
+        return lines
+
+    def offset(self, tokens):
+        return tokens[-1]
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+# Accepts producers on a TCP address (host, port) or a Unix socket path and reads newline-delimited events
+# Tokens are the sending connections - after each commit every producer is told how many of its events were persisted,
+# so a producer that never receives an ACK knows to send those events again
+class SocketSource(EventSource):
+    def __init__(self, address):
+        self.address = address
+        self.name = f"socket:{address}"
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)  # Stale socket file left by an earlier run
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(address)
+        self._server.listen()
+        self._server.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._buffers = {}  # Connection -> bytes received after its last complete line
+        self._pending = []  # Complete lines not yet handed out
+
+    def _poll(self, limit, wait):
+        if not self._pending:
+            for key, _ in self._selector.select(wait):
+                if key.fileobj is self._server:
+                    connection, _ = self._server.accept()
+                    connection.setblocking(False)
+                    self._selector.register(connection, selectors.EVENT_READ)
+                    self._buffers[connection] = b""
+                    continue
+                connection = key.fileobj
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    data = b""
+                if not data:  # Producer disconnected
+                    self._selector.unregister(connection)
+                    del self._buffers[connection]
+                    connection.close()
+                    continue
+                *complete, self._buffers[connection] = (self._buffers[connection] + data).split(b"\n")
+                self._pending.extend((line, connection) for line in complete if line.strip())
+        lines, self._pending = self._pending[:limit], self._pending[limit:]
+        return lines
+
+    def acknowledge(self, tokens):
+        counts = {}
+        for connection in tokens:
+            counts[connection] = counts.get(connection, 0) + 1
+        for connection, count in counts.items():
+            try:
+                connection.sendall(f"ACK {count}\n".encode())
+            except OSError:
+                pass  # Producer already gone, it will resend what it did not see acknowledged
+
+    def close(self):
+        for connection in list(self._buffers):
+            connection.close()
+        self._selector.close()
+        self._server.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+## OFFSETS
+# Creates the table holding each consumer's position in its source
+def create_offsets_table(cursor):
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            consumer VARCHAR NOT NULL,
+            source VARCHAR NOT NULL,
+            position BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (consumer, source)
+        )
+    """.format(table_name=INGESTION_OFFSETS_TABLE)
+    cursor.execute(create_sql)
+    cursor.connection.commit()
+
+# Returns a consumer's saved position in a source, None when it has not committed a batch yet
+def read_offset(cursor, consumer, source):
+    offset_sql = "SELECT position FROM {table_name} WHERE consumer = %s AND source = %s".format(table_name=INGESTION_OFFSETS_TABLE)
+    cursor.execute(offset_sql, (consumer, source))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# Saves a consumer's position without committing, so it commits together with the batch it follows
+def write_offset(cursor, consumer, source, position):
+    offset_sql = """
+        INSERT INTO {table_name} (consumer, source, position, updated_at)
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT (consumer, source) DO UPDATE SET position = EXCLUDED.position, updated_at = EXCLUDED.updated_at
+    """.format(table_name=INGESTION_OFFSETS_TABLE)
+    cursor.execute(offset_sql, (consumer, source, position))
+
+## PIPELINE
+# Database errors caused by the contents of an event rather than by the database, e.g. an amount too large for its
+# column or an unknown customer - the event is skipped instead of failing its batch on every replay
+REJECTED_EVENT_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+# Reads micro-batches from a source and persists, scores and commits each of them in one database transaction
+class Ingestor:
+    def __init__(self, source, consumer="ingestion", batch_size=INGESTION_BATCH_SIZE, max_latency=INGESTION_MAX_LATENCY):
+        self.source = source
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.use_copy = True
+        self.counts = {"batches": 0, "inserted": 0, "duplicates": 0, "invalid": 0, "rejected": 0, "scored": 0, "flagged": 0}
+
+    # Persists and scores one batch of (line, token) pairs, then commits it with the source offset
+    def process(self, cursor, lines):
+        transactions = {}
+        invalid = 0
+        for line, _ in lines:
+            try:
+                transaction = event_to_transaction(json.loads(line))
+            except (ValueError, TypeError) as e:  # Bad events are reported and skipped, they must not stall the stream
+                invalid += 1
+                print(f"Skipping invalid event {highlight('blue', line[:80].decode(errors='replace').strip())}: {e}")
+                continue
+            # A producer resending unacknowledged events can repeat one within a batch, the first copy is kept
+            transactions.setdefault(transaction.transaction_id, transaction)
+        transactions = list(transactions.values())
+
+        with metrics.timer("cardguard_ingestion_batch_seconds", "Time to persist, score and commit one micro-batch"):
+            # Insert, score and update the running statistics, all uncommitted until the offset is written
+            rejected = 0
+            try:
+                inserted, scores = self._persist(cursor, transactions)
+            except REJECTED_EVENT_ERRORS as e:
+                # Some event was refused by the database (overflowing amount, value too long, ...) - retry the events
+                # one at a time so the rest of the batch still goes through
+                print(f"Batch rejected by the database, retrying its events one at a time: {e}")
+                cursor.connection.rollback()
+                inserted, scores = [], {}
+                for transaction in transactions:
+                    cursor.execute("SAVEPOINT ingestion_event")
+                    try:
+                        event_inserted, event_scores = self._persist(cursor, [transaction], use_copy=False)
+                    except REJECTED_EVENT_ERRORS as e:
+                        cursor.execute("ROLLBACK TO SAVEPOINT ingestion_event")
+                        rejected += 1
+                        print(f"Skipping rejected event {highlight('blue', transaction.transaction_id)}: {e}")
+                        continue
+                    cursor.execute("RELEASE SAVEPOINT ingestion_event")
+                    inserted.extend(event_inserted)
+                    scores.update(event_scores)
+
+            tokens = [token for _, token in lines]
+            position = self.source.offset(tokens)
+            if position is not None:
+                write_offset(cursor, self.consumer, self.source.name, position)
+            cursor.connection.commit()
+        new_ids = [row[0] for row in inserted]
+        transaction_id_registry.add(new_ids)
+        self.source.acknowledge(tokens)
+
+        flagged = sum(1 for score in scores.values() if score > 0)
+        for key, value in (("batches", 1), ("inserted", len(inserted)), ("duplicates", len(lines) - invalid - rejected - len(inserted)),
+                           ("invalid", invalid), ("rejected", rejected), ("scored", len(scores)), ("flagged", flagged)):
+            self.counts[key] += value
+        metrics.inc("cardguard_ingested_events_total", "Events consumed by the ingestion pipeline", len(lines))
+        return scores
+
+    # Helper function that inserts transactions, updates the running statistics and scores the new ones, without
+    # committing - returns the inserted (transaction_id, customer_id, amount, location) rows and the scores
+    def _persist(self, cursor, transactions, use_copy=True):
+        if not transactions:
+            return [], {}
+        rows = [transaction_row(transaction) for transaction in transactions]
+        inserted = None
+        if use_copy and self.use_copy:
+            try:
+                inserted = copy_transaction_chunk(cursor, rows)
+            except REJECTED_EVENT_ERRORS:
+                raise  # The events are at fault, not COPY
+            except psycopg2.Error as e:
+                print(f"COPY unavailable, falling back to execute_values: {e}")
+                cursor.connection.rollback()
+                self.use_copy = False
+        if inserted is None:
+            inserted = insert_transaction_chunk(cursor, rows)
+        record_amounts(cursor, [(row[1], row[2]) for row in inserted])
+        record_locations(cursor, [(row[1], row[3]) for row in inserted])
+
+        # Score the new transactions only - an event replayed by a producer keeps the verdict it already has
+        new_ids = {row[0] for row in inserted}
+        batch = [transaction for transaction in transactions if transaction.transaction_id in new_ids and is_scoreable(transaction)]
+        return inserted, score_batch(cursor, batch, get_rule_config()) if batch else {}
+
+    # Consumes batches until stop is set, or until no event arrives for idle_timeout seconds when it is given
+    # Returns the running counts - batches, inserted, duplicates, invalid, rejected, scored and flagged
+    def run(self, stop=None, idle_timeout=None):
+        stop = stop or threading.Event()
+        with pooled_cursor() as cursor:
+            create_offsets_table(cursor)
+            create_transaction_scores_table(cursor)
+            if self.source.resumable:
+                self.source.seek(read_offset(cursor, self.consumer, self.source.name))
+            try:
+                while not stop.is_set():
+                    # Wake up at least once per poll interval to notice stop, unless idle_timeout asks for longer
+                    timeout = idle_timeout if idle_timeout is not None else max(INGESTION_POLL_INTERVAL, self.max_latency)
+                    lines = self.source.read(self.batch_size, self.max_latency, timeout)
+                    if lines:
+                        self.process(cursor, lines)
+                    elif idle_timeout is not None:
+                        break
+            finally:
+                self.source.close()
+        print(f"Ingestion stopped: {highlight('blue', self.counts['inserted'])} transaction(s) added in {highlight('blue', self.counts['batches'])} batch(es), "
+              f"{highlight('red', self.counts['flagged'])} flagged, {highlight('blue', self.counts['duplicates'])} duplicate(s), {highlight('blue', self.counts['invalid'])} invalid and {highlight('blue', self.counts['rejected'])} rejected event(s).")
+        return self.counts
+
+# Running this file directly starts a consumer on a JSONL file or socket
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Card Guard streaming ingestion")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--file", help="Append-only JSONL event log to tail")
+    source_group.add_argument("--tcp", help="host:port to accept producers on")
+    source_group.add_argument("--unix", help="Unix socket path to accept producers on")
+    parser.add_argument("--consumer", default="ingestion", help="Consumer name the file offset is saved under")
+    parser.add_argument("--batch-size", type=int, default=INGESTION_BATCH_SIZE, help="Events per micro-batch")
+    parser.add_argument("--max-latency", type=float, default=INGESTION_MAX_LATENCY, help="Seconds before a partial batch is flushed")
+    parser.add_argument("--idle-timeout", type=float, default=None, help="Stop after this many seconds without events")
+    args = parser.parse_args()
+
+    if args.file:
+        source = JsonlFileSource(args.file)
+    elif args.tcp:
+        host, port = args.tcp.rsplit(":", 1)
+        source = SocketSource((host, int(port)))
+    else:
+        source = SocketSource(args.unix)
+    try:
+        Ingestor(source, args.consumer, args.batch_size, args.max_latency).run(idle_timeout=args.idle_timeout)
+    except KeyboardInterrupt:
+        pass  # The batch in progress was rolled back, it is read again from the saved offset next time
@@ -0,0 +1,139 @@
+# CARD GUARD
+# Location Profile Functions
+# Keeps a running count of each customer's transactions per location, updated in the same database transaction
+# as every insert, update and delete, so the location rule can see where a customer actually shops - not just the
+# home location on their profile - without scanning their transaction history
+# The rule reads a LocationProfile holding the customer's top-K locations and answers each check with a dict lookup
+
+# Import libraries
+from config import *
+from utils import *
+from psycopg2.extras import execute_values
+
+# Creates the location counts table if it does not already exist
+# The functions below create it on first use, an existing transactions table still needs a rebuild to fill it
+def create_location_counts_table(cursor):
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            customer_id TEXT NOT NULL,
+            location TEXT NOT NULL,
+            txn_count BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (customer_id, location)
+        )
+    """.format(table_name=LOCATION_COUNTS_TABLE)
+    cursor.execute(create_sql)
+
+# Helper function that folds (customer_id, location) pairs into one (customer_id, location, count) row per pair
+def summarize_locations(locations):
+    counts = {}
+    for customer_id, location in locations:
+        if customer_id is None or location is None:  # NULLs are not counted, like the rebuild
+            continue
+        counts[(customer_id, location)] = counts.get((customer_id, location), 0) + 1
+    return [(customer_id, location, count) for (customer_id, location), count in counts.items()]
+
+# Adds transaction locations to the counts - takes an iterable of (customer_id, location) pairs
+# Does not commit, so the caller can keep the counts in the same database transaction as the insert
+def record_locations(cursor, locations):
+    rows = summarize_locations(locations)
+    if not rows:
+        return
+    ensure_table(cursor, LOCATION_COUNTS_TABLE, create_location_counts_table)
+    merge_sql = """
+        INSERT INTO {table_name} AS l (customer_id, location, txn_count)
+        VALUES %s
+        ON CONFLICT (customer_id, location) DO UPDATE SET txn_count = l.txn_count + EXCLUDED.txn_count
+    """.format(table_name=LOCATION_COUNTS_TABLE)
+    execute_values(cursor, merge_sql, rows)
+
+# Removes transaction locations from the counts - takes an iterable of (customer_id, location) pairs
+# Locations whose count drops to zero are deleted, does not commit
+def remove_locations(cursor, locations):
+    rows = summarize_locations(locations)
+    if not rows:
+        return
+    ensure_table(cursor, LOCATION_COUNTS_TABLE, create_location_counts_table)
+    unmerge_sql = """
+        UPDATE {table_name} AS l
+        SET txn_count = GREATEST(l.txn_count - r.txn_count, 0)
+        FROM (VALUES %s) AS r(customer_id, location, txn_count)
+        WHERE l.customer_id = r.customer_id AND l.location = r.location
+    """.format(table_name=LOCATION_COUNTS_TABLE)
+    execute_values(cursor, unmerge_sql, rows, template="(%s, %s, %s::bigint)")
+    cursor.execute("DELETE FROM {table_name} WHERE customer_id = ANY(%s) AND txn_count = 0".format(table_name=LOCATION_COUNTS_TABLE),
+                   (list({row[0] for row in rows}),))
+
+# Where a customer is expected to transact - the home location from their profile and the counts of their top_k
+# most used locations (ties included), out of total transactions with a location
+class LocationProfile:
+    __slots__ = ("home", "total", "top")
+
+    def __init__(self, home="Unknown", total=0, top=None):
+        self.home = home
+        self.total = total
+        self.top = top or {}
+
+    # Share of the customer's other transactions made at location - the counts include the transaction being scored,
+    # so it is taken out again; locations outside the top-K count as never seen, home and 'Unknown' are always expected
+    def share(self, location):
+        if location == self.home or location == "Unknown":
+            return 1.0
+        if self.total <= 1:
+            return 0.0
+        return max(self.top.get(location, 0) - 1, 0) / (self.total - 1)
+
+    # Frequency-weighted anomaly score between 0 (where the customer always shops) and 1 (never seen there)
+    def anomaly_score(self, location):
+        return 1.0 - self.share(location)
+
+    # Locations the customer is expected in, home first and then the most used
+    def expected_locations(self):
+        return [str(self.home)] + [location for location in sorted(self.top, key=self.top.get, reverse=True) if location != self.home]
+
+# Loads the top_k location counts of many customers at once - returns a dict of customer_id -> (total, {location: count})
+# Customers without counted transactions are left out
+def get_location_counts_bulk(cursor, customerIDs, top_k=LOCATION_TOP_K):
+    ensure_table(cursor, LOCATION_COUNTS_TABLE, create_location_counts_table)
+    counts_sql = """
+        SELECT customer_id, location, txn_count, total
+        FROM (
+            SELECT customer_id, location, txn_count,
+                   SUM(txn_count) OVER (PARTITION BY customer_id) AS total,
+                   RANK() OVER (PARTITION BY customer_id ORDER BY txn_count DESC) AS location_rank
+            FROM {table_name}
+            WHERE customer_id = ANY(%s)
+        ) AS ranked
+        WHERE location_rank <= %s
+    """.format(table_name=LOCATION_COUNTS_TABLE)
+    execute_prepared(cursor, counts_sql, (list(customerIDs), top_k))
+    counts = {}
+    for customer_id, location, txn_count, total in cursor.fetchall():
+        counts.setdefault(customer_id, (int(total), {}))[1][location] = txn_count
+    return counts
+
+# Rebuilds the whole table from the transactions table, used to seed the counts and to correct any drift
+def rebuild_location_counts(cursor):
+    try:
+        create_location_counts_table(cursor)
+        cursor.execute("TRUNCATE {table_name}".format(table_name=LOCATION_COUNTS_TABLE))
+        rebuild_sql = """
+            INSERT INTO {counts_table} (customer_id, location, txn_count)
+            SELECT customer_id, location, COUNT(*)
+            FROM {transactions_table}
+            WHERE customer_id IS NOT NULL AND location IS NOT NULL
+            GROUP BY customer_id, location
+        """.format(counts_table=LOCATION_COUNTS_TABLE, transactions_table=TRANSACTIONS_TABLE)
+        cursor.execute(rebuild_sql)
+        rebuilt = cursor.rowcount
+        cursor.connection.commit()
+        print(f"Location counts rebuilt: {highlight('blue', rebuilt)} customer location(s).")
+        return rebuilt
+    except Exception as e:
+        print(f"Error rebuilding location counts: {e}")
+        cursor.connection.rollback()
+        raise
+
+# Running this file directly performs a full rebuild of the counts
+if __name__ == "__main__":
+    with pooled_cursor() as cursor:
+        rebuild_location_counts(cursor)
@@ -0,0 +1,245 @@
+# CARD GUARD
+# Metrics
+# Counters, histograms and gauges for the scoring hot path, exported in the Prometheus text format
+# Records per-rule wall time, database queries and rows fetched per scored transaction, and cache hit rates
+# Everything is off unless METRICS_ENABLED is set, and the disabled path is a single attribute check
+# Usage:
+#   metrics.write()                  (writes the current values to METRICS_FILE)
+#   metrics.serve()                  (serves them at http://localhost:METRICS_PORT/metrics)
+
+# Import libraries
+from config import *
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import os
+import threading
+import time
+import psycopg2.extensions
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000, 10000)
+
+# Cumulative histogram in the Prometheus style - bucket counts, sum and count of every observation
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last slot is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Times a with-block and records the elapsed seconds in a histogram
+class Timer:
+    def __init__(self, registry, name, help_text, labels):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, self.help_text, time.perf_counter() - self.start, **self.labels)
+        return False
+
+# Records how many queries and rows a block of work cost on the current thread, e.g. one scored transaction
+class QueryTracker:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.queries, self.rows = self.registry.thread_counts()
+        return self
+
+    def __exit__(self, *exc_info):
+        queries, rows = self.registry.thread_counts()
+        self.registry.observe(f"cardguard_{self.name}_seconds", f"Wall time of {self.name}", time.perf_counter() - self.start)
+        self.registry.observe(f"cardguard_{self.name}_queries", f"Database queries per {self.name}", queries - self.queries, buckets=COUNT_BUCKETS)
+        self.registry.observe(f"cardguard_{self.name}_rows", f"Rows fetched per {self.name}", rows - self.rows, buckets=COUNT_BUCKETS)
+        return False
+
+# Holds every metric - families are keyed by name, and each family holds one value per label set
+class MetricsRegistry:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._families = {}  # name -> [type, help, {labels: value or Histogram}]
+        self._gauges = {}  # name -> (help, function returning the current value)
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Per-thread query and row counts
+
+    # Helper function that returns the value dict of a family, creating the family on first use
+    def _family(self, name, metric_type, help_text):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [metric_type, help_text, {}]
+        return family[2]
+
+    # Adds amount to a counter
+    def inc(self, name, help_text, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._family(name, "counter", help_text)
+            values[key] = values.get(key, 0) + amount
+
+    # Records one observation in a histogram
+    def observe(self, name, help_text, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._family(name, "histogram", help_text)
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    # Registers a gauge whose value is read from function when the metrics are exported
+    def gauge(self, name, help_text, function):
+        self._gauges[name] = (help_text, function)
+
+    # Returns a context manager that times its block, or a shared no-op one when metrics are off
+    def timer(self, name, help_text, **labels):
+        if not self.enabled:
+            return NULL_CONTEXT
+        return Timer(self, name, help_text, labels)
+
+    # Returns a context manager that records wall time, queries and rows of its block, or a no-op when metrics are off
+    def track(self, name):
+        if not self.enabled:
+            return NULL_CONTEXT
+        return QueryTracker(self, name)
+
+    # Counts one executed query and the rows it fetched, called by InstrumentedCursor
+    def record_query(self, seconds):
+        if not self.enabled:
+            return
+        self._local.queries = getattr(self._local, "queries", 0) + 1
+        self.inc("cardguard_db_queries_total", "Database queries executed")
+        self.observe("cardguard_db_query_seconds", "Wall time of each database query", seconds)
+
+    def record_rows(self, count):
+        if not self.enabled:
+            return
+        self._local.rows = getattr(self._local, "rows", 0) + count
+        self.inc("cardguard_db_rows_fetched_total", "Rows fetched from the database", count)
+
+    # Returns (queries, rows) counted on the current thread so far
+    def thread_counts(self):
+        return getattr(self._local, "queries", 0), getattr(self._local, "rows", 0)
+
+    # Clears every counter and histogram, registered gauges are kept
+    def reset(self):
+        with self._lock:
+            self._families.clear()
+
+    # Renders every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text, values) in sorted(self._families.items()):
+                lines.append(f"# HELP {name} {escape_help(help_text)}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in sorted(values.items()):
+                    if metric_type == "histogram":
+                        cumulative = 0
+                        for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(key)} {value.sum}")
+                        lines.append(f"{name}_count{format_labels(key)} {value.count}")
+                    else:
+                        lines.append(f"{name}{format_labels(key)} {value}")
+        for name, (help_text, function) in sorted(self._gauges.items()):
+            lines.append(f"# HELP {name} {escape_help(help_text)}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {function()}")
+        return "\n".join(lines) + "\n"
+
+    # Writes the metrics to a file, through a temporary file so a scraper never reads a partial one
+    def write(self, path=METRICS_FILE):
+        with open(path + ".tmp", "w") as file:
+            file.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    # Serves the metrics over HTTP from a background thread - returns the server so it can be shut down
+    def serve(self, port=METRICS_PORT, host="127.0.0.1"):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Keep scrapes out of the console
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+NULL_CONTEXT = nullcontext()
+
+# Helper function that formats a label set as {name="value",...}
+def format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in key) + "}"
+
+# Helper functions that escape backslashes and newlines in HELP text, and double quotes too in label values,
+# as the exposition format requires
+def escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+def escape_label_value(value):
+    return escape_help(str(value)).replace('"', '\\"')
+
+# Cursor that reports every query and fetched row to the metrics, installed on pooled connections when METRICS_ENABLED
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.record_query(time.perf_counter() - start)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            metrics.record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        metrics.record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.record_rows(len(rows))
+        return rows
+
+# Registry shared by every module
+metrics = MetricsRegistry()
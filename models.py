@@ -2,11 +2,16 @@
 # models.py houses Class definitions
 
 # Import libraries
-from datetime import datetime
+from datetime import datetime, timezone
 from utils import highlight
+import numpy as np
 
 # Define 'Transaction' class with all attributes of a transaction from the database
+# Slotted so each instance holds its 12 attributes without a per-instance __dict__
 class Transaction:
+    __slots__ = ("transaction_id", "customer_id", "timestamp", "merchant_name", "category", "amount",
+                 "location", "card_type", "approval_status", "payment_method", "is_fraud", "note")
+
     # Initialize all attributes with empty values to detect and handle improper import from database
     def __init__(self, transaction_id="", customer_id="", timestamp=None, merchant_name="", 
                 category="", amount=0.00, location="", card_type="", approval_status="", payment_method="", 
@@ -54,6 +59,8 @@ class Transaction:
 
 # Define 'Customer' class with all attributes of a customer from the database
 class Customer:
+    __slots__ = ("customer_id", "first_name", "last_name", "age", "location", "phone_number")
+
     # Initialize all attributes with empty values to detect and handle improper import from database
     def __init__(self, customer_id="", first_name="", last_name="", age=0, location="Unknown", phone_number="000-000-0000"):
 
@@ -71,4 +78,172 @@ class Customer:
         print(f"Age: {highlight("blue",self.age)}")
         print(f"Location: {highlight("blue",self.location)}")
         print(f"Phone Number: {highlight("blue",self.phone_number)}")
-        print("--------------------------------------------------")
\ No newline at end of file
+        print("--------------------------------------------------")
+
+# Helper function that returns the SQL column list for a projection of a model's fields, e.g. ("customer_id", "age")
+# Names are checked against the model's slots, since they are formatted into the query rather than passed as parameters
+def select_columns(model, columns):
+    unknown = [column for column in columns if column not in model.__slots__]
+    if unknown or not columns:
+        raise ValueError(f"Unknown {model.__name__} column(s): {', '.join(unknown) or '(none selected)'}")
+    return ", ".join(columns)
+
+## COLUMNAR TRANSACTIONS
+# Fields stored as fixed-width bytes, dictionary codes, or in their own typed arrays in a TransactionBatch
+ID_FIELDS = ("transaction_id", "customer_id")
+ENCODED_FIELDS = ("merchant_name", "category", "location", "card_type", "approval_status", "payment_method", "is_fraud", "note")
+
+# Helper function that dictionary-encodes a column - returns (int32 codes, list of distinct values)
+def encode_column(values):
+    lookup = {}
+    codes = np.fromiter((lookup.setdefault(value, len(lookup)) for value in values), dtype=np.int32, count=len(values))
+    return codes, list(lookup)
+
+# Helper function that builds the property giving a TransactionView read and write access to one column
+def column_property(name):
+    if name in ID_FIELDS:
+        def get(view):
+            return view._batch.columns[name][view._index].decode()
+        def set(view, value):
+            column = view._batch.columns[name]
+            encoded = str(value).encode()
+            if len(encoded) > column.dtype.itemsize:  # Widen the column instead of truncating a longer ID
+                column = view._batch.columns[name] = column.astype(f"S{len(encoded)}")
+            column[view._index] = encoded
+    elif name in ENCODED_FIELDS:
+        def get(view):
+            return view._batch.dictionaries[name][view._batch.columns[name][view._index]]
+        def set(view, value):
+            view._batch.columns[name][view._index] = view._batch.code(name, value)
+    elif name == "timestamp":
+        def get(view):
+            value = view._batch.columns[name][view._index].item()
+            if value is None:
+                return datetime(1970, 1, 1)  # Same placeholder Transaction uses for NULL
+            tzinfo = view._batch.tzinfo
+            return value.replace(tzinfo=timezone.utc).astimezone(tzinfo) if tzinfo is not None else value
+        def set(view, value):
+            view._batch.columns[name][view._index] = to_datetime64(value, view._batch.tzinfo)
+    else:
+        def get(view):
+            return float(view._batch.columns[name][view._index])
+        def set(view, value):
+            view._batch.columns[name][view._index] = value
+    return property(get, set)
+
+# Helper function that converts a timestamp for a batch's timestamp column - aware timestamps are stored as UTC and
+# only fit a batch with a tzinfo, naive ones only a batch without
+def to_datetime64(value, tzinfo):
+    if value is None:
+        return np.datetime64("NaT")
+    if isinstance(value, datetime) and (value.tzinfo is not None) != (tzinfo is not None):
+        raise ValueError(f"Cannot store {'an aware' if value.tzinfo is not None else 'a naive'} timestamp in a TransactionBatch "
+                         f"of {'aware' if tzinfo is not None else 'naive'} timestamps: {value!r}")
+    if tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+# Row of a TransactionBatch that behaves like a Transaction - reads and writes go straight to the batch's arrays
+class TransactionView:
+    __slots__ = ("_batch", "_index")
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    # Returns a standalone Transaction copy of the row
+    def to_transaction(self):
+        return Transaction(*(getattr(self, name) for name in Transaction.__slots__))
+
+    print_info = Transaction.print_info
+    set_fraud = Transaction.set_fraud
+    update_note = Transaction.update_note
+
+for _name in Transaction.__slots__:
+    setattr(TransactionView, _name, column_property(_name))
+
+# Columnar container for large numbers of transactions, for batch scoring a day of transactions in memory
+# IDs are fixed-width bytes, amounts float64, timestamps datetime64, and the text columns int32 codes into a list of
+# distinct values - indexing or iterating yields TransactionView rows, so functions written for Transaction keep working
+# Timezone-aware timestamps are stored as UTC and read back in the batch's tzinfo - the shared timezone of the rows, or
+# UTC when they use several - and a batch can not mix aware and naive timestamps
+class TransactionBatch:
+    def __init__(self, columns, dictionaries, tzinfo=None):
+        self.columns = columns  # name -> NumPy array, one entry per transaction
+        self.dictionaries = dictionaries  # name -> list of distinct values for the encoded columns
+        self.tzinfo = tzinfo  # Timezone of the timestamps, None for naive timestamps
+        self._lookups = {name: {value: code for code, value in enumerate(values)} for name, values in dictionaries.items()}
+
+    # Builds a batch from rows in the transactions table's column order, e.g. cursor.fetchall() of SELECT *
+    @classmethod
+    def from_rows(cls, rows):
+        rows = list(rows)
+        values = dict(zip(Transaction.__slots__, zip(*rows))) if rows else {name: () for name in Transaction.__slots__}
+        columns = {}
+        dictionaries = {}
+        for name in ID_FIELDS:
+            columns[name] = np.array([str(value).encode() for value in values[name]], dtype="S") if rows else np.array([], dtype="S1")
+        zones = {value.tzinfo for value in values["timestamp"] if isinstance(value, datetime)}
+        tzinfo = None
+        if zones - {None}:
+            if None in zones:
+                raise ValueError("TransactionBatch can not mix timezone-aware and naive timestamps")
+            tzinfo = zones.pop() if len(zones) == 1 else timezone.utc
+        timestamps = values["timestamp"] if tzinfo is None else [to_datetime64(value, tzinfo) for value in values["timestamp"]]
+        columns["timestamp"] = np.array(timestamps, dtype="datetime64[us]")
+        columns["amount"] = np.array([float(value) if value is not None else np.nan for value in values["amount"]], dtype=np.float64)
+        for name in ENCODED_FIELDS:
+            column = values[name] if name != "is_fraud" else [value if value is not None else "Undetermined" for value in values[name]]
+            columns[name], dictionaries[name] = encode_column(column)
+        return cls(columns, dictionaries, tzinfo)
+
+    # Builds a batch from Transaction objects
+    @classmethod
+    def from_transactions(cls, transactions):
+        return cls.from_rows([tuple(getattr(transaction, name) for name in Transaction.__slots__) for transaction in transactions])
+
+    # Returns the dictionary code for value in an encoded column, adding the value if it is new
+    def code(self, name, value):
+        lookup = self._lookups[name]
+        if value not in lookup:
+            lookup[value] = len(self.dictionaries[name])
+            self.dictionaries[name].append(value)
+        return lookup[value]
+
+    # Returns a column as a NumPy array of Python values, decoding IDs and dictionary codes
+    def column(self, name):
+        if name in ID_FIELDS:
+            return np.char.decode(self.columns[name]).astype(object)
+        if name in ENCODED_FIELDS:
+            return np.array(self.dictionaries[name], dtype=object)[self.columns[name]]
+        return self.columns[name]
+
+    # Converts the batch back to rows in the transactions table's column order, ready for executemany or COPY
+    def to_rows(self):
+        return [tuple(getattr(view, name) for name in Transaction.__slots__) for view in self]
+
+    # Converts the batch back to standalone Transaction objects
+    def to_transactions(self):
+        return [view.to_transaction() for view in self]
+
+    # Bytes held by the arrays, not counting the shared dictionary values
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def __len__(self):
+        return len(self.columns["amount"])
+
+    # An integer index returns a TransactionView, a slice returns a new batch holding copies of those rows
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TransactionBatch({name: column[index].copy() for name, column in self.columns.items()},
+                                    {name: list(values) for name, values in self.dictionaries.items()}, self.tzinfo)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("TransactionBatch index out of range")
+        return TransactionView(self, index)
+
+    def __iter__(self):
+        return (TransactionView(self, index) for index in range(len(self)))
@@ -0,0 +1,149 @@
+# CARD GUARD
+# Parallel Rescoring
+# Re-runs the fraud rules over historical transactions with a pool of worker processes
+# Transactions are split into partitions by a hash of customer_id, so each customer is scored by one worker and
+# its profile stays in that worker's cache; every worker opens its own pooled connection
+# Each partition is walked in transaction_id order a batch at a time, and its position is checkpointed after every
+# batch, so a crashed or interrupted run picks up where it stopped when started again with the same run name
+# Usage:
+#   python rescore.py                     (score undetermined transactions, resuming the last 'rescore' run)
+#   python rescore.py --force --restart   (rescore every transaction from the beginning)
+#   python rescore.py --create-index      (index the partition hash first, so workers do not each scan the table)
+
+# Import libraries
+from config import *
+from models import *
+from utils import *
+from transaction_functions import flag_fraud_batch
+from verdicts import create_transaction_scores_table
+from contextlib import redirect_stdout
+import argparse
+import io
+import multiprocessing
+import time
+
+# Partition hash of a transaction's customer - the sign bit is masked off rather than using abs(), which overflows
+# when hashtext returns the smallest integer; the partition index is built on the same expression
+PARTITION_HASH = "(hashtext(customer_id) & 2147483647)"
+
+# Creates the table holding each partition's progress
+def create_checkpoint_table(cursor):
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            run_name VARCHAR NOT NULL,
+            partitions INTEGER NOT NULL,
+            partition INTEGER NOT NULL,
+            last_transaction_id VARCHAR,
+            scored BIGINT NOT NULL DEFAULT 0,
+            finished BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (run_name, partitions, partition)
+        )
+    """.format(table_name=RESCORE_CHECKPOINT_TABLE)
+    cursor.execute(create_sql)
+    cursor.connection.commit()
+
+# Indexes the partition hash for a given number of partitions, so each worker reads only its own rows
+# Drops the index earlier versions built on abs(hashtext(customer_id)), which the batch query no longer uses
+def create_partition_index(cursor, partitions):
+    index_sql = """
+        DROP INDEX IF EXISTS {table_name}_rescore_{partitions};
+        CREATE INDEX IF NOT EXISTS {table_name}_rescore_hash_{partitions}
+        ON {table_name} ((mod({partition_hash}, {partitions})), transaction_id)
+    """.format(table_name=TRANSACTIONS_TABLE, partition_hash=PARTITION_HASH, partitions=int(partitions))
+    cursor.execute(index_sql)
+    cursor.connection.commit()
+
+# Returns a partition's checkpoint as (last_transaction_id, scored, finished) - (None, 0, False) for a new partition
+def read_checkpoint(cursor, run_name, partitions, partition):
+    checkpoint_sql = """
+        SELECT last_transaction_id, scored, finished FROM {table_name}
+        WHERE run_name = %s AND partitions = %s AND partition = %s
+    """.format(table_name=RESCORE_CHECKPOINT_TABLE)
+    cursor.execute(checkpoint_sql, (run_name, partitions, partition))
+    return cursor.fetchone() or (None, 0, False)
+
+# Saves a partition's progress
+def write_checkpoint(cursor, run_name, partitions, partition, last_transaction_id, scored, finished=False):
+    checkpoint_sql = """
+        INSERT INTO {table_name} (run_name, partitions, partition, last_transaction_id, scored, finished, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, now())
+        ON CONFLICT (run_name, partitions, partition) DO UPDATE
+        SET last_transaction_id = EXCLUDED.last_transaction_id, scored = EXCLUDED.scored,
+            finished = EXCLUDED.finished, updated_at = EXCLUDED.updated_at
+    """.format(table_name=RESCORE_CHECKPOINT_TABLE)
+    cursor.execute(checkpoint_sql, (run_name, partitions, partition, last_transaction_id, scored, finished))
+    cursor.connection.commit()
+
+# Removes every checkpoint of a run so it starts from the beginning
+def clear_checkpoints(cursor, run_name):
+    cursor.execute("DELETE FROM {table_name} WHERE run_name = %s".format(table_name=RESCORE_CHECKPOINT_TABLE), (run_name,))
+    cursor.connection.commit()
+
+# Scores one partition in batches, checkpointing after each - runs inside a worker process
+# Returns (partition, transactions scored, seconds spent)
+def rescore_partition(run_name, partitions, partition, batch_size=RESCORE_BATCH_SIZE, force=False):
+    start = time.perf_counter()
+    # Keyset pagination on transaction_id, the undetermined filter is skipped when every verdict is being replaced
+    batch_sql = """
+        SELECT * FROM {table_name}
+        WHERE mod({partition_hash}, %s) = %s
+            AND transaction_id > %s
+            AND (%s OR is_fraud IS NULL OR is_fraud = 'Undetermined')
+        ORDER BY transaction_id
+        LIMIT %s
+    """.format(table_name=TRANSACTIONS_TABLE, partition_hash=PARTITION_HASH)
+    with pooled_cursor() as cursor:
+        last_transaction_id, scored, finished = read_checkpoint(cursor, run_name, partitions, partition)
+        while not finished:
+            cursor.execute(batch_sql, (partitions, partition, last_transaction_id or "", force, batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                with redirect_stdout(io.StringIO()):  # One summary per partition instead of one per batch
+                    scores = flag_fraud_batch(cursor, TransactionBatch.from_rows(rows), chunk_size=batch_size, force=force)
+                if scores is False:
+                    raise RuntimeError(f"Scoring failed in partition {partition} after transaction {last_transaction_id}")
+                scored += len(scores)
+                last_transaction_id = rows[-1][0]
+            finished = len(rows) < batch_size
+            write_checkpoint(cursor, run_name, partitions, partition, last_transaction_id, scored, finished)
+    return partition, scored, time.perf_counter() - start
+
+# Helper function that unpacks a task tuple for Pool.imap_unordered
+def _rescore_task(task):
+    return rescore_partition(*task)
+
+# Rescores the transactions table with one partition per worker process - returns the number of transactions scored
+def rescore(processes=RESCORE_PROCESSES, batch_size=RESCORE_BATCH_SIZE, force=False, run_name="rescore", restart=False, create_index=False):
+    processes = processes or multiprocessing.cpu_count()
+    with pooled_cursor() as cursor:
+        create_checkpoint_table(cursor)
+        create_transaction_scores_table(cursor)
+        if restart:
+            clear_checkpoints(cursor, run_name)
+        if create_index:
+            create_partition_index(cursor, processes)
+    close_pool()  # Workers open their own connections
+
+    start = time.perf_counter()
+    total = 0
+    tasks = [(run_name, processes, partition, batch_size, force) for partition in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        for partition, scored, seconds in pool.imap_unordered(_rescore_task, tasks):
+            total += scored
+            print(f"Partition {highlight('blue', partition)} finished: {highlight('blue', scored)} transaction(s) scored in {highlight('blue', f'{seconds:.1f}')}s.")
+    elapsed = time.perf_counter() - start
+    print(f"Rescoring finished: {highlight('blue', total)} transaction(s) scored by {highlight('blue', processes)} process(es) in {highlight('blue', f'{elapsed:.1f}')}s.")
+    return total
+
+# Running this file directly rescores the transactions table
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Card Guard parallel rescoring")
+    parser.add_argument("--processes", type=int, default=RESCORE_PROCESSES, help="Worker processes (default: one per core)")
+    parser.add_argument("--batch-size", type=int, default=RESCORE_BATCH_SIZE, help="Transactions scored per checkpoint")
+    parser.add_argument("--force", action="store_true", help="Rescore transactions that already have a verdict")
+    parser.add_argument("--run", default="rescore", help="Run name the checkpoints are saved under")
+    parser.add_argument("--restart", action="store_true", help="Ignore saved checkpoints and start from the beginning")
+    parser.add_argument("--create-index", action="store_true", help="Index the partition hash before scoring")
+    args = parser.parse_args()
+    rescore(args.processes, args.batch_size, args.force, args.run, args.restart, args.create_index)
@@ -0,0 +1,166 @@
+# CARD GUARD
+# Rule Configuration
+# Loads the fraud rule settings once into an immutable RuleConfig - category bounds as a read-only mapping and an array
+# indexed by category id, restricted categories as a frozenset - so scoring never rebuilds them per call
+# Defaults come from config.py, RULE_CONFIG_FILE (JSON or TOML) can override any of them and is reloaded when it
+# changes, so thresholds can be tuned without a redeploy; every config has a version stamp recorded with each verdict
+# Usage:
+#   rules = get_rule_config()          (current config, picks up changes to RULE_CONFIG_FILE)
+#   reload_rule_config("rules.json")   (load a file now)
+
+# Import libraries
+from config import *
+from utils import highlight
+from datetime import datetime
+from types import MappingProxyType
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Settings a rule config file may contain, with their defaults from config.py
+DEFAULT_SETTINGS = {
+    "category_bounds": CATEGORY_BOUNDS,
+    "age_restricted_categories": AGE_RESTRICTED_CATEGORIES,
+    "minimum_age": MINIMUM_AGE,
+    "z_score_threshold": Z_SCORE_THRESHOLD,
+    "location_top_k": LOCATION_TOP_K,
+    "location_min_share": LOCATION_MIN_SHARE,
+    "duplicate_window_minutes": DUPLICATE_WINDOW_MINUTES,
+    "duplicate_amount_tolerance": DUPLICATE_AMOUNT_TOLERANCE,
+}
+
+# Immutable, precomputed fraud rule settings - load a new RuleConfig instead of changing one
+class RuleConfig:
+    __slots__ = ("category_bounds", "other_bound", "categories", "category_ids", "bounds_by_id", "age_restricted",
+                 "minimum_age", "z_score_threshold", "location_top_k", "location_min_share",
+                 "duplicate_window_minutes", "duplicate_amount_tolerance",
+                 "version", "source", "loaded_at")
+
+    def __init__(self, settings, source="config.py"):
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown rule settings: {', '.join(sorted(unknown))}")
+        if not isinstance(settings.get("category_bounds", {}), dict):
+            raise ValueError("category_bounds must be a mapping of category to maximum amount")
+        if isinstance(settings.get("age_restricted_categories", ()), (str, bytes, dict)):
+            raise ValueError("age_restricted_categories must be a list of categories")
+        # Bounds are merged over the ones in config.py, a file only has to list the categories it changes
+        bounds_settings = {**CATEGORY_BOUNDS, **settings.get("category_bounds", {})}
+        settings = {**DEFAULT_SETTINGS, **settings}
+
+        bounds = {str(category): float(bound) for category, bound in bounds_settings.items()}
+        if any(bound <= 0 for bound in bounds.values()):
+            raise ValueError("Category bounds must be positive")
+        categories = tuple(category for category in bounds if category != "Other")
+
+        assign = super().__setattr__
+        assign("category_bounds", MappingProxyType(bounds))
+        assign("other_bound", bounds["Other"])
+        assign("categories", categories)
+        assign("category_ids", MappingProxyType({category: index for index, category in enumerate(categories)}))
+        bounds_by_id = np.array([bounds[category] for category in categories] + [bounds["Other"]], dtype=np.float64)
+        bounds_by_id.flags.writeable = False
+        assign("bounds_by_id", bounds_by_id)  # Index len(categories) holds the "Other" bound
+        assign("age_restricted", frozenset(settings["age_restricted_categories"]))
+        assign("minimum_age", int(settings["minimum_age"]))
+        assign("z_score_threshold", float(settings["z_score_threshold"]))
+        assign("location_top_k", int(settings["location_top_k"]))
+        assign("location_min_share", float(settings["location_min_share"]))
+        assign("duplicate_window_minutes", int(settings["duplicate_window_minutes"]))
+        assign("duplicate_amount_tolerance", float(settings["duplicate_amount_tolerance"]))
+        assign("source", source)
+        assign("loaded_at", datetime.now())
+        # The version is a hash of the settings, so the same settings always get the same stamp
+        assign("version", hashlib.sha256(json.dumps(self.settings(), sort_keys=True).encode()).hexdigest()[:12])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RuleConfig is immutable, load a new one with reload_rule_config")
+
+    # Maximum expected amount for a category, "Other" for unexpected categories
+    def max_amount(self, category):
+        return self.category_bounds.get(category, self.other_bound)
+
+    # Id of a category in bounds_by_id, unexpected categories map to the "Other" slot
+    def category_id(self, category):
+        return self.category_ids.get(category, len(self.categories))
+
+    # Returns the settings as plain JSON-serializable values
+    def settings(self):
+        return {
+            "category_bounds": dict(self.category_bounds),
+            "age_restricted_categories": sorted(self.age_restricted),
+            "minimum_age": self.minimum_age,
+            "z_score_threshold": self.z_score_threshold,
+            "location_top_k": self.location_top_k,
+            "location_min_share": self.location_min_share,
+            "duplicate_window_minutes": self.duplicate_window_minutes,
+            "duplicate_amount_tolerance": self.duplicate_amount_tolerance,
+        }
+
+    def __repr__(self):
+        return f"RuleConfig(version={self.version!r}, source={self.source!r})"
+
+# Builds a RuleConfig from config.py, with the settings in path (JSON, or TOML by extension) layered on top
+def load_rule_config(path=None):
+    if not path:
+        return RuleConfig({})
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as file:
+            settings = tomllib.load(file)
+    else:
+        with open(path) as file:
+            settings = json.load(file)
+    return RuleConfig(settings, source=path)
+
+# Errors that mean a rule config file is missing or invalid
+LOAD_ERRORS = (OSError, ValueError, TypeError, KeyError)
+
+# A missing or invalid RULE_CONFIG_FILE at import falls back to the defaults, a fixed file is picked up once it changes
+_lock = threading.Lock()
+_checked_at = time.monotonic()
+_file_mtime = None
+try:
+    _file_mtime = os.path.getmtime(RULE_CONFIG_FILE) if RULE_CONFIG_FILE else None
+    _current = load_rule_config(RULE_CONFIG_FILE)
+except LOAD_ERRORS as e:
+    _current = RuleConfig({})
+    print(f"Error loading rule config {highlight('blue', RULE_CONFIG_FILE)}, using the defaults from config.py: {e}")
+
+# Returns the current rule config - checks RULE_CONFIG_FILE for changes at most every RULE_CONFIG_CHECK_INTERVAL seconds
+def get_rule_config():
+    global _checked_at, _file_mtime
+    if RULE_CONFIG_FILE and time.monotonic() - _checked_at >= RULE_CONFIG_CHECK_INTERVAL:
+        with _lock:
+            if time.monotonic() - _checked_at >= RULE_CONFIG_CHECK_INTERVAL:
+                _checked_at = time.monotonic()
+                try:
+                    mtime = os.path.getmtime(RULE_CONFIG_FILE)
+                except OSError:
+                    mtime = _file_mtime  # Keep the current config while the file is missing or being replaced
+                if mtime != _file_mtime:
+                    _file_mtime = mtime
+                    reload_rule_config(RULE_CONFIG_FILE)
+    return _current
+
+# Loads path and makes it the current rule config - an invalid file is reported and the current config kept
+def reload_rule_config(path=RULE_CONFIG_FILE):
+    global _current
+    try:
+        new_config = load_rule_config(path)
+    except LOAD_ERRORS as e:
+        print(f"Error loading rule config {highlight('blue', path)}, keeping version {highlight('blue', _current.version)}: {e}")
+        return _current
+    if new_config.version != _current.version:
+        print(f"Rule config version {highlight('blue', new_config.version)} loaded from {highlight('blue', new_config.source)}")
+    _current = new_config
+    return _current
+
+# Makes a RuleConfig the current one, e.g. to try out thresholds in a backtest
+def set_rule_config(rule_config):
+    global _current
+    _current = rule_config
+    return _current
@@ -0,0 +1,115 @@
+# CARD GUARD
+# Scoring Service
+# Asyncio front end for real-time authorization decisions - transactions are queued in process and scored
+# concurrently by flag_fraud on worker threads, each with its own pooled connection, so one slow database
+# round-trip never blocks the other decisions in flight
+
+# Import libraries
+from config import *
+from utils import *
+from transaction_functions import flag_fraud
+from verdict_writer import verdict_writer
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import asyncio
+import time
+
+# Helper function run on a worker thread - scores one transaction on a pooled connection
+def score_transaction(transaction):
+    with pooled_cursor() as cursor:
+        return flag_fraud(cursor, transaction)
+
+# Accepts transactions from an in-process queue and scores up to 'workers' of them at a time
+# The bounded queue applies backpressure: score() waits for a free slot once queue_size transactions are pending
+class ScoringService:
+    def __init__(self, workers=SCORING_WORKERS, queue_size=SCORING_QUEUE_SIZE, timeout=SCORING_TIMEOUT,
+                 latency_window=SCORING_LATENCY_WINDOW):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue = None
+        self.queue_size = queue_size
+        self.latencies = deque(maxlen=latency_window)  # Seconds from submission to decision
+        self.timeouts = 0
+        self._executor = None
+        self._tasks = []
+
+    # Starts the worker tasks, must be awaited inside the running event loop
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scoring")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Waits for queued transactions to finish, then stops the workers once their verdicts are committed
+    async def stop(self):
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self._executor, verdict_writer.flush)
+        self._executor.shutdown(wait=True)
+
+    # Scores a transaction - returns flag_fraud's result (fraud score, None if not processed, False on error)
+    # Raises asyncio.TimeoutError when no decision is reached within timeout seconds, the service timeout when None
+    async def score(self, transaction, timeout=None):
+        future = asyncio.get_running_loop().create_future()
+        submitted = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self._submit(transaction, future, submitted), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    # Helper function that queues a transaction and waits for its decision
+    async def _submit(self, transaction, future, submitted):
+        await self.queue.put((transaction, future, submitted))  # Waits here while the queue is full
+        return await future
+
+    # Worker loop - takes transactions off the queue and scores them on the thread pool
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            transaction, future, submitted = await self.queue.get()
+            try:
+                # Skip transactions whose caller already gave up waiting
+                if future.cancelled():
+                    continue
+                result = await loop.run_in_executor(self._executor, score_transaction, transaction)
+                self.latencies.append(time.perf_counter() - submitted)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    # Reports p50/p99 latency in milliseconds over the most recent decisions
+    def latency_stats(self):
+        if not self.latencies:
+            return {"count": 0, "p50_ms": 0.0, "p99_ms": 0.0, "timeouts": self.timeouts}
+        ordered = sorted(self.latencies)
+        percentile = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+        return {"count": len(ordered), "p50_ms": percentile(0.50), "p99_ms": percentile(0.99), "timeouts": self.timeouts}
+
+# Scores a list of transactions through the service, all of them in flight at once - returns (results, latency stats)
+async def score_concurrently(transactions, **service_options):
+    service = ScoringService(**service_options)
+    await service.start()
+    try:
+        results = await asyncio.gather(*(service.score(transaction) for transaction in transactions), return_exceptions=True)
+    finally:
+        await service.stop()
+    return results, service.latency_stats()
+
+# Running this file directly generates, inserts and scores a batch of transactions and reports latency
+if __name__ == "__main__":
+    from transaction_generator import TransactionGenerator
+    from transaction_functions import add_transactions_bulk
+
+    with pooled_cursor() as cursor:
+        transactions = TransactionGenerator(cursor).generate(500)
+        add_transactions_bulk(cursor, transactions)
+    results, stats = asyncio.run(score_concurrently(transactions, timeout=60))  # Generous timeout, this run measures latency under load
+    p50 = f"{stats['p50_ms']:.1f} ms"
+    p99 = f"{stats['p99_ms']:.1f} ms"
+    print(f"Scored {highlight('blue', stats['count'])} transaction(s): p50 {highlight('yellow', p50)}, p99 {highlight('yellow', p99)}, {highlight('red', stats['timeouts'])} timeout(s)")
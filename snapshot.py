@@ -0,0 +1,227 @@
+# CARD GUARD
+# Snapshot Functions
+# Exports the transactions and customers tables to local Parquet files so backtests, rescoring runs and
+# pandas analysis read columnar files instead of the production database
+# Layout:
+#   <snapshot_dir>/transactions/date=YYYY-MM-DD/category=<category>/*.parquet
+#   <snapshot_dir>/customers/customers.parquet
+#   <snapshot_dir>/_snapshot_state.json   (database snapshot the last refresh read, and its refresh number)
+# New transactions are found through SNAPSHOT_LOG_TABLE, where a trigger records the ID and database transaction of
+# every inserted row - a refresh exports the rows whose transaction committed after the last refresh's database
+# snapshot, so the timestamps the rows carry do not matter and no commit is missed or exported twice
+# Each refresh deletes the log entries its recorded snapshot already covers, so the log stays small
+# Usage:
+#   python snapshot.py          (incremental refresh, only transactions inserted since the last refresh)
+#   python snapshot.py --full   (rebuild the snapshot from scratch)
+
+# Import libraries
+from config import *
+from utils import *
+import argparse
+import json
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Column types of each snapshot, amounts are stored as float64 for analysis
+TRANSACTIONS_SCHEMA = pa.schema([
+    ("transaction_id", pa.string()),
+    ("customer_id", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+    ("merchant_name", pa.string()),
+    ("category", pa.string()),
+    ("amount", pa.float64()),
+    ("location", pa.string()),
+    ("card_type", pa.string()),
+    ("approval_status", pa.string()),
+    ("payment_method", pa.string()),
+    ("is_fraud", pa.string()),
+    ("note", pa.string()),
+    ("date", pa.string()),
+])
+CUSTOMERS_SCHEMA = pa.schema([
+    ("customer_id", pa.string()),
+    ("first_name", pa.string()),
+    ("last_name", pa.string()),
+    ("age", pa.int64()),
+    ("location", pa.string()),
+    ("phone_number", pa.string()),
+])
+STATE_FILE = "_snapshot_state.json"
+TRANSACTION_COLUMNS = ", ".join(f"t.{name}" for name in TRANSACTIONS_SCHEMA.names[:-1])
+
+# Creates the insert log and the trigger that fills it, does nothing once the trigger exists
+# One statement-level trigger per INSERT copies the new IDs, stamped with the inserting database transaction
+def create_snapshot_log(cursor):
+    cursor.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s", (f"{SNAPSHOT_LOG_TABLE}_trigger",))
+    if cursor.fetchone() is not None:
+        cursor.connection.commit()
+        return
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {log_table} (
+            xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+            transaction_id TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS {log_table}_xid_idx ON {log_table} (xid);
+        CREATE OR REPLACE FUNCTION {log_table}_record() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO {log_table} (transaction_id) SELECT transaction_id FROM new_rows;
+            RETURN NULL;
+        END
+        $$;
+        CREATE TRIGGER {log_table}_trigger AFTER INSERT ON {table_name}
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {log_table}_record();
+    """.format(log_table=SNAPSHOT_LOG_TABLE, table_name=TRANSACTIONS_TABLE)
+    cursor.execute(create_sql)
+    cursor.connection.commit()
+
+# Helper function that reads the state of the last refresh - returns an empty dict if there is no snapshot yet
+def read_snapshot_state(snapshot_dir):
+    path = os.path.join(snapshot_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+# Helper function that saves the snapshot state, written to a temporary file first so a crash never leaves it half written
+def write_snapshot_state(snapshot_dir, state):
+    path = os.path.join(snapshot_dir, STATE_FILE)
+    with open(path + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(path + ".tmp", path)
+
+# Helper function that turns a list of transaction rows into an Arrow table with a 'date' partition column
+def transactions_to_table(rows):
+    columns = list(zip(*rows))
+    data = {name: list(values) for name, values in zip(TRANSACTIONS_SCHEMA.names, columns)}
+    data["amount"] = [float(amount) if amount is not None else None for amount in data["amount"]]
+    data["date"] = [timestamp.date().isoformat() if timestamp is not None else None for timestamp in data["timestamp"]]
+    return pa.Table.from_pydict(data, schema=TRANSACTIONS_SCHEMA)
+
+# Helper function that names the Parquet files written by a refresh, so a retried refresh can find and replace them
+def refresh_prefix(refresh):
+    return f"part-{refresh:06d}-"
+
+# Helper function that deletes the files a refresh wrote, used when that refresh stopped before saving its state
+def remove_refresh_files(snapshot_dir, refresh):
+    removed = 0
+    for directory, _, files in os.walk(os.path.join(snapshot_dir, "transactions")):
+        for name in files:
+            if name.startswith(refresh_prefix(refresh)):
+                os.remove(os.path.join(directory, name))
+                removed += 1
+    return removed
+
+# Exports transactions partitioned by date and category - every transaction when since is None, otherwise the ones
+# inserted by database transactions that since (a pg_snapshot from the last refresh) could not see yet
+# Run inside a REPEATABLE READ transaction so the rows match the snapshot saved for the next refresh
+# Streams rows with a server-side cursor so memory use stays bounded - returns the number of rows exported
+def export_transactions(cursor, snapshot_dir, since=None, refresh=1, batch_size=SNAPSHOT_BATCH_SIZE):
+    root_path = os.path.join(snapshot_dir, "transactions")
+
+    if since:
+        export_sql = """
+            SELECT {columns} FROM {table_name} AS t
+            WHERE t.transaction_id IN (
+                SELECT transaction_id FROM {log_table}
+                WHERE xid >= pg_snapshot_xmin(%s::pg_snapshot) AND NOT pg_visible_in_snapshot(xid, %s::pg_snapshot)
+            )
+            ORDER BY t.timestamp
+        """.format(columns=TRANSACTION_COLUMNS, table_name=TRANSACTIONS_TABLE, log_table=SNAPSHOT_LOG_TABLE)
+        params = (since, since)
+    else:
+        export_sql = "SELECT {columns} FROM {table_name} AS t ORDER BY t.timestamp".format(columns=TRANSACTION_COLUMNS, table_name=TRANSACTIONS_TABLE)
+        params = None
+
+    exported = 0
+    for batch_number, rows in enumerate(stream_batches(cursor, export_sql, params, batch_size)):
+        table = transactions_to_table(rows)
+        pq.write_to_dataset(table, root_path, partition_cols=["date", "category"],
+                            basename_template=f"{refresh_prefix(refresh)}{batch_number}-{{i}}.parquet",
+                            existing_data_behavior="overwrite_or_ignore")
+        exported += len(rows)
+
+    return exported
+
+# Exports the whole customers table, it is small enough to be rewritten on every refresh
+def export_customers(cursor, snapshot_dir):
+    cursor.execute("SELECT * FROM {table_name}".format(table_name=CUSTOMERS_TABLE))
+    rows = cursor.fetchall()
+    columns = list(zip(*rows)) if rows else [[] for _ in CUSTOMERS_SCHEMA.names]
+    table = pa.Table.from_pydict({name: list(values) for name, values in zip(CUSTOMERS_SCHEMA.names, columns)}, schema=CUSTOMERS_SCHEMA)
+    os.makedirs(os.path.join(snapshot_dir, "customers"), exist_ok=True)
+    pq.write_table(table, os.path.join(snapshot_dir, "customers", "customers.parquet"))
+    return len(rows)
+
+# Refreshes the snapshot - incremental by default, only transactions inserted since the last refresh are added
+# Rows updated in place (e.g. new fraud verdicts) need a full refresh to be picked up
+# A refresh that stopped before saving its state is retried under the same number, replacing the files it wrote
+def refresh_snapshot(cursor, snapshot_dir=SNAPSHOT_DIR, full=False):
+    try:
+        state = read_snapshot_state(snapshot_dir)
+        if state and not full and "snapshot" not in state:
+            print(f"Snapshot in {highlight('blue', snapshot_dir)} has no database snapshot to continue from, rebuilding it.")
+            full = True
+        if full:
+            if os.path.exists(snapshot_dir):
+                shutil.rmtree(snapshot_dir)
+            state = {}
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        refresh = state.get("refresh", 0) + 1
+        if state.get("in_progress"):
+            removed = remove_refresh_files(snapshot_dir, refresh)
+            print(f"Replacing {highlight('blue', removed)} file(s) left by an unfinished refresh.")
+        write_snapshot_state(snapshot_dir, dict(state, in_progress=True))
+
+        # The insert log must exist before the export's snapshot is taken, so every later insert is logged
+        create_snapshot_log(cursor)
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SELECT pg_current_snapshot()::text")
+        snapshot = cursor.fetchone()[0]
+        exported = export_transactions(cursor, snapshot_dir, state.get("snapshot"), refresh)
+        customers = export_customers(cursor, snapshot_dir)
+        write_snapshot_state(snapshot_dir, {"snapshot": snapshot, "refresh": refresh})
+
+        # Once the snapshot is recorded, log entries of database transactions that finished before its xmin can never be
+        # exported again - they are pruned in the export's transaction, so the log only holds what the next refresh reads
+        prune_sql = "DELETE FROM {log_table} WHERE xid < pg_snapshot_xmin(%s::pg_snapshot)".format(log_table=SNAPSHOT_LOG_TABLE)
+        cursor.execute(prune_sql, (snapshot,))
+        cursor.connection.commit()
+        print(f"Snapshot refreshed: {highlight('blue', exported)} new transaction(s), {highlight('blue', customers)} customer(s).")
+        return exported
+    except Exception as e:
+        print(f"Error refreshing snapshot: {e}")
+        cursor.connection.rollback()
+        raise
+
+# Reads transactions from the snapshot into a pandas DataFrame
+# Date bounds (YYYY-MM-DD, end exclusive) and categories only open the matching partitions
+def read_transactions_snapshot(snapshot_dir=SNAPSHOT_DIR, start_date=None, end_date=None, categories=None, columns=None):
+    dataset = ds.dataset(os.path.join(snapshot_dir, "transactions"), format="parquet", partitioning="hive")
+    conditions = []
+    if start_date:
+        conditions.append(ds.field("date") >= str(start_date))
+    if end_date:
+        conditions.append(ds.field("date") < str(end_date))
+    if categories:
+        conditions.append(ds.field("category").isin(list(categories)))
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+# Reads customers from the snapshot into a pandas DataFrame
+def read_customers_snapshot(snapshot_dir=SNAPSHOT_DIR, columns=None):
+    return pq.read_table(os.path.join(snapshot_dir, "customers", "customers.parquet"), columns=columns).to_pandas()
+
+# Running this file directly refreshes the snapshot
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Card Guard Parquet snapshot")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR, help="Snapshot directory")
+    parser.add_argument("--full", action="store_true", help="Rebuild the snapshot from scratch")
+    args = parser.parse_args()
+    with pooled_cursor() as cursor:
+        refresh_snapshot(cursor, args.dir, args.full)
@@ -0,0 +1,131 @@
+# CARD GUARD
+# Spending Statistics Functions
+# Keeps a running count, mean and M2 (sum of squared differences from the mean) of transaction amounts
+# per customer using Welford's method, so average and standard deviation are read in O(1) instead of
+# aggregating a customer's whole transaction history on every fraud check
+
+# Import libraries
+from config import *
+from utils import *
+from psycopg2.extras import execute_values
+import math
+
+# Creates the running statistics table if it does not already exist
+# The functions below create it on first use, an existing transactions table still needs a rebuild to fill it
+def create_spending_stats_table(cursor):
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            customer_id TEXT PRIMARY KEY,
+            txn_count BIGINT NOT NULL DEFAULT 0,
+            mean DOUBLE PRECISION NOT NULL DEFAULT 0,
+            m2 DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+    """.format(table_name=SPENDING_STATS_TABLE)
+    cursor.execute(create_sql)
+
+# Helper function that folds (customer_id, amount) pairs into one (count, mean, m2) entry per customer
+def summarize_amounts(amounts):
+    summaries = {}
+    for customer_id, amount in amounts:
+        if amount is None:  # NULL amounts are ignored, matching AVG/STDDEV_SAMP in SQL
+            continue
+        amount = float(amount)
+        count, mean, m2 = summaries.get(customer_id, (0, 0.0, 0.0))
+        count += 1
+        delta = amount - mean
+        mean += delta / count
+        m2 += delta * (amount - mean)
+        summaries[customer_id] = (count, mean, m2)
+    return [(customer_id, count, mean, m2) for customer_id, (count, mean, m2) in summaries.items()]
+
+# Adds transaction amounts to the store - takes an iterable of (customer_id, amount) pairs
+# Existing entries are merged with the new ones using the parallel form of Welford's method
+# Does not commit, so the caller can keep the statistics in the same database transaction as the insert
+def record_amounts(cursor, amounts):
+    rows = summarize_amounts(amounts)
+    if not rows:
+        return
+    ensure_table(cursor, SPENDING_STATS_TABLE, create_spending_stats_table)
+    merge_sql = """
+        INSERT INTO {table_name} AS s (customer_id, txn_count, mean, m2)
+        VALUES %s
+        ON CONFLICT (customer_id) DO UPDATE SET
+            txn_count = s.txn_count + EXCLUDED.txn_count,
+            mean = s.mean + (EXCLUDED.mean - s.mean) * EXCLUDED.txn_count / (s.txn_count + EXCLUDED.txn_count),
+            m2 = s.m2 + EXCLUDED.m2
+                 + (EXCLUDED.mean - s.mean) * (EXCLUDED.mean - s.mean) * s.txn_count * EXCLUDED.txn_count / (s.txn_count + EXCLUDED.txn_count)
+    """.format(table_name=SPENDING_STATS_TABLE)
+    execute_values(cursor, merge_sql, rows)
+
+# Removes transaction amounts from the store - takes an iterable of (customer_id, amount) pairs
+# Reverses the merge done by record_amounts, a customer whose last amount is removed goes back to zero
+# Does not commit, so the caller can keep the statistics in the same database transaction as the delete
+def remove_amounts(cursor, amounts):
+    rows = summarize_amounts(amounts)
+    if not rows:
+        return
+    ensure_table(cursor, SPENDING_STATS_TABLE, create_spending_stats_table)
+    unmerge_sql = """
+        UPDATE {table_name} AS s
+        SET txn_count = GREATEST(s.txn_count - r.txn_count, 0),
+            mean = CASE WHEN s.txn_count > r.txn_count
+                        THEN (s.txn_count * s.mean - r.txn_count * r.mean) / (s.txn_count - r.txn_count)
+                        ELSE 0 END,
+            m2 = CASE WHEN s.txn_count > r.txn_count
+                      THEN GREATEST(s.m2 - r.m2 - (r.mean - s.mean) * (r.mean - s.mean) * s.txn_count * r.txn_count / (s.txn_count - r.txn_count), 0)
+                      ELSE 0 END
+        FROM (VALUES %s) AS r(customer_id, txn_count, mean, m2)
+        WHERE s.customer_id = r.customer_id
+    """.format(table_name=SPENDING_STATS_TABLE)
+    execute_values(cursor, unmerge_sql, rows, template="(%s, %s::bigint, %s::double precision, %s::double precision)")
+
+# Helper function that turns a stored (count, mean, m2) entry into average and sample standard deviation
+def stats_from_entry(count, mean, m2):
+    if not count:
+        return 0.0, 0.0
+    std_dev = math.sqrt(max(m2, 0.0) / (count - 1)) if count > 1 else 0.0  # STDDEV_SAMP is NULL for a single row
+    return float(mean), std_dev
+
+# Finds a customer's average and standard deviation of spending from the store - returns (0.0, 0.0) if unknown
+def get_spending_stats(cursor, customerID):
+    ensure_table(cursor, SPENDING_STATS_TABLE, create_spending_stats_table)
+    stats_sql = "SELECT txn_count, mean, m2 FROM {table_name} WHERE customer_id = %s".format(table_name=SPENDING_STATS_TABLE)
+    cursor.execute(stats_sql, (customerID,))
+    result = cursor.fetchone()
+    if result:
+        return stats_from_entry(*result)
+    return 0.0, 0.0
+
+# Finds average and standard deviation for many customers at once - returns a dict of customer_id -> (avg, std_dev)
+def get_spending_stats_bulk(cursor, customerIDs):
+    ensure_table(cursor, SPENDING_STATS_TABLE, create_spending_stats_table)
+    stats_sql = "SELECT customer_id, txn_count, mean, m2 FROM {table_name} WHERE customer_id = ANY(%s)".format(table_name=SPENDING_STATS_TABLE)
+    cursor.execute(stats_sql, (list(customerIDs),))
+    return {row[0]: stats_from_entry(*row[1:]) for row in cursor.fetchall()}
+
+# Rebuilds the whole store from the transactions table, used to seed the store and to correct any drift
+def rebuild_spending_stats(cursor):
+    try:
+        create_spending_stats_table(cursor)
+        cursor.execute("TRUNCATE {table_name}".format(table_name=SPENDING_STATS_TABLE))
+        rebuild_sql = """
+            INSERT INTO {stats_table} (customer_id, txn_count, mean, m2)
+            SELECT customer_id, COUNT(amount), AVG(amount), COALESCE(VAR_POP(amount) * COUNT(amount), 0)
+            FROM {transactions_table}
+            WHERE amount IS NOT NULL
+            GROUP BY customer_id
+        """.format(stats_table=SPENDING_STATS_TABLE, transactions_table=TRANSACTIONS_TABLE)
+        cursor.execute(rebuild_sql)
+        rebuilt = cursor.rowcount
+        cursor.connection.commit()
+        print(f"Spending statistics rebuilt for {highlight('blue', rebuilt)} customer(s).")
+        return rebuilt
+    except Exception as e:
+        print(f"Error rebuilding spending statistics: {e}")
+        cursor.connection.rollback()
+        raise
+
+# Running this file directly performs a full rebuild of the store
+if __name__ == "__main__":
+    with pooled_cursor() as cursor:
+        rebuild_spending_stats(cursor)
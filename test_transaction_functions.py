@@ -1,9 +1,37 @@
 # CARD GUARD
-# charge_functions.py Testing File
+# transaction_functions.py Testing File
 
-from unittest.mock import patch, MagicMock
-from datetime import datetime
+from unittest.mock import MagicMock
+from datetime import datetime, timedelta, timezone
 from transaction_functions import *
+from spending_stats import summarize_amounts, stats_from_entry
+from vectorized_scoring import score_frame
+from rule_config import RuleConfig
+from location_profiles import LocationProfile
+from id_registry import BloomFilter, IdRegistry, transaction_id_registry
+from customer_cache import CustomerProfileCache
+from metrics import MetricsRegistry, InstrumentedCursor
+import verdict_writer
+import transaction_functions
+import transaction_generator
+import rescore
+import snapshot
+import scoring_service
+from contextlib import contextmanager
+from config import DATABASE_CONFIG
+from utils import database_connect, ConnectionPool
+from psycopg2 import pool as psycopg2_pool
+from ingestion import JsonlFileSource, append_events, event_to_transaction
+from fraud_rules import REASON_AMOUNT_BOUNDS, REASON_Z_SCORE, REASON_LOCATION
+from verdicts import find_transactions_by_reason
+import asyncio
+import json
+import re
+import statistics
+import threading
+import numpy as np
+import pandas as pd
+import psycopg2
 import pytest
 
 @pytest.fixture
@@ -23,74 +51,599 @@ def sample_charge():
         is_fraud="Undetermined"
     )
 
-@patch("processing.psycopg2.connect")  # Mock the database connection
+# Starts the shared transaction ID registry empty instead of loading it through the mocked cursor
+@pytest.fixture
+def empty_id_registry(monkeypatch):
+    monkeypatch.setattr(transaction_id_registry, "_filter", BloomFilter(1000, 0.001))
+    return transaction_id_registry
+
+# Real database connection, for checks a mocked cursor can't make - tests using it are skipped when no database is up
+@pytest.fixture
+def database_connection():
+    try:
+        connection = database_connect(**DATABASE_CONFIG)
+    except psycopg2.OperationalError:
+        pytest.skip("database not available")
+    yield connection
+    connection.close()
+
+# Real cursor on a temporary transactions table
+@pytest.fixture
+def duplicates_cursor(database_connection, monkeypatch):
+    cursor = database_connection.cursor()
+    cursor.execute("""
+        CREATE TEMP TABLE test_transactions (transaction_id text PRIMARY KEY, customer_id text, timestamp timestamp,
+            merchant_name text, amount numeric(10, 2), location text, card_type text)
+    """)
+    monkeypatch.setattr(transaction_functions, "TRANSACTIONS_TABLE", "test_transactions")
+    return cursor
+
+# Customer row returned by the mocked cursor: customer_id, first_name, last_name, age, location, phone_number
+CUSTOMER_ROW = ("TestCustomer", "Test", "Customer", 40, "New York", "555-0100")
+
 # Test Update Transaction Function
-def test_update_transaction(mock_connect, sample_charge):
-    # Create a mock connection and cursor
-    mock_conn = MagicMock()
+def test_update_transaction(sample_charge):
+    # Mock cursor, the UPDATE returns the old and new customer_id, amount and location, and that the timestamp is unchanged
     mock_cursor = MagicMock()
-    mock_connect.return_value = mock_conn
-    mock_conn.cursor.return_value = mock_cursor
-
-    # Simulate a successful update
-    mock_cursor.rowcount = 1
+    mock_cursor.fetchone.return_value = (sample_charge.customer_id, sample_charge.amount, sample_charge.location,
+                                         sample_charge.customer_id, sample_charge.amount, sample_charge.location, False)
 
     # Call the function
-    update_transaction(sample_charge)
+    update_transaction(mock_cursor, sample_charge)
 
     # Verify the SQL execution
-    mock_cursor.execute.assert_called_once_with(
-        """
-                UPDATE transactions
-                SET customer_id = %s, timestamp = %s, merchant_name = %s, category = %s, amount = %s, 
-                location = %s, card_type = %s, approval_status = %s, payment_method = %s, is_fraud = %s
-                WHERE transaction_id = %s
-        """,
-        (
-            sample_charge.customer_id, sample_charge.timestamp, sample_charge.merchant_name,
-            sample_charge.category, sample_charge.amount, sample_charge.location,
-            sample_charge.card_type, sample_charge.approval_status, sample_charge.payment_method,
-            sample_charge.is_fraud, sample_charge.transaction_id
-        )
+    mock_cursor.execute.assert_called_once()
+    update_sql, params = mock_cursor.execute.call_args[0]
+    assert "UPDATE transactions" in update_sql
+    assert params == (
+        sample_charge.customer_id, sample_charge.timestamp, sample_charge.merchant_name,
+        sample_charge.category, sample_charge.amount, sample_charge.location,
+        sample_charge.card_type, sample_charge.approval_status, sample_charge.payment_method,
+        sample_charge.is_fraud, sample_charge.note, sample_charge.transaction_id
     )
 
     # Verify that commit was called
-    mock_conn.commit.assert_called_once()
+    mock_cursor.connection.commit.assert_called_once()
 
-    # Verify the connection and cursor were closed
-    mock_cursor.close.assert_called_once()
-    mock_conn.close.assert_called_once()
+    # A failed update is rolled back, so the cursor is not left in an aborted transaction
+    mock_cursor.execute.side_effect = psycopg2.Error("deadlock detected")
+    update_transaction(mock_cursor, sample_charge)
+    mock_cursor.connection.rollback.assert_called_once()
 
 # Test that generated charges are valid
-def test_generate_charge():
+def test_generate_charge(empty_id_registry):
+    # Mock cursor: the random customer lookup, the ID registry accepts the new transaction ID without a query
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [CUSTOMER_ROW]
+
     # Generate a charge
-    charge = generate_transaction()
+    charge = generate_transaction(mock_cursor)
 
     # Check the type of the returned object
-    assert isinstance(charge, Transaction), "The returned object is not an instance of Charge."
+    assert isinstance(charge, Transaction), "The returned object is not an instance of Transaction."
 
     # Validate individual attributes
-    assert len(charge.transaction_id) == 8, "Transaction ID is not 8 characters long."
-    assert isinstance(charge.customer_id, str) and len(charge.customer_id) == 8, "Customer ID is not valid."
-    assert isinstance(charge.timestamp, datetime), "Timestamp is not a datetime."
+    assert len(charge.transaction_id) == 32, "Transaction ID is not 32 characters long."
+    assert charge.customer_id == "TestCustomer", "Customer ID is not valid."
+    assert isinstance(datetime.strptime(charge.timestamp, "%Y-%m-%d %H:%M:%S"), datetime), "Timestamp is not valid."
     assert isinstance(charge.merchant_name, str), "Merchant name is not a string."
     assert isinstance(charge.category, str), "Category is not a string."
-    assert 1.0 <= charge.amount <= 5000.0, "Amount is out of range."
+    assert 1.0 <= charge.amount <= 10000.0, "Amount is out of range."
     assert isinstance(charge.location, str), "Location is not a string."
     assert charge.card_type in ["Visa", "Mastercard", "American Express", "Discover"], "Card type is invalid."
     assert charge.approval_status in ["Approved", "Declined", "Pending"], "Approval status is invalid."
     assert charge.payment_method in ["Chip", "Swipe", "Contactless", "Online Payment", "Mobile Wallet"], "Payment method is invalid."
     assert charge.is_fraud == "Undetermined", "Default fraud status is not 'Undetermined'."
 
-def test_randomization():
-    # Generate two charges and ensure they are different
-    charge1 = generate_transaction()
-    charge2 = generate_transaction()
+def test_randomization(empty_id_registry):
+    # Generate two charges for the same customer and ensure they are different
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [CUSTOMER_ROW, CUSTOMER_ROW]
+    charge1 = generate_transaction(mock_cursor)
+    charge2 = generate_transaction(mock_cursor)
 
     assert charge1.transaction_id != charge2.transaction_id, "Transaction IDs are not unique."
-    assert charge1.customer_id != charge2.customer_id or charge1.timestamp != charge2.timestamp, \
+    assert charge1.timestamp != charge2.timestamp or charge1.merchant_name != charge2.merchant_name, \
         "Generated charges are too similar and may lack randomization."
 
+# Test that the bulk insert falls back to execute_values once COPY fails and counts the rows that already existed
+def test_add_transactions_bulk(sample_charge, monkeypatch):
+    mock_cursor = MagicMock()
+    mock_cursor.copy_expert.side_effect = psycopg2.OperationalError("COPY is not allowed")
+    inserted_chunks = [[("TestTransaction", "TestCustomer", 150.75, "New York")], []]
+    monkeypatch.setattr(transaction_functions, "insert_transaction_chunk", lambda cursor, rows: inserted_chunks.pop(0))
+    recorded = []
+    monkeypatch.setattr(transaction_functions, "record_amounts", lambda cursor, amounts: recorded.append(amounts))
+    monkeypatch.setattr(transaction_functions, "record_locations", lambda cursor, locations: None)
+
+    counts = add_transactions_bulk(mock_cursor, [sample_charge] * 3, chunk_size=2)
+    assert counts == {"inserted": 1, "skipped": 2}
+    mock_cursor.copy_expert.assert_called_once()  # The second chunk goes straight to execute_values
+    mock_cursor.connection.rollback.assert_called_once()
+    assert mock_cursor.connection.commit.call_count == 2
+    assert recorded == [[("TestCustomer", 150.75)], []]
+
+# Test that side tables are created on the caller's cursor and only remembered once the creating transaction committed
+def test_ensure_table():
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [(False,), (True,)]  # Still locked by the creating transaction, then committed
+    created = []
+    for _ in range(3):
+        ensure_table(mock_cursor, "test_table", created.append)
+    assert created == [mock_cursor, mock_cursor]
+
+# Test that seeded generators reproduce the same batch, and that restricted categories stay away from too young or old customers
+def test_transaction_generator(monkeypatch):
+    roster = [("Young", 18, "Boston"), ("Adult", 40, "New York"), ("Senior", 80, "Chicago")]
+    def generate(seed, count):
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = list(roster)
+        return [transaction_row(transaction) for transaction in transaction_generator.TransactionGenerator(mock_cursor, seed=seed, pool_size=50).generate(count)]
+
+    assert generate(7, 200) == generate(7, 200)
+    assert generate(7, 200) != generate(8, 200)
+
+    monkeypatch.setattr(transaction_generator, "ANOMALY_CHANCE", 0)  # Anomalies are the only way into a restricted category
+    rows = generate(7, 2000)
+    assert any(row[1] == "Adult" and row[4] in RESTRICTED_CATEGORIES for row in rows)
+    assert not any(row[1] != "Adult" and row[4] in RESTRICTED_CATEGORIES for row in rows)
+
+# Test that the shared rule evaluation scores each rule once
+def test_evaluate_fraud_rules(sample_charge):
+    # Clean transaction: in bounds, no outlier, no duplicates, home location, adult customer
+    fraud_score, reasons = evaluate_fraud_rules(sample_charge, 150.0, 10.0, [], "New York", 40)
+    assert fraud_score == 0 and reasons == []
+
+    # Out of bounds for category, Z-Score outlier, one duplicate, and away from home
+    sample_charge.amount = 5000.00
+    fraud_score, reasons = evaluate_fraud_rules(sample_charge, 150.0, 10.0, [("Duplicate",)], "Boston", 40)
+    assert fraud_score == 4
+    assert len(reasons) == 4
+
+    # A threshold stops evaluation once the score reaches it, the cheap amount check runs first
+    fraud_score, reasons = evaluate_fraud_rules(sample_charge, 150.0, 10.0, [("Duplicate",)], "Boston", 40, threshold=1)
+    assert fraud_score == 1
+    assert "out of bounds" in reasons[0]
+
+
+# Test that the running statistics agree with a full recalculation
+def test_running_spending_stats():
+    amounts = [12.50, 300.00, 45.99, 1200.00, 80.25]
+    [(customer_id, count, mean, m2)] = summarize_amounts([("TestCustomer", amount) for amount in amounts] + [("TestCustomer", None)])
+    avg_spent, std_dev = stats_from_entry(count, mean, m2)
+
+    assert customer_id == "TestCustomer" and count == len(amounts)
+    assert avg_spent == pytest.approx(statistics.mean(amounts))
+    assert std_dev == pytest.approx(statistics.stdev(amounts))
+    assert stats_from_entry(1, 99.0, 0.0) == (99.0, 0.0)  # A single transaction has no deviation
+
+
+# Test that a TransactionBatch round-trips rows and its views write back to the arrays
+def test_transaction_batch(sample_charge):
+    batch = TransactionBatch.from_transactions([sample_charge, sample_charge])
+    assert len(batch) == 2 and batch.columns["amount"].dtype == np.float64
+    assert batch[1].transaction_id == "TestTransaction" and batch[1].amount == 150.75
+
+    batch[0].set_fraud("FRAUD")
+    assert batch.to_rows()[0][10] == "FRAUD" and batch[1].is_fraud == "Undetermined"
+    assert batch.dictionaries["is_fraud"] == ["Undetermined", "FRAUD"]
+
+    # A slice is a separate batch, and timezone-aware timestamps keep their timezone
+    eastern = timezone(timedelta(hours=-5))
+    sample_charge.timestamp = datetime(2024, 5, 1, 12, 30, tzinfo=eastern)
+    batch = TransactionBatch.from_transactions([sample_charge] * 3)
+    sub_batch = batch[1:]
+    sub_batch[0].set_fraud("FRAUD")
+    assert len(sub_batch) == 2 and batch[1].is_fraud == "Undetermined"
+    assert sub_batch[1].timestamp == sample_charge.timestamp and sub_batch[1].timestamp.utcoffset() == timedelta(hours=-5)
+    with pytest.raises(ValueError):
+        sub_batch[0].timestamp = datetime(2024, 5, 1)
+
+
+# Test that the batch scorer skips what flag_fraud would skip unless forced, and writes each chunk with one UPDATE
+def test_flag_fraud_batch(sample_charge, monkeypatch):
+    def charge(transaction_id, **changes):
+        transaction = Transaction(*(getattr(sample_charge, name) for name in Transaction.__slots__))
+        transaction.transaction_id = transaction_id
+        for name, value in changes.items():
+            setattr(transaction, name, value)
+        return transaction
+    transactions = [charge("Clean"), charge("Scored", is_fraud="NOT FRAUD"), charge("Declined", approval_status="Declined"),
+                    charge("Free", amount=0), charge("Large", amount=5000.00)]
+    prefetched = {"spending_stats": (150.0, 10.0), "duplicates": [], "location_profile": LocationProfile("New York"), "customer_age": 40}
+    monkeypatch.setattr(fraud_rules, "prefetch", lambda cursor, batch: {transaction.transaction_id: prefetched for transaction in batch})
+    written = []
+    monkeypatch.setattr(transaction_functions, "write_verdicts", lambda cursor, verdicts: written.append(verdicts))
+    mock_cursor = MagicMock()
+
+    assert flag_fraud_batch(mock_cursor, transactions, chunk_size=2) == {"Clean": 0, "Large": 2}
+    assert [[verdict[:3] for verdict in verdicts] for verdicts in written] == [[("Clean", "NOT FRAUD", 0)], [("Large", "FRAUD", 2)]]
+    assert mock_cursor.connection.commit.call_count == 2  # The chunk of Declined and Free had nothing to score
+
+    # force rescores the transaction that already has a verdict, never the declined or zero amount ones
+    written.clear()
+    assert flag_fraud_batch(mock_cursor, transactions, chunk_size=10, force=True) == {"Clean": 0, "Scored": 0, "Large": 2}
+    assert len(written) == 1 and [verdict[0] for verdict in written[0]] == ["Clean", "Scored", "Large"]
+
+# Test that the vectorized scorer agrees with the shared rule evaluation
+def test_score_frame(sample_charge, monkeypatch):
+    stats = pd.DataFrame({"customer_id": ["TestCustomer"], "avg_spent": [150.0], "std_dev": [10.0], "location": ["Boston"], "age": [40]})
+    frame = pd.DataFrame([{name: getattr(sample_charge, name) for name in Transaction.__slots__}] * 2)
+    frame.loc[1, "amount"] = 5000.00
+    # The customer shops in Boston, New York only shows up for the transaction being scored
+    counts = pd.DataFrame({"customer_id": ["TestCustomer"] * 2, "location": ["Boston", "New York"], "location_count": [10, 1]})
+    scored = score_frame(frame, stats, location_counts=counts)
+
+    profile = LocationProfile("Boston", 11, {"Boston": 10, "New York": 1})
+    for index, amount in enumerate([150.75, 5000.00]):
+        sample_charge.amount = amount
+        fraud_score, reasons = evaluate_fraud_rules(sample_charge, 150.0, 10.0, [], profile, 40)
+        assert scored.loc[index, "fraud_score"] == fraud_score
+    assert scored.loc[1, "reason_codes"] == REASON_AMOUNT_BOUNDS | REASON_Z_SCORE | REASON_LOCATION
+
+    # A rule registered with a higher weight adds that weight, like it does in flag_fraud
+    monkeypatch.setattr(fraud_rules.rules["location"], "weight", 3)
+    assert score_frame(frame, stats, location_counts=counts).loc[1, "fraud_score"] == fraud_score + 2
+
+# Test that frequently used locations are accepted and rarely used or unseen ones score as anomalies
+def test_location_profile():
+    profile = LocationProfile("Boston", 20, {"New York": 12, "Boston": 5, "Chicago": 2})
+    assert profile.share("Boston") == 1.0 and profile.share("Unknown") == 1.0
+    assert profile.share("New York") == 11 / 19
+    assert profile.share("Chicago") == 1 / 19 < LOCATION_MIN_SHARE
+    assert profile.anomaly_score("London") == 1.0
+    assert profile.expected_locations() == ["Boston", "New York", "Chicago"]
+
+# Test that the ID registry only queries for possible matches and rebuilds once deletions pile up
+def test_id_registry():
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [(2,), ("TestTransaction",), None]
+    mock_cursor.connection.cursor.return_value.__enter__.return_value.fetchmany.side_effect = [[("TestTransaction",), ("Other",)], []]
+    registry = IdRegistry("transactions", "transaction_id", min_capacity=100)
+
+    assert registry.exists(mock_cursor, "TestTransaction")  # Loads the filter, then confirms the hit
+    assert not registry.exists(mock_cursor, "NewTransaction")  # Answered by the filter alone
+    registry.add(["NewTransaction"])
+    assert not registry.exists(mock_cursor, "NewTransaction")  # Deleted since, so the query finds nothing
+    assert registry.stats()["definitely_new"] == 1 and registry.stats()["false_positives"] == 1
+    registry.remove(["TestTransaction", "Other"])
+    assert registry._removed * 2 > registry._filter.count
+
+    # Stale filter: threads that find it stale together wait for one rebuild, and IDs added during it are kept
+    batches = [[("TestTransaction",)], []]
+    def read_ids(batch_size):
+        if batches[0]:
+            registry.add(["AddedDuringLoad"])
+            waiting.start()
+            waiting.join(0.05)  # Still blocked on the rebuild
+        return batches.pop(0)
+    loading_cursor, waiting_cursor = MagicMock(), MagicMock()
+    loading_cursor.fetchone.side_effect = [(1,), None]
+    loading_cursor.connection.cursor.return_value.__enter__.return_value.fetchmany.side_effect = read_ids
+    waiting_cursor.fetchone.return_value = None
+    waiting = threading.Thread(target=registry.exists, args=(waiting_cursor, "AddedDuringLoad"))
+    assert not registry.exists(loading_cursor, "NewTransaction")
+    waiting.join()
+    assert "AddedDuringLoad" in registry._filter and registry._removed == 0
+    assert not waiting_cursor.connection.cursor.called  # Found the rebuilt filter and did not load it again
+
+# Test that cached customers are loaded once, and that a customer invalidated while it is being loaded is not stored
+def test_customer_cache(empty_id_registry, monkeypatch):
+    cache = CustomerProfileCache(max_size=10, ttl=60)
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [CUSTOMER_ROW]
+    customer = cache.get(mock_cursor, CUSTOMER_ROW[0])
+    assert customer.location == CUSTOMER_ROW[4] and cache.get(mock_cursor, CUSTOMER_ROW[0]) is customer
+    assert mock_cursor.execute.call_count == 1
+
+    cache.invalidate(CUSTOMER_ROW[0])
+    def updated_meanwhile():
+        cache.invalidate(CUSTOMER_ROW[0])
+        return [CUSTOMER_ROW]
+    mock_cursor.fetchall.side_effect = updated_meanwhile
+    assert cache.get(mock_cursor, CUSTOMER_ROW[0]).location == CUSTOMER_ROW[4]
+    assert cache.stats()["size"] == 0 and not cache._invalidated
+
+    # generate_transaction caches the customer it read, unless the customer was updated during the read
+    monkeypatch.setattr(transaction_functions, "customer_cache", cache)
+    mock_cursor.fetchone.side_effect = [CUSTOMER_ROW]
+    generate_transaction(mock_cursor)
+    assert cache.stats()["size"] == 1
+    cache.invalidate(CUSTOMER_ROW[0])
+    def updated_during_read():
+        cache.invalidate(CUSTOMER_ROW[0])
+        return CUSTOMER_ROW
+    mock_cursor.fetchone.side_effect = updated_during_read
+    generate_transaction(mock_cursor)
+    assert cache.stats()["size"] == 0 and not cache._loading
+
+# Test that queued verdicts are written in one deduplicated batch, and spilled to a file when the database is down on shutdown
+def test_verdict_writer(monkeypatch, tmp_path):
+    written = []
+    monkeypatch.setattr(verdict_writer, "pooled_cursor", contextmanager(lambda: (yield MagicMock())))
+    monkeypatch.setattr(verdict_writer, "write_verdicts", lambda cursor, verdicts: written.append(verdicts))
+    writer = verdict_writer.VerdictWriter(batch_size=10, max_latency=5, spill_file=str(tmp_path / "spill.jsonl"))
+    writer.submit("TestTransaction", "NOT FRAUD", 0, "v1")
+    writer.submit("Other", "FRAUD", 2, "v1")
+    writer.submit("TestTransaction", "FRAUD", 1, "v2", REASON_Z_SCORE, {"z_score": 2.5})
+    writer.close()
+    assert [[verdict[:6] for verdict in verdicts] for verdicts in written] == [[("TestTransaction", "FRAUD", 1, "v2", REASON_Z_SCORE, {"z_score": 2.5}), ("Other", "FRAUD", 2, "v1", 0, None)]]
+    assert written[0][0][6] > written[0][1][6]  # Stamped when submitted, so the database keeps the newest verdict
+
+    def database_down(cursor, verdicts):
+        raise RuntimeError("connection refused")
+    monkeypatch.setattr(verdict_writer, "write_verdicts", database_down)
+    monkeypatch.setattr(verdict_writer.time, "sleep", lambda seconds: None)
+    writer.submit("TestTransaction", "FRAUD", 1, "v2", REASON_Z_SCORE, {"z_score": 2.5})
+    writer.close()
+    assert writer.spilled == 1
+    assert json.loads((tmp_path / "spill.jsonl").read_text())[:6] == ["TestTransaction", "FRAUD", 1, "v2", REASON_Z_SCORE, {"z_score": 2.5}]
+
+    # With the queue full the verdict is written on the caller's cursor, and committing it is left to the caller
+    monkeypatch.setattr(verdict_writer, "write_verdicts", lambda cursor, verdicts: written.append(verdicts))
+    writer = verdict_writer.VerdictWriter(batch_size=1, queue_size=1, submit_timeout=0.01, spill_file=str(tmp_path / "spill.jsonl"))
+    released = threading.Event()
+    monkeypatch.setattr(writer, "_write", lambda batch: released.wait())
+    mock_cursor = MagicMock()
+    assert writer.submit("First", "FRAUD", 1, "v2", cursor=mock_cursor)
+    while writer._queue.qsize():  # Wait for the writer thread to pick it up and stall
+        released.wait(0.01)
+    assert writer.submit("Second", "FRAUD", 1, "v2", cursor=mock_cursor)
+    assert not writer.submit("Third", "FRAUD", 1, "v2", cursor=mock_cursor)
+    assert written[-1][0][0] == "Third" and writer.written_directly == 1
+    mock_cursor.connection.commit.assert_not_called()
+    released.set()
+    writer.close()
+
+# Test that rules report their reason codes and params, and that reasons are looked up through their partial index
+def test_reason_codes(sample_charge):
+    sample_charge.amount = 5000.00
+    prefetched = {"spending_stats": (150.0, 10.0), "duplicates": [], "location_profile": LocationProfile("New York"), "customer_age": 40}
+    fraud_score, reasons, reason_mask, params = fraud_rules.evaluate_detailed(None, sample_charge, prefetched)
+    assert fraud_score == 2 and reason_mask == REASON_AMOUNT_BOUNDS | REASON_Z_SCORE
+    assert params == {"max_amount": 500.0, "z_score": 485.0}
+
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = []
+    assert find_transactions_by_reason(mock_cursor, "z_score", "2024-01-01", "2024-02-01") == []
+    prepare_sql = mock_cursor.execute.call_args_list[0][0][0]
+    assert "reason_mask & 2 <> 0 AND transaction_ts >= $1 AND transaction_ts < $2" in prepare_sql
+    with pytest.raises(ValueError):
+        find_transactions_by_reason(mock_cursor, "velocity")
+
+# Test that a transaction lookup prepares its query once per connection and fetches only the requested columns
+def test_find_transaction_prepared(sample_charge):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = ("Undetermined", 150.75)
+
+    assert find_transaction(mock_cursor, "TestTransaction", ("is_fraud", "amount")) == ("Undetermined", 150.75)
+    find_transaction(mock_cursor, "TestTransaction", ("is_fraud", "amount"))
+    statements = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert statements[0].startswith("PREPARE") and "SELECT is_fraud, amount FROM transactions WHERE transaction_id = $1" in statements[0]
+    assert len(statements) == 3 and all(statement.startswith("EXECUTE") for statement in statements[1:])
+    with pytest.raises(ValueError):
+        find_transaction(mock_cursor, "TestTransaction", ("amount; DROP TABLE transactions",))
+
+    # A % inside a string literal is kept, dict parameters are rejected
+    execute_prepared(mock_cursor, "SELECT 1 FROM transactions WHERE merchant_name LIKE 'A%' AND amount > %s", (0,))
+    assert "LIKE 'A%' AND amount > $1" in mock_cursor.execute.call_args_list[-2][0][0]
+    with pytest.raises(ValueError):
+        execute_prepared(mock_cursor, "SELECT %(amount)s", {"amount": 0})
+
+# Test that events round-trip through the JSONL log and a half-written line is left for the next read
+def test_jsonl_event_source(sample_charge, tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    sample_charge.timestamp = datetime(2024, 5, 1, 12, 30)
+    append_events(path, [sample_charge])
+    with open(path, "a") as file:
+        file.write('{"transaction_id": "Partial"')
+
+    source = JsonlFileSource(path)
+    lines = source.read(max_events=10, max_latency=0, timeout=0.1)
+    assert len(lines) == 1 and source.offset([token for _, token in lines]) == len(lines[0][0])
+    decoded = event_to_transaction(json.loads(lines[0][0]))
+    assert [getattr(decoded, name) for name in Transaction.__slots__] == [getattr(sample_charge, name) for name in Transaction.__slots__]
+    with pytest.raises(ValueError):
+        event_to_transaction({"transaction_id": "NoCustomer"})
+    source.close()
+
+# Test that rule configs are immutable, versioned by their settings, and change the rule thresholds
+def test_rule_config(sample_charge):
+    rules = RuleConfig({"z_score_threshold": 5.0})
+    assert rules.version == RuleConfig({"z_score_threshold": 5.0}).version != RuleConfig({}).version
+    assert rules.bounds_by_id[rules.category_id("Unknown Category")] == rules.max_amount("Unknown Category")
+    with pytest.raises(AttributeError):
+        rules.z_score_threshold = 1.0
+    with pytest.raises(ValueError):
+        RuleConfig({"z_score": 5.0})
+    with pytest.raises(ValueError):
+        RuleConfig({"age_restricted_categories": "Gambling"})
+    travel = RuleConfig({"category_bounds": {"Travel": 4000}})  # Other categories keep their config.py bounds
+    assert travel.max_amount("Travel") == 4000.0 and travel.max_amount("Luxury Items") == CATEGORY_BOUNDS["Luxury Items"]
+
+    sample_charge.amount = 190.00
+    assert evaluate_fraud_rules(sample_charge, 150.0, 10.0, [], "New York", 40)[0] == 1
+    assert evaluate_fraud_rules(sample_charge, 150.0, 10.0, [], "New York", 40, rules=rules)[0] == 0
+
+
+# Test that a rescore partition resumes after its checkpoint and records where it stopped
+def test_rescore_checkpoint(sample_charge, monkeypatch):
+    mock_cursor = MagicMock()
+    monkeypatch.setattr(rescore, "pooled_cursor", contextmanager(lambda: (yield mock_cursor)))
+    row = tuple(getattr(sample_charge, name) for name in Transaction.__slots__)
+    mock_cursor.fetchone.return_value = ("Earlier", 5, False)  # Checkpoint of an interrupted run
+    mock_cursor.fetchall.return_value = [row]
+    monkeypatch.setattr(rescore, "flag_fraud_batch", lambda cursor, batch, chunk_size, force: {view.transaction_id: 0 for view in batch})
+
+    assert rescore.rescore_partition("test", 4, 1, batch_size=2)[1] == 6
+    batch_params, checkpoint_params = [call[0][1] for call in mock_cursor.execute.call_args_list[1:]]
+    assert batch_params == (4, 1, "Earlier", False, 2)
+    assert checkpoint_params == ("test", 4, 1, "TestTransaction", 6, True)  # Fewer rows than batch_size, so finished
+
+    # A finished partition is not read again
+    mock_cursor.reset_mock()
+    mock_cursor.fetchone.return_value = ("TestTransaction", 6, True)
+    assert rescore.rescore_partition("test", 4, 1, batch_size=2)[1] == 6
+    assert mock_cursor.execute.call_count == 1
+
+
+# Test that timestamp repairs stream the affected rows through a server-side cursor and stage the rule's timestamps
+def test_repair_timestamps(sample_charge, monkeypatch):
+    mock_cursor = MagicMock()
+    mock_cursor.rowcount = 1
+    stream = mock_cursor.connection.cursor.return_value.__enter__.return_value
+    row = tuple(getattr(sample_charge, name) for name in Transaction.__slots__)
+    stream.__iter__.return_value = iter([row, ("Other",) + row[1:]])
+    staged = []
+    monkeypatch.setattr(transaction_functions, "execute_values", lambda cursor, sql, repairs, page_size: staged.extend(repairs))
+
+    repaired = datetime(2024, 5, 1, 12, 30)
+    assert repair_timestamps(mock_cursor, rule=lambda transaction: repaired if transaction.transaction_id != "Other" else None, chunk_size=50) == 1
+    assert mock_cursor.connection.cursor.call_args[1]["withhold"] is False and stream.itersize == 50
+    assert staged == [("TestTransaction", repaired)]  # A rule returning None skips the row
+    mock_cursor.connection.commit.assert_called_once()
+    with pytest.raises(ValueError):
+        repair_timestamps(mock_cursor)
+
+
+# Test that an incremental snapshot refresh only reads log entries its predecessor's snapshot could not see, and prunes the rest
+def test_snapshot_refresh(sample_charge, monkeypatch, tmp_path):
+    sample_charge.timestamp = datetime(2024, 5, 1, 12, 30)
+    row = tuple(getattr(sample_charge, name) for name in Transaction.__slots__)
+    reads = []
+    def stream_batches(cursor, query, params, batch_size):
+        reads.append(params)
+        return iter([[row]])
+    monkeypatch.setattr(snapshot, "stream_batches", stream_batches)
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [(1,), ("100:102:100",), (1,), ("105:105:",)]  # Trigger exists, then each refresh's snapshot
+    mock_cursor.fetchall.return_value = [CUSTOMER_ROW]
+
+    snapshot.refresh_snapshot(mock_cursor, str(tmp_path))
+    snapshot.refresh_snapshot(mock_cursor, str(tmp_path))
+    assert reads == [None, ("100:102:100", "100:102:100")]
+    prunes = [call[0][1] for call in mock_cursor.execute.call_args_list if call[0][0].startswith("DELETE")]
+    assert prunes == [("100:102:100",), ("105:105:",)]
+    assert snapshot.read_snapshot_state(str(tmp_path)) == {"snapshot": "105:105:", "refresh": 2}
+
+
+# Test that the scoring service returns verdicts, honours an explicit zero timeout and drains its queue on shutdown
+def test_scoring_service(sample_charge, monkeypatch):
+    released = threading.Event()
+    def score_transaction(transaction):
+        released.wait(5)  # Stands in for flag_fraud on a pooled connection
+        return 2 if transaction.amount > 1000 else 0
+    monkeypatch.setattr(scoring_service, "score_transaction", score_transaction)
+    monkeypatch.setattr(scoring_service.verdict_writer, "flush", lambda: None)
+
+    async def run():
+        service = scoring_service.ScoringService(workers=2, queue_size=10, timeout=5)
+        await service.start()
+        released.set()
+        assert await service.score(sample_charge) == 0
+
+        # timeout=0 gives up at once instead of falling back to the service timeout
+        released.clear()
+        with pytest.raises(asyncio.TimeoutError):
+            await service.score(sample_charge, timeout=0)
+        assert service.timeouts == 1
+
+        # Transactions still queued when the service stops are scored before it returns
+        pending = [asyncio.ensure_future(service.score(sample_charge)) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        asyncio.get_running_loop().call_later(0.05, released.set)
+        await service.stop()
+        assert [task.result() for task in pending] == [0] * 4
+        assert service.queue.empty() and service.latency_stats()["count"] == 5
+    asyncio.run(run())
+
+# Test that duplicates are only flagged inside both the time window and the amount tolerance, per row, in bulk and on the index
+def test_find_repeat_transactions(sample_charge, duplicates_cursor):
+    create_duplicate_index(duplicates_cursor)
+    sample_charge.timestamp = datetime(2024, 1, 1, 12, 0)
+    sample_charge.amount = 0.1 + 0.2  # Float error, 0.30000000000000004
+    stored = [("Inside", 10, 0.30), ("Tolerance", -10, 0.31), ("OutsideWindow", 11, 0.30), ("OutsideTolerance", 0, 0.32)]
+    for transaction_id, minutes, amount in stored:
+        duplicates_cursor.execute("INSERT INTO test_transactions VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                                  (transaction_id, sample_charge.customer_id, sample_charge.timestamp + timedelta(minutes=minutes),
+                                   sample_charge.merchant_name, amount, sample_charge.location, sample_charge.card_type))
+    assert sorted(find_repeat_transactions(duplicates_cursor, sample_charge, 10, 0.01)) == [("Inside",), ("Tolerance",)]
+    bulk = find_repeat_transactions_bulk(duplicates_cursor, [sample_charge], 10, 0.01)
+    assert sorted(bulk["TestTransaction"]) == [("Inside",), ("Tolerance",)]
+    # With no tolerance only the float-error amount still matches
+    assert find_repeat_transactions(duplicates_cursor, sample_charge, 10, 0) == [("Inside",)]
+    assert find_repeat_transactions_bulk(duplicates_cursor, [sample_charge], 10, 0) == {"TestTransaction": [("Inside",)]}
+    duplicates_cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'test_transactions_duplicate_lookup'")
+    assert duplicates_cursor.fetchone()[0].endswith("(customer_id, merchant_name, location, card_type, \"timestamp\")")
+
+# Test that the pool times out when every slot is taken, discards stale connections, and rolls back or closes returned ones
+def test_connection_pool():
+    healthy, stale = MagicMock(closed=0), MagicMock(closed=1)
+    pool = ConnectionPool(0, 3, checkout_timeout=0.01)
+    pool._pool = MagicMock()
+    pool._pool.getconn.side_effect = [stale, stale, healthy]
+    assert pool.getconn() is healthy
+    assert pool._pool.putconn.call_args_list == [((stale,), {"close": True})] * 2
+    # Every connection stale - the checkout fails and gives its slot back
+    pool._pool.getconn.side_effect = [stale] * 3
+    with pytest.raises(psycopg2_pool.PoolError):
+        pool.getconn()
+    pool._pool.getconn.side_effect = None
+    pool._pool.getconn.return_value = healthy
+    assert pool.getconn() is healthy and pool.getconn() is healthy
+    with pytest.raises(psycopg2_pool.PoolError):
+        pool.getconn()  # All three slots are checked out
+    # Returned mid-transaction: rolled back and kept, or closed when the rollback fails
+    pool._pool.putconn.reset_mock()
+    healthy.rollback.reset_mock()
+    healthy.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+    pool.putconn(healthy)
+    healthy.rollback.assert_called_once()
+    healthy.rollback.side_effect = psycopg2.OperationalError
+    pool.putconn(healthy)
+    assert pool._pool.putconn.call_args_list == [((healthy,), {"close": False}), ((healthy,), {"close": True})]
+    healthy.rollback.side_effect = None
+    assert pool.getconn() is healthy and pool.getconn() is healthy  # Both slots were released
+
+# Test that counters and timer histograms render valid Prometheus text, and that a disabled registry records nothing
+def test_metrics(database_connection, monkeypatch):
+    registry = MetricsRegistry(enabled=True)
+    monkeypatch.setattr("metrics.metrics", registry)
+    registry.inc("cardguard_cache_hits_total", "Cache hits", cache="customer")
+    registry.inc("cardguard_cache_hits_total", "Cache hits", 2, cache="customer")
+    registry.inc("cardguard_cache_hits_total", "Cache hits", cache='say "hi"\\now')
+    with registry.timer("cardguard_rule_seconds", "Wall time of\neach rule", rule="z_score"):
+        pass
+    with database_connection.cursor(cursor_factory=InstrumentedCursor) as cursor:
+        cursor.execute("SELECT generate_series(1, 3)")
+        assert len(cursor.fetchall()) == 3
+    text = registry.render()
+    lines = text.splitlines()
+    assert text.endswith("\n")
+    assert 'cardguard_cache_hits_total{cache="customer"} 3' in lines
+    assert 'cardguard_cache_hits_total{cache="say \\"hi\\"\\\\now"} 1' in lines
+    assert "# HELP cardguard_rule_seconds Wall time of\\neach rule" in lines
+    assert "cardguard_db_queries_total 1" in lines and "cardguard_db_rows_fetched_total 3" in lines
+    # Every sample is name{labels} value, and each histogram's buckets are cumulative and end in +Inf at the count
+    sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*"(?:,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*")*\})? (\S+)$')
+    for line in lines:
+        assert line.startswith(("# HELP ", "# TYPE ")) or (sample.match(line) and float(line.rsplit(" ", 1)[1]) >= 0), line
+    for name in ("cardguard_rule_seconds", "cardguard_db_query_seconds"):
+        buckets = [line for line in lines if line.startswith(name + "_bucket")]
+        counts = [float(line.rsplit(" ", 1)[1]) for line in buckets]
+        assert counts == sorted(counts) and counts[-1] == 1 and 'le="+Inf"' in buckets[-1]
+        assert f"# TYPE {name} histogram" in lines and any(line.startswith(name + "_count") and line.endswith(" 1") for line in lines)
+    # Disabled: every call is a no-op, even on an instrumented cursor
+    disabled = MetricsRegistry(enabled=False)
+    monkeypatch.setattr("metrics.metrics", disabled)
+    disabled.inc("cardguard_cache_hits_total", "Cache hits")
+    disabled.observe("cardguard_rule_seconds", "Rule time", 0.5)
+    with disabled.timer("cardguard_rule_seconds", "Rule time"), disabled.track("flag_fraud"):
+        with database_connection.cursor(cursor_factory=InstrumentedCursor) as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+    assert disabled.render() == "\n" and disabled.thread_counts() == (0, 0)
+
 
 
 
@@ -6,23 +6,40 @@ from config import *
 from models import *
 from utils import *
 from customer_functions import find_customer
+from customer_cache import customer_cache
+from id_registry import transaction_id_registry
+from spending_stats import record_amounts, remove_amounts, get_spending_stats, get_spending_stats_bulk
+from location_profiles import LocationProfile, record_locations, remove_locations, get_location_counts_bulk
+from fraud_rules import fraud_rules
+from rule_config import get_rule_config
+from verdicts import write_verdicts, refresh_score_timestamps, create_missing_scores_table
+from verdict_writer import verdict_writer
+from transaction_generator import (TransactionGenerator, CATEGORIES, RESTRICTED_CATEGORIES, REDRAW_CATEGORIES, CARD_TYPES, APPROVAL_STATUSES, APPROVAL_WEIGHTS,
+                                   PAYMENT_METHODS, DECLINED_NOTES, ANOMALY_CHANCE, AMOUNT_RANGES)
 import random
 import uuid
 from faker import Faker
+import csv
+import io
+import psycopg2
+from psycopg2.extras import execute_values
 
-# Connect to PostgreSQL Database using the helper function
-main_connection = database_connect(**DATABASE_CONFIG)  # Database connection passed into functions
-main_cursor = main_connection.cursor()  # Cursor to execute SQL commands passed into functions
+# Faker instance shared by every generated transaction, creating one per call is slow
+fake = Faker()
 
 # Updates the table with new transaction information when modified
 def update_transaction(cursor, transaction):
     try:        
-        # SQL query to update row with new transaction information
+        # SQL query to update row with new transaction information, returning the old and new customer_id, amount and location
+        # and whether the timestamp changed
         update_table_sql = """
-                UPDATE {table_name}
+                UPDATE {table_name} AS t
                 SET customer_id = %s, timestamp = %s, merchant_name = %s, category = %s, amount = %s, 
                     location = %s, card_type = %s, approval_status = %s, payment_method = %s, is_fraud = %s, note = %s
-                WHERE transaction_id = %s
+                FROM (SELECT transaction_id, customer_id, amount, location, timestamp FROM {table_name} WHERE transaction_id = %s FOR UPDATE) AS old
+                WHERE t.transaction_id = old.transaction_id
+                RETURNING old.customer_id, old.amount, old.location, t.customer_id, t.amount, t.location,
+                          t.timestamp IS DISTINCT FROM old.timestamp
                 """.format(table_name=TRANSACTIONS_TABLE)
         # Execute the SQL Query
         cursor.execute(update_table_sql, (
@@ -30,29 +47,36 @@ def update_transaction(cursor, transaction):
             transaction.location, transaction.card_type, transaction.approval_status, transaction.payment_method, transaction.is_fraud, transaction.note,
             transaction.transaction_id,
         ))
+        result = cursor.fetchone()
+
+        # Keep the running spending statistics and location counts in step if the customer, amount or location changed
+        if result and (result[0], result[1]) != (result[3], result[4]):
+            remove_amounts(cursor, [(result[0], result[1])])
+            record_amounts(cursor, [(result[3], result[4])])
+        if result and (result[0], result[2]) != (result[3], result[5]):
+            remove_locations(cursor, [(result[0], result[2])])
+            record_locations(cursor, [(result[3], result[5])])
+        # The transaction's score is looked up by timestamp, so it follows the new one
+        if result and result[6]:
+            refresh_score_timestamps(cursor, [transaction.transaction_id])
         
         # Commit changes and close connections
-        main_connection.commit()
+        cursor.connection.commit()
         print(f"Transaction ID: {highlight("blue",transaction.transaction_id)} successfully updated.")
     except Exception as e:
         print(f"Error updating transaction {highlight("blue",transaction.transaction_id)}: {e}")
+        cursor.connection.rollback()  # The UPDATE and the statistics it moved are undone together
 
-# Finds a customer's location for detecting locational anomaly fraud
+# Finds the home location on a customer's profile - the location rule also accepts the locations the customer
+# uses most, see load_location_profile
+# Reads the customer's profile from customer_cache, so repeated lookups do not hit the customers table
 def find_customer_location(cursor, customerID):
     try:
-        # Query to find the most common location for the customer
-        location_query_sql = """
-            SELECT location
-            FROM {table_name}
-            WHERE customer_id = %s
-        """.format(table_name=CUSTOMERS_TABLE)
-        # Execute the SQL Query
-        cursor.execute(location_query_sql, (customerID,))
-        result = cursor.fetchone()
+        customer = customer_cache.get(cursor, customerID)
 
-        # Return the customer's common location or 'Unknown' if no result is found
-        if result:
-            return result[0]
+        # Return the customer's common location or 'Unknown' if the customer is not found
+        if customer:
+            return customer.location
         else:
             return "Unknown"
     
@@ -61,21 +85,14 @@ def find_customer_location(cursor, customerID):
         return "Unknown"
     
 # Helper function to find a customer's age for unexpected category fraud
+# Reads the customer's profile from customer_cache, so repeated lookups do not hit the customers table
 def find_customer_age(cursor, customerID):
     try:
-        # Query to find the customer's age
-        age_query_sql = """
-            SELECT age
-            FROM {table_name}
-            WHERE customer_id = %s
-        """.format(table_name=CUSTOMERS_TABLE)
-        # Execute the SQL Query
-        cursor.execute(age_query_sql, (customerID,))
-        result = cursor.fetchone()
+        customer = customer_cache.get(cursor, customerID)
 
         # Return the customer's age or 0 if not found
-        if result:
-            return result[0]
+        if customer:
+            return customer.age
         else:
             return 0
     
@@ -83,22 +100,23 @@ def find_customer_age(cursor, customerID):
         print(f"Error finding typical age for customer_id {customerID}: {e}")
         return 0
 
-# Helper function to find a transaction in database from transaction ID
-def find_transaction(cursor, transactionID):
+# Helper function to find a transaction in database from transaction ID - returns a Transaction
+# columns fetches only those fields instead and returns them as a tuple, e.g. find_transaction(cursor, id, ("is_fraud",))
+def find_transaction(cursor, transactionID, columns=None):
     try:
-        # Check if the transaction_id exists
-        check_sql = "SELECT * FROM {table_name} WHERE transaction_id = %s".format(table_name=TRANSACTIONS_TABLE)
-        cursor.execute(check_sql, (transactionID,))
+        find_sql = "SELECT {columns} FROM {table_name} WHERE transaction_id = %s".format(
+            columns=select_columns(Transaction, columns or Transaction.__slots__), table_name=TRANSACTIONS_TABLE)
+        execute_prepared(cursor, find_sql, (transactionID,))
         
         # Use fetchone to get a single result
         result = cursor.fetchone()
 
         # Return the result if found, otherwise return None
         if result:
-            # Create a Transaction object from the tuple result
-            return Transaction(*result)  # Unpacks the result tuple into the Transaction constructor
+            # Create a Transaction object from the tuple result when every column was fetched
+            return result if columns else Transaction(*result)
         else:
-            print(f"Transaction ID: {highlight("blue",transactionID)} is not in the database.")
+            print(f"Transaction ID: {highlight('blue', transactionID)} is not in the database.")
             return None
 
     except Exception as e:
@@ -106,100 +124,158 @@ def find_transaction(cursor, transactionID):
         raise  # Re-raise the exception for better error propagation
 
 # Adds a transaction to database, allows for manual transaction entry
+# An existing transaction_id is skipped by the INSERT itself, so no separate existence check is needed
 def add_transaction(cursor, transaction):
     try:
-        # Check if the transaction_id already exists
-        check_sql = "SELECT 1 FROM {table_name} WHERE transaction_id = %s".format(table_name=TRANSACTIONS_TABLE)
-        cursor.execute(check_sql, (transaction.transaction_id,))
-        result = cursor.fetchone()
+        # SQL to insert new transaction
+        insert_sql = """
+            INSERT INTO {table_name} (
+                transaction_id, customer_id, timestamp, merchant_name, category, amount, 
+                location, card_type, approval_status, payment_method, is_fraud, note
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (transaction_id) DO NOTHING
+        """.format(table_name=TRANSACTIONS_TABLE)
+        # Execute the SQL Query
+        cursor.execute(insert_sql, (
+            transaction.transaction_id, transaction.customer_id, transaction.timestamp, 
+            transaction.merchant_name, transaction.category, transaction.amount, 
+            transaction.location, transaction.card_type, transaction.approval_status, 
+            transaction.payment_method, transaction.is_fraud, transaction.note,
+        ))
 
-        if result:
+        if not cursor.rowcount:
             print(f"Transaction ID: {highlight('blue', transaction.transaction_id)} already exists in the database. Skipping insertion.")
         else:
-            # SQL to insert new transaction
-            insert_sql = """
-                INSERT INTO {table_name} (
-                    transaction_id, customer_id, timestamp, merchant_name, category, amount, 
-                    location, card_type, approval_status, payment_method, is_fraud, note
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """.format(table_name=TRANSACTIONS_TABLE)
-            # Execute the SQL Query
-            cursor.execute(insert_sql, (
-                transaction.transaction_id, transaction.customer_id, transaction.timestamp, 
-                transaction.merchant_name, transaction.category, transaction.amount, 
-                transaction.location, transaction.card_type, transaction.approval_status, 
-                transaction.payment_method, transaction.is_fraud, transaction.note,
-            ))
-            # Commit the addition
-            main_connection.commit()
+            # Add the amount to the customer's running spending statistics
+            record_amounts(cursor, [(transaction.customer_id, transaction.amount)])
+            record_locations(cursor, [(transaction.customer_id, transaction.location)])
+            # Commit the addition and record the new ID
+            cursor.connection.commit()
+            transaction_id_registry.add([transaction.transaction_id])
             print(f"Transaction ID: {highlight('blue', transaction.transaction_id)} successfully added to database!")
 
     except Exception as e:
         print("Failed to insert record into table:", e)
-        main_connection.rollback()  # Roll back the transaction in case of an error
-    
+        cursor.connection.rollback()  # Roll back the transaction in case of an error
+
+# Column order used by the bulk insert paths, matches the Transaction constructor
+TRANSACTION_COLUMNS = ("transaction_id", "customer_id", "timestamp", "merchant_name", "category", "amount",
+                       "location", "card_type", "approval_status", "payment_method", "is_fraud", "note")
+
+# Helper function that turns a Transaction into a tuple in TRANSACTION_COLUMNS order
+def transaction_row(transaction):
+    return (transaction.transaction_id, transaction.customer_id, transaction.timestamp,
+            transaction.merchant_name, transaction.category, transaction.amount,
+            transaction.location, transaction.card_type, transaction.approval_status,
+            transaction.payment_method, transaction.is_fraud, transaction.note)
+
+# Helper function that streams a chunk of rows through COPY into a temporary staging table, then moves
+# them into the transactions table - returns the (transaction_id, customer_id, amount, location) of every row actually inserted
+def copy_transaction_chunk(cursor, rows):
+    staging_table = f"{TRANSACTIONS_TABLE}_staging"
+    # Staging rows are cleared automatically every time the chunk is committed
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS {staging_table} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+    """.format(staging_table=staging_table, table_name=TRANSACTIONS_TABLE))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert("COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+        staging_table=staging_table, columns=", ".join(TRANSACTION_COLUMNS)), buffer)
+
+    # Rows whose transaction_id already exists are skipped instead of being checked one by one
+    cursor.execute("""
+        INSERT INTO {table_name} ({columns})
+        SELECT {columns} FROM {staging_table}
+        ON CONFLICT (transaction_id) DO NOTHING
+        RETURNING transaction_id, customer_id, amount, location
+    """.format(table_name=TRANSACTIONS_TABLE, staging_table=staging_table, columns=", ".join(TRANSACTION_COLUMNS)))
+    return cursor.fetchall()
+
+# Helper function that inserts a chunk of rows with a multi-row INSERT, used when COPY is unavailable
+# Returns the (transaction_id, customer_id, amount, location) of every row actually inserted
+def insert_transaction_chunk(cursor, rows):
+    insert_sql = """
+        INSERT INTO {table_name} ({columns})
+        VALUES %s
+        ON CONFLICT (transaction_id) DO NOTHING
+        RETURNING transaction_id, customer_id, amount, location
+    """.format(table_name=TRANSACTIONS_TABLE, columns=", ".join(TRANSACTION_COLUMNS))
+    return execute_values(cursor, insert_sql, rows, page_size=len(rows), fetch=True)
+
+# Adds many transactions to the database at once, committing once per chunk
+# Streams each chunk through COPY, falling back to execute_values if COPY fails
+# Returns a dict with the number of transactions inserted and skipped as duplicates
+def add_transactions_bulk(cursor, transactions, chunk_size=BULK_INSERT_CHUNK_SIZE, use_copy=True):
+    counts = {"inserted": 0, "skipped": 0}
+    try:
+        for chunk in chunk_data(transactions, chunk_size):
+            rows = [transaction_row(transaction) for transaction in chunk]
+            if use_copy:
+                try:
+                    inserted = copy_transaction_chunk(cursor, rows)
+                except psycopg2.Error as e:
+                    print(f"COPY unavailable, falling back to execute_values: {e}")
+                    cursor.connection.rollback()
+                    use_copy = False
+            if not use_copy:
+                inserted = insert_transaction_chunk(cursor, rows)
+
+            # Add the new amounts and locations to the running statistics, then commit the chunk
+            record_amounts(cursor, [(row[1], row[2]) for row in inserted])
+            record_locations(cursor, [(row[1], row[3]) for row in inserted])
+            cursor.connection.commit()
+            transaction_id_registry.add([row[0] for row in inserted])
+            counts["inserted"] += len(inserted)
+            counts["skipped"] += len(rows) - len(inserted)
+
+        print(f"Bulk insert finished: {highlight('blue', counts['inserted'])} transaction(s) added, {highlight('blue', counts['skipped'])} already existed.")
+
+    except Exception as e:
+        print(f"Failed to bulk insert records into table: {e}")
+        cursor.connection.rollback()  # Roll back the current chunk, earlier chunks stay committed
+
+    return counts
+
 # Removes a transaction from database, allows for manual transaction deletion via provided transactionID
 def delete_transaction(cursor, transactionID):    
     try:
-        # Check if the transaction_id exists
-        check_sql = "SELECT 1 FROM {table_name} WHERE transaction_id = %s".format(table_name=TRANSACTIONS_TABLE)
-        cursor.execute(check_sql, (transactionID,))
-        result = cursor.fetchone()
+        # SQL FUNCTION to delete a transaction by transaction ID, no rows come back when it does not exist
+        remove_sql = "DELETE FROM {table_name} WHERE transaction_id = %s RETURNING customer_id, amount, location".format(table_name=TRANSACTIONS_TABLE)
+        # Execute the SQL Query
+        execute_prepared(cursor, remove_sql, (transactionID,))
+        removed = cursor.fetchall()
 
-        if result:
-            # SQL FUNCTION to delete a transaction by transaction ID
-            remove_sql = "DELETE FROM {table_name} WHERE transaction_id = %s".format(table_name=TRANSACTIONS_TABLE)
-            # Execute the SQL Query
-            cursor.execute(remove_sql, (transactionID,))
+        if removed:
+            # Remove the amount and location from the customer's running statistics
+            remove_amounts(cursor, [(customer_id, amount) for customer_id, amount, _ in removed])
+            remove_locations(cursor, [(customer_id, location) for customer_id, _, location in removed])
         
             # Commit the deletion
-            main_connection.commit()
-            print(f"Transaction ID: {highlight("blue",transactionID)} successfully removed from database!")
+            cursor.connection.commit()
+            transaction_id_registry.remove([transactionID])
+            print(f"Transaction ID: {highlight('blue', transactionID)} successfully removed from database!")
 
         else:
-            print(f"Transaction ID: {highlight("blue",transactionID)} is not in the database.")
+            print(f"Transaction ID: {highlight('blue', transactionID)} is not in the database.")
     
     except Exception as e:
         print(f"Failed to delete record from table: {e}")
-        main_connection.rollback()  # Roll back the transaction in case of an error
+        cursor.connection.rollback()  # Roll back the transaction in case of an error
 
 # Function to generate a randomized transaction - returns a Transaction
 def generate_transaction(cursor):
-    # Initialize Faker instance for generating realistic data
-    fake = Faker()
-
-    # Define list of expenditure categories
-    categories = [
-    "Groceries", "Dining", "Travel", "Retail", "Utilities", "Healthcare",
-    "Subscriptions", "Education", "Automobile", "Entertainment", "Charity",
-    "Insurance", "Miscellaneous", "Financial Services", "Luxury Items", "Night Club",
-    "Bar Service", "Gambling", "Car Rental"
-    ]
-    card_types = ["Visa", "Mastercard", "American Express", "Discover"]
-    approval_statuses = ["Approved", "Declined", "Pending"]
-    weights = [75, 10, 15]  # Corresponding to 75%, 10%, and 15%
-    payment_methods = ["Chip", "Swipe", "Contactless", "Online Payment", "Mobile Wallet"]
-    declined_notes = ["Insufficient Balance", "Expired Card", "Incorrect Security Code", "Card Not Activated", 
-                    "Invalid Card Number", "Suspended Card", "Do Not Honor", "Exceeded Credit Limit"]
-
-    # Probability of anomaly (used for location and amount)
-    anomaly_chance = 0.02  # 2%
+    # Categories, statuses, notes and amount ranges are the module constants shared with TransactionGenerator
 
     # Helper function to generate a unique transaction ID
+    # The ID registry answers for new IDs without a query, only possible matches are checked in the database
     def generate_unique_transaction_id():
         try:
-            while True:
-                # Generate a new transaction ID
-                transaction_id = str(uuid.uuid4()).replace('-', '')
-
-                # Check if the transaction_id exists
-                check_sql = "SELECT 1 FROM {table_name} WHERE transaction_id = %s".format(table_name=TRANSACTIONS_TABLE)
-                cursor.execute(check_sql, (transaction_id,))
-                result = cursor.fetchone()
-
-                if not result:  # If no match found
-                    return transaction_id  # Unique ID found, return it
+            return transaction_id_registry.new_id(cursor, lambda: str(uuid.uuid4()).replace('-', ''))
 
         except Exception as e:
             print(f"Error generating transaction ID: {e}")
@@ -221,68 +297,45 @@ def generate_transaction(cursor):
             print(f"Error generating customer ID: {e}")
             raise
 
-    thisCustomer = Customer(*fetch_customer()) # Unpack fetched customer into new customer object
+    # The fetched customer is cached, as the transaction is likely to be scored next - the load is registered before
+    # the query so a customer updated meanwhile is not cached stale
+    started = customer_cache.start_load()
+    try:
+        thisCustomer = Customer(*fetch_customer()) # Unpack fetched customer into new customer object
+    except Exception:
+        customer_cache.finish_load(started, {})
+        raise
+    customer_cache.finish_load(started, {thisCustomer.customer_id: thisCustomer})
 
     # Generate simulated transaction information
     transaction_id = generate_unique_transaction_id()
     customer_id = thisCustomer.customer_id
     timestamp = fake.date_time_this_decade().strftime('%Y-%m-%d %H:%M:%S')
     merchant_name = fake.company()
-    category = random.choice(categories)
-    if category in ["Night Club", "Bar Service", "Gambling", "Car Rental"]:
-        if thisCustomer.age < 21 or thisCustomer.age > 75:
-            if random.random() >= anomaly_chance:
+    category = random.choice(CATEGORIES)
+    if category in RESTRICTED_CATEGORIES:
+        if thisCustomer.age < MINIMUM_AGE or thisCustomer.age > 75:
+            if random.random() >= ANOMALY_CHANCE:
                 # Skip these categories for customers under 21 or over 75, unless anomaly occurs
-                category = random.choice([c for c in categories if c not in ["Night Club", "Bar Service", "Gambling"]])
+                category = random.choice(REDRAW_CATEGORIES)
 
-    if category in ["Groceries", "Utilities", "Charity", "Insurance", "Miscellaneous"]:
-        # 2% chance to generate an anomalous value for lower expense categories
-        if random.random() < anomaly_chance:
-            amount = round(random.uniform(1.0, 5000.0), 2)  # Anomalous range
-        else:
-            amount = round(random.uniform(10.00, 300.00), 2)  # Normal range
-    elif category in ["Dining", "Travel", "Retail", "Healthcare", "Subscriptions", "Education", 
-                    "Automobile", "Entertainment", "Luxury Items", "Financial Services"]:
-         # 2% chance to generate an anomalous value for higher expense categories
-        if random.random() < anomaly_chance:
-            amount = round(random.uniform(1.0, 10000.0), 2)  # Anomalous range
-        else:
-            if category == "Dining":
-                amount = round(random.uniform(50.00, 500.00), 2) # Normal range
-            elif category == "Travel":
-                amount = round(random.uniform(200.00, 3000.00), 2) # Normal range
-            elif category == "Retail":
-                amount = round(random.uniform(50.00, 500.00), 2) # Normal range
-            elif category == "Healthcare":
-                amount = round(random.uniform(100.00, 1500.00), 2) # Normal range
-            elif category == "Subscriptions":
-                amount = round(random.uniform(10.00, 100.00), 2) # Normal range
-            elif category == "Education":
-                amount = round(random.uniform(100.00, 2500.00), 2) # Normal range
-            elif category == "Automobile":
-                amount = round(random.uniform(200.00, 1000.00), 2) # Normal range
-            elif category == "Entertainment":
-                amount = round(random.uniform(20.00, 300.00), 2) # Normal range
-            elif category == "Luxury Items":
-                amount = round(random.uniform(100.00, 5000.00), 2) # Normal range
-            elif category == "Financial Services":
-                amount = round(random.uniform(10.00, 200.00), 2) # Normal range
-    elif category in ["Night Club", "Bar Service", "Gambling", "Car Rental"]:
-        if random.random() < anomaly_chance:
-            amount = round(random.uniform(5000.00, 10000.00), 2)  # Anomalous range
-        else:
-            amount = round(random.uniform(20.00, 500.00), 2)  # Normal for these categories
+    # 2% chance to generate an anomalous value, otherwise the category's normal range
+    normal_low, normal_high, anomaly_low, anomaly_high = AMOUNT_RANGES[category]
+    if random.random() < ANOMALY_CHANCE:
+        amount = round(random.uniform(anomaly_low, anomaly_high), 2)  # Anomalous range
+    else:
+        amount = round(random.uniform(normal_low, normal_high), 2)  # Normal range
     # If there's a chance for a new location, simulate it
-    if random.random() < anomaly_chance:
+    if random.random() < ANOMALY_CHANCE:
         location = f"{fake.city()}, {fake.state_abbr()}"
     else:
         location = thisCustomer.location  # Use the customer's common location
-    card_type = random.choice(card_types)
-    approval_status = random.choices(approval_statuses, weights, k=1)[0]
-    payment_method = random.choice(payment_methods)
+    card_type = random.choice(CARD_TYPES)
+    approval_status = random.choices(APPROVAL_STATUSES, APPROVAL_WEIGHTS, k=1)[0]
+    payment_method = random.choice(PAYMENT_METHODS)
     is_fraud = "Undetermined"
     if approval_status == "Declined":
-        note = random.choice(declined_notes)
+        note = random.choice(DECLINED_NOTES)
     else:
         note = None 
 
@@ -293,16 +346,34 @@ def generate_transaction(cursor):
 
 # Simulates a new transaction being added to database, as if a payment was processed
 def swipe_card():
-    # Generate a new random transaction
-    newTransaction = generate_transaction(main_cursor)
-    # Add transaction to database with add_transaction function
-    add_transaction(main_cursor, newTransaction)
+    # Check out a connection from the shared pool for this payment
+    with pooled_cursor() as cursor:
+        # Generate a new random transaction
+        newTransaction = generate_transaction(cursor)
+        # Add transaction to database with add_transaction function
+        add_transaction(cursor, newTransaction)
     return newTransaction
 
+# Simulates count payments at once for load testing, generating them in chunks and inserting them with add_transactions_bulk
+# A seed makes the generated transactions reproducible - returns the inserted and skipped counts
+def swipe_cards(count, seed=None, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    with pooled_cursor() as cursor:
+        generator = TransactionGenerator(cursor, seed=seed)
+        chunks = (generator.generate(min(chunk_size, count - start)) for start in range(0, count, chunk_size))
+        return add_transactions_bulk(cursor, (transaction for chunk in chunks for transaction in chunk), chunk_size=chunk_size)
+
 # Takes in a transaction and finds identical transactions
-def find_repeat_transactions(cursor, transaction):
+# window_minutes and amount_tolerance default to the current rule config
+def find_repeat_transactions(cursor, transaction, window_minutes=None, amount_tolerance=None):
+    rules = get_rule_config()
+    window_minutes = rules.duplicate_window_minutes if window_minutes is None else window_minutes
+    amount_tolerance = rules.duplicate_amount_tolerance if amount_tolerance is None else amount_tolerance
     try:
         # SQL query to find repeat transactions, and isnt the same transaction as the one being checked
+        # Only transactions within window_minutes and amount_tolerance count, so the lookup is a bounded range scan
+        # on the duplicate lookup index no matter how long the customer's history is
+        # Amounts are compared as numeric in whole cents, as double precision an exact one-cent difference can exceed a 0.01
+        # tolerance, and an amount carrying float error (0.1 + 0.2) still matches the 0.30 it stands for, like the Spark join
         find_transactions_sql = """
             SELECT transaction_id
             FROM {table_name}
@@ -310,11 +381,15 @@ def find_repeat_transactions(cursor, transaction):
                 AND merchant_name = %s
                 AND location = %s
                 AND card_type = %s
+                AND timestamp BETWEEN %s::timestamp - make_interval(mins => %s) AND %s::timestamp + make_interval(mins => %s)
+                AND abs(round(amount, 2) - round(%s::numeric, 2)) <= %s::numeric
                 AND transaction_id != %s
         """.format(table_name=TRANSACTIONS_TABLE)
 
         # Execute the SQL query to find duplicate transactions
-        cursor.execute(find_transactions_sql, (transaction.customer_id, transaction.merchant_name, transaction.location, transaction.card_type, transaction.transaction_id,))
+        cursor.execute(find_transactions_sql, (transaction.customer_id, transaction.merchant_name, transaction.location, transaction.card_type,
+                                               transaction.timestamp, window_minutes, transaction.timestamp, window_minutes,
+                                               transaction.amount, amount_tolerance, transaction.transaction_id,))
         duplicate_transactions = cursor.fetchall()
         
         # Return duplicate transactions for further analysis
@@ -324,6 +399,46 @@ def find_repeat_transactions(cursor, transaction):
         print(f"Unable to find transaction: {e}")
         return []
 
+# Batch version of find_repeat_transactions - finds the duplicates of every transaction with one joined query
+# Returns a dict of transaction_id -> list of (duplicate transaction_id,) tuples
+def find_repeat_transactions_bulk(cursor, transactions, window_minutes=None, amount_tolerance=None):
+    rules = get_rule_config()
+    window_minutes = rules.duplicate_window_minutes if window_minutes is None else window_minutes
+    amount_tolerance = rules.duplicate_amount_tolerance if amount_tolerance is None else amount_tolerance
+    duplicates = {transaction.transaction_id: [] for transaction in transactions}
+    if not duplicates:
+        return duplicates
+    duplicates_sql = """
+        SELECT v.transaction_id, t.transaction_id
+        FROM (VALUES %s) AS v(transaction_id, customer_id, merchant_name, location, card_type, timestamp, amount, window_minutes, amount_tolerance)
+        JOIN {table_name} AS t
+            ON t.customer_id = v.customer_id
+            AND t.merchant_name = v.merchant_name
+            AND t.location = v.location
+            AND t.card_type = v.card_type
+            AND t.timestamp BETWEEN v.timestamp - make_interval(mins => v.window_minutes) AND v.timestamp + make_interval(mins => v.window_minutes)
+            AND abs(round(t.amount, 2) - round(v.amount, 2)) <= v.amount_tolerance
+            AND t.transaction_id != v.transaction_id
+    """.format(table_name=TRANSACTIONS_TABLE)
+    duplicate_rows = execute_values(cursor, duplicates_sql, [
+        (transaction.transaction_id, transaction.customer_id, transaction.merchant_name, transaction.location,
+         transaction.card_type, transaction.timestamp, transaction.amount, window_minutes, amount_tolerance)
+        for transaction in transactions],
+        template="(%s, %s, %s, %s, %s, %s::timestamp, %s::numeric, %s::integer, %s::numeric)",
+        page_size=len(transactions), fetch=True)
+    for transaction_id, duplicate_id in duplicate_rows:
+        duplicates[transaction_id].append((duplicate_id,))
+    return duplicates
+
+# Creates the composite index that backs find_repeat_transactions, safe to run more than once
+def create_duplicate_index(cursor):
+    index_sql = """
+        CREATE INDEX IF NOT EXISTS {table_name}_duplicate_lookup
+        ON {table_name} (customer_id, merchant_name, location, card_type, timestamp)
+    """.format(table_name=TRANSACTIONS_TABLE)
+    cursor.execute(index_sql)
+    cursor.connection.commit()
+
 # Calculates the average amount of money spent by customer
 def calculate_avg_spent(cursor, customerID):
     try:
@@ -346,108 +461,121 @@ def calculate_avg_spent(cursor, customerID):
         return 0.0
 
 # Takes in a customer_id and finds the average amount of money spent by customer to help with Z-Score
+# Reads the running statistics kept by spending_stats instead of aggregating the customer's whole history
 def calculate_average_and_std_dev(cursor, customerID):
     try:
-        avg_std_query_sql = """
-            SELECT AVG(amount) AS avg_amount, 
-                   STDDEV_SAMP(amount) AS std_dev
-            FROM {table_name}
-            WHERE customer_id = %s AND amount IS NOT NULL
-        """.format(table_name=TRANSACTIONS_TABLE)
-
-        cursor.execute(avg_std_query_sql, (customerID,))
-        result = cursor.fetchone()
-
-        if result:
-            # Ensure values are properly converted to float, handling potential Decimal type
-            avg_amount = float(result[0]) if result[0] is not None else 0.0
-            std_dev = float(result[1]) if result[1] is not None else 0.0
-            return avg_amount, std_dev
-        else:
-            return 0.0, 0.0
+        return get_spending_stats(cursor, customerID)
 
     except Exception as e:
         print(f"Error calculating average and standard deviation for customer_id {customerID}: {e}")
         return 0.0, 0.0
 
+# Query that finds transactions with NULL or placeholder timestamps
+MISSING_TIMESTAMP_SQL = "SELECT * FROM {table_name} WHERE timestamp IS NULL OR timestamp = '1970-01-01'".format(table_name=TRANSACTIONS_TABLE)
+
+# Yields every transaction with a NULL or placeholder timestamp through a server-side cursor, so memory use stays constant
+def stream_missing_timestamps(cursor, itersize=STREAM_ITERSIZE, withhold=False):
+    for row in stream_rows(cursor, MISSING_TIMESTAMP_SQL, itersize=itersize, withhold=withhold):
+        yield Transaction(*row)
+
 # Checks datetime of each transaction for NULL or placeholder value and asks user to update value
 def timestamp_check(cursor):
     try:
-        # SQL query to find transactions with placeholder or NULL values
-        find_null_timestamps = """
-                                SELECT * 
-                                FROM {table_name}
-                                WHERE timestamp IS NULL OR timestamp = '1970-01-01'
-                                """.format(table_name=TRANSACTIONS_TABLE)
-        # Execute the SQL Query
-        cursor.execute(find_null_timestamps)
-        missing_timestamps = cursor.fetchall()
-
-        # If there are missing timestamps, prompt user to update
-        if missing_timestamps:
-            print(f"Transactions found with NULL or placeholder timestamps.")
-            for transaction in missing_timestamps:
-                transaction_id = transaction[0]
-                print(f"Transaction ID: {highlight("blue",transaction_id)} has a missing timestamp.")
-                user_input = input(f"Please enter a valid timestamp for Transaction ID: {highlight("blue",transaction_id)}: ")
-                if user_input:
-                    try:
-                        new_timestamp = datetime.strptime(user_input, '%Y-%m-%d %H:%M:%S')
-                        # Update the transaction's timestamp in the database
-                        update_sql = """
-                            UPDATE {table_name}
-                            SET timestamp = %s
-                            WHERE transaction_id = %s
-                            """.format(table_name=TRANSACTIONS_TABLE)
-                        # Execute the SQL Query
-                        cursor.execute(update_sql, (new_timestamp, transaction_id,))
-
-                        # Commit the transaction
-                        main_connection.commit()
-                        print(f"Transaction ID: {highlight("blue",transaction_id)} updated successfully.")
-                    except ValueError:
-                        print("Invalid date format. Please use 'YYYY-MM-DD HH:MM:SS'.")
-                else:
-                    print(f"No input received for Transaction ID: {highlight("blue",transaction_id)}. Skipping update.")
+        # Stream transactions with placeholder or NULL values, held open across the commit after each update
+        found = False
+        for transaction in stream_missing_timestamps(cursor, withhold=True):
+            # If there are missing timestamps, prompt user to update
+            if not found:
+                print(f"Transactions found with NULL or placeholder timestamps.")
+                found = True
+            transaction_id = transaction.transaction_id
+            print(f"Transaction ID: {highlight("blue",transaction_id)} has a missing timestamp.")
+            user_input = input(f"Please enter a valid timestamp for Transaction ID: {highlight("blue",transaction_id)}: ")
+            if user_input:
+                try:
+                    new_timestamp = datetime.strptime(user_input, '%Y-%m-%d %H:%M:%S')
+                    # Update the transaction's timestamp in the database
+                    update_sql = """
+                        UPDATE {table_name}
+                        SET timestamp = %s
+                        WHERE transaction_id = %s
+                        """.format(table_name=TRANSACTIONS_TABLE)
+                    # Execute the SQL Query
+                    cursor.execute(update_sql, (new_timestamp, transaction_id,))
+
+                    # Commit the transaction
+                    cursor.connection.commit()
+                    print(f"Transaction ID: {highlight("blue",transaction_id)} updated successfully.")
+                except ValueError:
+                    print("Invalid date format. Please use 'YYYY-MM-DD HH:MM:SS'.")
+            else:
+                print(f"No input received for Transaction ID: {highlight("blue",transaction_id)}. Skipping update.")
 
-        else:
+        if not found:
             print("No transactions found with missing timestamps.")
                     
     except Exception as e:
         print(f"Error updating transactions: {e}")
-        main_connection.rollback()  # Roll back in case of an error
+        cursor.connection.rollback()  # Roll back in case of an error
+
+# Non-interactive version of timestamp_check for large tables - returns the number of transactions updated
+# rule is a function that takes a Transaction and returns its new timestamp (None skips it), or one timestamp for every row
+# mapping_file is a CSV of transaction_id,timestamp with a header line
+# New timestamps are staged in a temporary table and applied with a single UPDATE, streaming keeps memory constant
+def repair_timestamps(cursor, rule=None, mapping_file=None, chunk_size=STREAM_ITERSIZE):
+    if (rule is None) == (mapping_file is None):
+        raise ValueError("Pass either a rule or a mapping_file")
+    try:
+        cursor.execute("CREATE TEMP TABLE timestamp_repairs (transaction_id VARCHAR PRIMARY KEY, timestamp TIMESTAMP) ON COMMIT DROP")
+        if mapping_file is not None:
+            # Load the CSV mapping straight into the staging table
+            with open(mapping_file, newline="") as file:
+                cursor.copy_expert("COPY timestamp_repairs (transaction_id, timestamp) FROM STDIN WITH (FORMAT csv, HEADER true)", file)
+        else:
+            # Apply the rule to each streamed transaction and stage the results a chunk at a time
+            new_timestamp = rule if callable(rule) else (lambda transaction: rule)
+            for chunk in chunk_data(stream_missing_timestamps(cursor, itersize=chunk_size), chunk_size):
+                repairs = [(transaction.transaction_id, new_timestamp(transaction)) for transaction in chunk]
+                repairs = [repair for repair in repairs if repair[1] is not None]
+                if repairs:
+                    execute_values(cursor, "INSERT INTO timestamp_repairs (transaction_id, timestamp) VALUES %s", repairs, page_size=chunk_size)
+
+        # Apply every staged timestamp at once, only to rows that are still missing one
+        update_sql = """
+            UPDATE {table_name} AS t
+            SET timestamp = r.timestamp
+            FROM timestamp_repairs AS r
+            WHERE t.transaction_id = r.transaction_id
+                AND (t.timestamp IS NULL OR t.timestamp = '1970-01-01')
+        """.format(table_name=TRANSACTIONS_TABLE)
+        cursor.execute(update_sql)
+        updated = cursor.rowcount
+        # Scores are looked up by their transaction's timestamp, so they follow the repaired ones
+        ensure_table(cursor, TRANSACTION_SCORES_TABLE, create_missing_scores_table)
+        cursor.execute("""
+            UPDATE {scores_table} AS s
+            SET transaction_ts = t.timestamp
+            FROM timestamp_repairs AS r
+            JOIN {table_name} AS t ON t.transaction_id = r.transaction_id
+            WHERE s.transaction_id = r.transaction_id AND s.transaction_ts IS DISTINCT FROM t.timestamp
+        """.format(scores_table=TRANSACTION_SCORES_TABLE, table_name=TRANSACTIONS_TABLE))
+        cursor.connection.commit()
+        print(f"Timestamp repair finished: {highlight('blue', updated)} transaction(s) updated.")
+        return updated
+
+    except Exception as e:
+        print(f"Error repairing timestamps: {e}")
+        cursor.connection.rollback()
+        return False
 
 # Helper function to check if a transaction's category is within the expected bounds - returns False if not
-def is_amount_valid(transaction):
+# Bounds come from rules, the current rule config when None
+def is_amount_valid(transaction, rules=None):
     category = transaction.category
     amount = transaction.amount
 
-    # Category bounds for each category (including "Other")
-    category_bounds = {
-        "Groceries": 300.00,
-        "Utilities": 300.00,
-        "Charity": 300.00,
-        "Insurance": 300.00,
-        "Miscellaneous": 300.00,
-        "Dining": 500.00,
-        "Travel": 3000.00,
-        "Retail": 500.00,
-        "Healthcare": 1500.00,
-        "Subscriptions": 100.00,
-        "Education": 2500.00,
-        "Automobile": 1000.00,
-        "Entertainment": 300.00,
-        "Luxury Items": 5000.00,
-        "Financial Services": 200.00,
-        "Night Club": 500.00, 
-        "Bar Service": 500.00, 
-        "Gambling": 500.00, 
-        "Car Rental": 500.00,
-        "Other": 500.00  # Max value for unexpected categories
-    }
-
     # Use "Other" as a fallback for any unexpected category
-    max_allowed = category_bounds.get(category, category_bounds["Other"])
+    max_allowed = (rules or get_rule_config()).max_amount(category)
     
     # If amount is less than or equal to max_allowed, return True
     return amount <= max_allowed
@@ -473,6 +601,118 @@ def notify_customer(cursor, transaction):
     except Exception as e:
         print(f"Error retrieving declined transactions for Customer ID: {highlight("blue",transaction.customer_id)}: {e}")
 
+# Checks whether a transaction should go through fraud analysis - positive amount, undetermined status, approved or pending
+# force also accepts transactions that already have a verdict, for rescoring history
+def is_scoreable(transaction, force=False):
+    return (transaction.amount > 0
+            and (force or transaction.is_fraud in ("Undetermined", None))
+            and transaction.approval_status in ["Pending", "Approved"])
+
+# Data loaders for the fraud rules - each is called at most once per transaction, and only if a rule needs it
+@fraud_rules.loader("spending_stats")
+def load_spending_stats(cursor, transaction):
+    return calculate_average_and_std_dev(cursor, transaction.customer_id)
+
+@fraud_rules.loader("duplicates")
+def load_duplicates(cursor, transaction):
+    return find_repeat_transactions(cursor, transaction)
+
+@fraud_rules.loader("location_profile")
+def load_location_profile(cursor, transaction):
+    return load_location_profiles_bulk(cursor, [transaction])[transaction.transaction_id]
+
+@fraud_rules.loader("customer_age")
+def load_customer_age(cursor, transaction):
+    return find_customer_age(cursor, transaction.customer_id)
+
+# Batch versions of the loaders used by flag_fraud_batch - one set-based query per chunk, returns {transaction_id: value}
+@fraud_rules.loader("spending_stats", batch=True)
+def load_spending_stats_bulk(cursor, transactions):
+    customer_stats = get_spending_stats_bulk(cursor, list({transaction.customer_id for transaction in transactions}))
+    return {transaction.transaction_id: customer_stats.get(transaction.customer_id, (0.0, 0.0)) for transaction in transactions}
+
+@fraud_rules.loader("duplicates", batch=True)
+def load_duplicates_bulk(cursor, transactions):
+    return find_repeat_transactions_bulk(cursor, transactions)
+
+# Home location from the customer cache plus the customer's top-K location counts
+@fraud_rules.loader("location_profile", batch=True)
+def load_location_profiles_bulk(cursor, transactions):
+    customer_ids = list({transaction.customer_id for transaction in transactions})
+    customers = customer_cache.get_many(cursor, customer_ids)
+    counts = get_location_counts_bulk(cursor, customer_ids, get_rule_config().location_top_k)
+    profiles = {customer_id: LocationProfile(customers[customer_id].location if customers[customer_id] else "Unknown", *counts.get(customer_id, ()))
+                for customer_id in customer_ids}
+    return {transaction.transaction_id: profiles[transaction.customer_id] for transaction in transactions}
+
+@fraud_rules.loader("customer_age", batch=True)
+def load_customer_age_bulk(cursor, transactions):
+    customers = customer_cache.get_many(cursor, [transaction.customer_id for transaction in transactions])
+    return {transaction.transaction_id: customers[transaction.customer_id].age if customers[transaction.customer_id] else 0
+            for transaction in transactions}
+
+# FRAUD RULES - cost orders them cheapest first: pure checks, then cached customer data, then database lookups
+
+# If the transaction amount is outside the max bound for the transaction category
+@fraud_rules.rule("amount_bounds", cost=0)
+def amount_bounds_rule(transaction, data):
+    if not is_amount_valid(transaction, data.rules):
+        data.params["max_amount"] = data.rules.max_amount(transaction.category)
+        return f"Transaction Amount: {highlight('blue', '$')}{highlight('blue', transaction.amount)} out of bounds for Category: {highlight('blue', transaction.category)}"
+
+# If the transaction has an unexpected category for customer's age
+@fraud_rules.rule("age_category", cost=1, requires=("customer_age",))
+def age_category_rule(transaction, data):
+    if transaction.category in data.rules.age_restricted and data["customer_age"] < data.rules.minimum_age:
+        data.params["customer_age"] = data["customer_age"]
+        return f"Unexpected Category: {highlight('blue', transaction.category)} for customer's age: {highlight('blue', str(data['customer_age']))}"
+
+# If the transaction is away from the customer's home and the locations they use most
+@fraud_rules.rule("location", cost=1, requires=("location_profile",))
+def location_rule(transaction, data):
+    profile = data["location_profile"]
+    if profile.share(transaction.location) < data.rules.location_min_share:
+        data.params["location_share"] = round(profile.share(transaction.location), 4)
+        return f"Location anomaly: {highlight('blue', transaction.location)} (Expected: {highlight('blue', ', '.join(profile.expected_locations()))}, anomaly score {highlight('blue', f'{profile.anomaly_score(transaction.location):.2f}')})"
+
+# If the transaction amount is outside of the normal standard deviation, based on Z-Score calculation
+@fraud_rules.rule("z_score", cost=2, requires=("spending_stats",))
+def z_score_rule(transaction, data):
+    avg_spent, std_dev = data["spending_stats"]
+    if std_dev > 0:  # Ensure we don't divide by zero
+        z_score = (float(transaction.amount) - avg_spent) / std_dev
+        if abs(z_score) > data.rules.z_score_threshold:
+            data.params["z_score"] = round(z_score, 4)
+            return f"Outlier in spending: Amount {highlight('blue', '$')}{highlight('blue', transaction.amount)}, Z-Score: {highlight('blue', f'{z_score:.2f}')}"
+
+# If the transaction is identical to another transaction
+@fraud_rules.rule("duplicates", cost=3, requires=("duplicates",))
+def duplicates_rule(transaction, data):
+    duplicates = data["duplicates"]
+    if len(duplicates) > 0:  # If it finds one or more duplicate transactions, print all duplicate transaction id's
+        data.params["duplicate_count"] = len(duplicates)
+        return f"Duplicate transaction. Found {highlight('blue', len(duplicates))} identical transaction(s): {highlight('blue', ', '.join([dup[0] for dup in duplicates]))}"
+
+# Applies every fraud rule to a transaction using already fetched customer data - returns the fraud_score and list of reasons
+# common_location is a LocationProfile, or just the customer's home location when no location counts are at hand
+# rules is the RuleConfig to evaluate with, the current one when None
+def evaluate_fraud_rules(transaction, avg_spent, std_dev, duplicates, common_location, customer_age, threshold=None, rules=None):
+    location_profile = common_location if isinstance(common_location, LocationProfile) else LocationProfile(common_location)
+    prefetched = {"spending_stats": (avg_spent, std_dev), "duplicates": duplicates,
+                  "location_profile": location_profile, "customer_age": customer_age}
+    return fraud_rules.evaluate(None, transaction, prefetched, threshold, rules)
+
+# Saves a transaction's verdict, fraud score and reason codes - only is_fraud changes, so the rest of the row is left alone
+# With VERDICT_WRITE_BEHIND the verdict is queued for the background writer instead of being committed here,
+# call verdict_writer.flush() before reading verdicts back
+def save_verdict(cursor, transaction, fraud_score, rules, reason_mask=0, params=None):
+    if VERDICT_WRITE_BEHIND:
+        if not verdict_writer.submit(transaction.transaction_id, transaction.is_fraud, fraud_score, rules.version, reason_mask, params, cursor):
+            cursor.connection.commit()  # The queue was full and the verdict was written on this cursor instead
+    else:
+        write_verdicts(cursor, [(transaction.transaction_id, transaction.is_fraud, fraud_score, rules.version, reason_mask, params)])
+        cursor.connection.commit()
+
 # Main Function that takes a transaction and determines fraudulence based on logic and defined rules
 def flag_fraud(cursor, transaction):
     try:
@@ -482,47 +722,16 @@ def flag_fraud(cursor, transaction):
             if transaction.is_fraud in ("Undetermined", None):
                 # Apply fraud detection logic only to transactions that are approved or pending
                 if transaction.approval_status in ["Pending", "Approved"]:
-                    reasons = []  # Collect fraud reasons here
-                    fraud_score = 0  # Assignment of a fraud_score based on how many flags are found
-
-                    # FRAUD LOGIC BEGINS
-                    # Check for various fraud conditions
-
-                    # If the transaction amount is outside the max bound for the transaction category
-                    if not is_amount_valid(transaction):
-                        reasons.append(f"Transaction Amount: {highlight('blue', '$')}{highlight('blue', transaction.amount)} out of bounds for Category: {highlight("blue",transaction.category)}")
-                        fraud_score += 1
-
-                    # If the transaction amount is outside of the normal standard deviation, based on Z-Score calculation
-                    avg_spent, std_dev = calculate_average_and_std_dev(cursor, transaction.customer_id)
-                    if std_dev > 0:  # Ensure we don't divide by zero
-                        z_score = (float(transaction.amount) - avg_spent) / std_dev
-                        if abs(z_score) > 2.0:
-                            reasons.append(f"Outlier in spending: Amount {highlight('blue', '$')}{highlight('blue', transaction.amount)}, Z-Score: {highlight('blue', f'{z_score:.2f}')}")
-                            fraud_score += 1
-
-                    # If the transaction is identical to another transaction
-                    duplicates = find_repeat_transactions(cursor, transaction)
-                    if len(duplicates) > 0: # If it finds one or more duplicate transactions, print all duplicate transaction id's
-                        reasons.append(f"Duplicate transaction. Found {highlight('blue', len(duplicates))} identical transaction(s): {highlight('blue', ', '.join([dup[0] for dup in duplicates]))}")
-                        fraud_score += 1
-
-                    # If the transaction is outside the customer's common location
-                    common_location = find_customer_location(cursor, transaction.customer_id)
-                    if transaction.location not in [common_location, "Unknown"]:
-                        reasons.append(f"Location anomaly: {highlight("blue",transaction.location)} (Expected: {highlight("blue",common_location)})")
-                        fraud_score += 1
-                    
-                    # If the transaction has an unexpected category for customer's age
-                    customer_age = find_customer_age(cursor, transaction.customer_id)
-                    if customer_age < 21 and transaction.category in ["Night Club", "Bar Service", "Gambling", "Car Rental"]:
-                        reasons.append(f"Unexpected Category: {highlight("blue",transaction.category)} for customer's age: {highlight("blue",str(customer_age))}")
-                        fraud_score += 1
+                    # FRAUD LOGIC BEGINS - rules load the customer data they need as they run
+                    rules = get_rule_config()
+                    with metrics.track("flag_fraud"):
+                        fraud_score, reasons, reason_mask, params = fraud_rules.evaluate_detailed(cursor, transaction, rules=rules)
+                    metrics.inc("cardguard_transactions_scored_total", "Transactions scored", verdict="FRAUD" if reasons else "NOT FRAUD")
 
                     # Set fraud status if any reasons were found, and display all flags to user
                     if reasons:
                         transaction.set_fraud("FRAUD")
-                        update_transaction(cursor, transaction)
+                        save_verdict(cursor, transaction, fraud_score, rules, reason_mask, params)
                         print(f"Transaction ID: {highlight("blue",transaction.transaction_id)} marked as {highlight("red",transaction.is_fraud)} with a fraud score of: {highlight("yellow",fraud_score)} due to the following reasons:")
                         for reason in reasons:
                             print(f"{highlight("blue","-")} {reason}")
@@ -531,7 +740,7 @@ def flag_fraud(cursor, transaction):
                     # If no fraud reasons, mark as Not Fraud
                     transaction.set_fraud("NOT FRAUD")
                     print(f"Transaction ID: {highlight("blue",transaction.transaction_id)} marked as {highlight("green",transaction.is_fraud)} with a fraud score of: {highlight("yellow",fraud_score)} after analysis.")
-                    update_transaction(cursor, transaction)
+                    save_verdict(cursor, transaction, fraud_score, rules, reason_mask, params)
                     return 0
                 else:
                     print(f"Transaction ID: {highlight("blue",transaction.transaction_id)} will not be processed. Transaction was marked as {highlight("blue","Declined")}. Declination Note: {highlight("blue",transaction.note)}")
@@ -545,12 +754,62 @@ def flag_fraud(cursor, transaction):
 
     except Exception as e:
         print(f"Error processing transaction: {e}")
-        main_connection.rollback()
+        cursor.connection.rollback()
+        return False  # Ensure no further processing
+
+# Scores a list of scoreable transactions and writes their verdicts and scores in bulk, without committing
+# so callers can commit them together with other work - returns a dict of transaction_id -> fraud_score
+def score_batch(cursor, batch, rules):
+    # Load the data every rule needs with one set-based query per loader
+    prefetched = fraud_rules.prefetch(cursor, batch)
+
+    # Evaluate every rule in memory
+    scores = {}
+    verdicts = []
+    for transaction in batch:
+        fraud_score, reasons, reason_mask, params = fraud_rules.evaluate_detailed(cursor, transaction, prefetched[transaction.transaction_id], rules=rules)
+        transaction.set_fraud("FRAUD" if reasons else "NOT FRAUD")
+        verdicts.append((transaction.transaction_id, transaction.is_fraud, fraud_score, rules.version, reason_mask, params))
+        scores[transaction.transaction_id] = fraud_score
+
+    # Write every verdict back with a single UPDATE
+    write_verdicts(cursor, verdicts)
+    flagged = sum(1 for verdict in verdicts if verdict[1] == "FRAUD")
+    metrics.inc("cardguard_transactions_scored_total", "Transactions scored", flagged, verdict="FRAUD")
+    metrics.inc("cardguard_transactions_scored_total", "Transactions scored", len(verdicts) - flagged, verdict="NOT FRAUD")
+    return scores
+
+# Batch version of flag_fraud - scores a list of transactions with a fixed number of set-based queries per chunk
+# Returns a dict of transaction_id -> fraud_score for every transaction that was scored
+# force rescores transactions that already have a verdict, replacing it
+def flag_fraud_batch(cursor, transactions, chunk_size=1000, force=False):
+    try:
+        rules = get_rule_config()  # One rule config for the whole batch
+        scores = {}
+        skipped = 0
+        for chunk in chunk_data(list(transactions), chunk_size):
+            # Only score transactions that flag_fraud would process, the rest are left untouched
+            batch = [transaction for transaction in chunk if is_scoreable(transaction, force)]
+            skipped += len(chunk) - len(batch)
+            if not batch:
+                continue
+
+            scores.update(score_batch(cursor, batch, rules))
+            cursor.connection.commit()
+
+        flagged = sum(1 for score in scores.values() if score > 0)
+        print(f"Batch scored {highlight("blue",len(scores))} transaction(s): {highlight("red",flagged)} marked as FRAUD, {highlight("green",len(scores) - flagged)} marked as NOT FRAUD, {highlight("blue",skipped)} skipped.")
+        return scores
+
+    except Exception as e:
+        print(f"Error processing transaction batch: {e}")
+        cursor.connection.rollback()
         return False  # Ensure no further processing
 
 
 
 # TESTING FRAUD FLAGS
+# Run a test inside 'with pooled_cursor() as main_cursor:' to give it a connection from the pool
 
 # TEST 1: Amount = 0
 '''
@@ -708,17 +967,3 @@ testCharge.location = testCustomer.location
 flag_fraud(main_cursor, testCharge)
 delete_transaction(main_cursor, testCharge.transaction_id)
 '''
-
-
-
-
-
-
-
-
-
-
-
-
-# Close the connection to the PostgreSQL database
-database_close(main_connection, main_cursor)
\ No newline at end of file
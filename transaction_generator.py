@@ -0,0 +1,152 @@
+# CARD GUARD
+# Transaction Generator
+# Vectorized version of generate_transaction for load testing - loads the customer roster once,
+# reuses one seeded Faker and NumPy random generator, and draws every field for N transactions at once
+
+# Import libraries
+from config import *
+from models import *
+from utils import *
+from datetime import datetime
+import uuid
+import numpy as np
+from faker import Faker
+
+# Same categories, statuses and probabilities as generate_transaction
+CATEGORIES = (
+    "Groceries", "Dining", "Travel", "Retail", "Utilities", "Healthcare",
+    "Subscriptions", "Education", "Automobile", "Entertainment", "Charity",
+    "Insurance", "Miscellaneous", "Financial Services", "Luxury Items", "Night Club",
+    "Bar Service", "Gambling", "Car Rental"
+)
+RESTRICTED_CATEGORIES = AGE_RESTRICTED_CATEGORIES  # The default restricted list of the age/category fraud rule
+# Categories a too young or too old customer can be redrawn into - none of the restricted ones
+REDRAW_CATEGORIES = tuple(c for c in CATEGORIES if c not in RESTRICTED_CATEGORIES)
+CARD_TYPES = ("Visa", "Mastercard", "American Express", "Discover")
+APPROVAL_STATUSES = ("Approved", "Declined", "Pending")
+APPROVAL_WEIGHTS = (0.75, 0.10, 0.15)
+PAYMENT_METHODS = ("Chip", "Swipe", "Contactless", "Online Payment", "Mobile Wallet")
+DECLINED_NOTES = ("Insufficient Balance", "Expired Card", "Incorrect Security Code", "Card Not Activated",
+                  "Invalid Card Number", "Suspended Card", "Do Not Honor", "Exceeded Credit Limit")
+ANOMALY_CHANCE = 0.02  # 2%
+
+# (normal low, normal high, anomalous low, anomalous high) amount range for each category
+AMOUNT_RANGES = {
+    "Groceries": (10.00, 300.00, 1.0, 5000.0),
+    "Utilities": (10.00, 300.00, 1.0, 5000.0),
+    "Charity": (10.00, 300.00, 1.0, 5000.0),
+    "Insurance": (10.00, 300.00, 1.0, 5000.0),
+    "Miscellaneous": (10.00, 300.00, 1.0, 5000.0),
+    "Dining": (50.00, 500.00, 1.0, 10000.0),
+    "Travel": (200.00, 3000.00, 1.0, 10000.0),
+    "Retail": (50.00, 500.00, 1.0, 10000.0),
+    "Healthcare": (100.00, 1500.00, 1.0, 10000.0),
+    "Subscriptions": (10.00, 100.00, 1.0, 10000.0),
+    "Education": (100.00, 2500.00, 1.0, 10000.0),
+    "Automobile": (200.00, 1000.00, 1.0, 10000.0),
+    "Entertainment": (20.00, 300.00, 1.0, 10000.0),
+    "Luxury Items": (100.00, 5000.00, 1.0, 10000.0),
+    "Financial Services": (10.00, 200.00, 1.0, 10000.0),
+    "Night Club": (20.00, 500.00, 5000.00, 10000.00),
+    "Bar Service": (20.00, 500.00, 5000.00, 10000.00),
+    "Gambling": (20.00, 500.00, 5000.00, 10000.00),
+    "Car Rental": (20.00, 500.00, 5000.00, 10000.00),
+}
+
+# Timestamps of seeded generators end here unless a reference_time is given, so a seed means the same data on any day
+SEEDED_REFERENCE_TIME = datetime(2025, 1, 1)
+
+# Generates batches of realistic transactions without touching the database after the roster is loaded
+class TransactionGenerator:
+    # Loads the customer roster and pre-generates pools of Faker values, seed makes every batch reproducible
+    # Timestamps fall between the start of reference_time's decade and reference_time - now for unseeded generators
+    def __init__(self, cursor, seed=None, pool_size=1000, reference_time=None):
+        self.rng = np.random.default_rng(seed)
+        if reference_time is None:
+            reference_time = SEEDED_REFERENCE_TIME if seed is not None else datetime.now()
+        self.reference_time = reference_time.replace(microsecond=0)
+        self.fake = Faker()
+        if seed is not None:
+            self.fake.seed_instance(seed)
+
+        # Load every customer once instead of an ORDER BY RANDOM() query per transaction, in a fixed order for the seed
+        roster_sql = "SELECT customer_id, age, location FROM {table_name} ORDER BY customer_id".format(table_name=CUSTOMERS_TABLE)
+        cursor.execute(roster_sql)
+        roster = cursor.fetchall()
+        if not roster:
+            raise ValueError("No customer IDs found in the database.")
+        self.customer_ids = np.array([row[0] for row in roster], dtype=object)
+        self.customer_ages = np.array([row[1] if row[1] is not None else 0 for row in roster], dtype=np.int64)
+        self.customer_locations = np.array([row[2] for row in roster], dtype=object)
+
+        # Faker is slow per call, so merchants and travel locations are sampled from pre-generated pools
+        self.merchants = np.array([self.fake.company() for _ in range(pool_size)], dtype=object)
+        self.cities = np.array([f"{self.fake.city()}, {self.fake.state_abbr()}" for _ in range(pool_size)], dtype=object)
+
+        # Lookup tables indexed by category id
+        self.categories = np.array(CATEGORIES, dtype=object)
+        ranges = np.array([AMOUNT_RANGES[category] for category in CATEGORIES])
+        self.normal_low, self.normal_high, self.anomaly_low, self.anomaly_high = ranges.T
+        self.restricted_ids = np.array([CATEGORIES.index(c) for c in RESTRICTED_CATEGORIES])
+        self.redraw_ids = np.array([CATEGORIES.index(c) for c in REDRAW_CATEGORIES])
+
+    # Draws timestamps uniformly between the start of the reference time's decade and the reference time, like Faker's
+    # date_time_this_decade
+    def _timestamps(self, count):
+        end = self.reference_time
+        decade_start = datetime(end.year - end.year % 10, 1, 1)
+        seconds = self.rng.integers(0, max(int((end - decade_start).total_seconds()), 1), size=count)
+        stamps = np.datetime64(decade_start, "s") + seconds.astype("timedelta64[s]")
+        return np.char.replace(np.datetime_as_string(stamps, unit="s"), "T", " ")
+
+    # Generates count transactions at once - returns a list of Transaction objects
+    def generate(self, count):
+        rng = self.rng
+
+        # Pick customers and categories
+        customer_index = rng.integers(0, len(self.customer_ids), size=count)
+        ages = self.customer_ages[customer_index]
+        category_ids = rng.integers(0, len(CATEGORIES), size=count)
+
+        # Customers under MINIMUM_AGE or over 75 are moved out of restricted categories, unless an anomaly occurs
+        redraw = (np.isin(category_ids, self.restricted_ids) & ((ages < MINIMUM_AGE) | (ages > 75))
+                  & (rng.random(count) >= ANOMALY_CHANCE))
+        category_ids[redraw] = rng.choice(self.redraw_ids, size=int(redraw.sum()))
+
+        # Amounts come from the category's normal range, or its anomalous range 2% of the time
+        amount_anomaly = rng.random(count) < ANOMALY_CHANCE
+        low = np.where(amount_anomaly, self.anomaly_low[category_ids], self.normal_low[category_ids])
+        high = np.where(amount_anomaly, self.anomaly_high[category_ids], self.normal_high[category_ids])
+        amounts = np.round(rng.uniform(low, high), 2)
+
+        # Customers usually transact at their common location, 2% of the time somewhere new
+        locations = self.customer_locations[customer_index].copy()
+        location_anomaly = rng.random(count) < ANOMALY_CHANCE
+        locations[location_anomaly] = rng.choice(self.cities, size=int(location_anomaly.sum()))
+
+        card_types = rng.integers(0, len(CARD_TYPES), size=count)
+        approval_statuses = rng.choice(len(APPROVAL_STATUSES), size=count, p=APPROVAL_WEIGHTS)
+        payment_methods = rng.integers(0, len(PAYMENT_METHODS), size=count)
+        declined_notes = rng.integers(0, len(DECLINED_NOTES), size=count)
+        merchants = rng.choice(self.merchants, size=count)
+        timestamps = self._timestamps(count)
+        id_bytes = rng.bytes(16 * count)
+
+        transactions = []
+        for i in range(count):
+            approval_status = APPROVAL_STATUSES[approval_statuses[i]]
+            transactions.append(Transaction(
+                uuid.UUID(bytes=id_bytes[16 * i:16 * i + 16], version=4).hex,
+                self.customer_ids[customer_index[i]],
+                str(timestamps[i]),
+                merchants[i],
+                CATEGORIES[category_ids[i]],
+                float(amounts[i]),
+                locations[i],
+                CARD_TYPES[card_types[i]],
+                approval_status,
+                PAYMENT_METHODS[payment_methods[i]],
+                "Undetermined",
+                DECLINED_NOTES[declined_notes[i]] if approval_status == "Declined" else None,
+            ))
+        return transactions
@@ -2,7 +2,19 @@
 # utils.py houses general utility functions to assist other files
 
 import csv
+import functools
+import itertools
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import pool as psycopg2_pool
+from config import DATABASE_CONFIG, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_CHECKOUT_TIMEOUT, POOL_HEALTH_CHECK_INTERVAL, STREAM_ITERSIZE, PREPARED_STATEMENTS
+from metrics import metrics, InstrumentedCursor
 
 ## DATABASE CONNECTION FUNCTIONS
 # Helper function that establishes a connection to the PostgreSQL database
@@ -27,6 +39,236 @@ def database_close(connection, cursor):
         if connection:
             connection.close()
 
+## CONNECTION POOL FUNCTIONS
+# Thread-safe pool of PostgreSQL connections shared by every module
+# Callers block (up to checkout_timeout seconds) when all max_size connections are checked out instead of failing
+class ConnectionPool:
+    def __init__(self, min_size, max_size, checkout_timeout=None, health_check_interval=30, **connect_kwargs):
+        self._pool = psycopg2_pool.ThreadedConnectionPool(min_size, max_size, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}  # id(connection) -> time it was last returned to the pool
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+    # Checks out a healthy connection, replacing any that were closed or went stale while idle
+    # After a database restart every idle connection can be stale, so up to max_size are discarded before giving up
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise psycopg2_pool.PoolError(f"No database connection available after {self.checkout_timeout} seconds")
+        try:
+            for _ in range(self.max_size):
+                connection = self._pool.getconn()
+                if self._is_healthy(connection):
+                    return connection
+                self._last_used.pop(id(connection), None)
+                self._pool.putconn(connection, close=True)
+            raise psycopg2_pool.PoolError(f"No healthy database connection after {self.max_size} attempts")
+        except Exception:
+            self._slots.release()
+            raise
+
+    # Returns a connection to the pool, discarding any uncommitted work
+    # A connection that cannot be rolled back is closed, but still handed back so the pool does not lose track of it
+    def putconn(self, connection, close=False):
+        try:
+            if not connection.closed and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+            self._last_used.pop(id(connection), None)
+            if not (close or connection.closed):
+                self._last_used[id(connection)] = time.monotonic()
+            self._pool.putconn(connection, close=close or bool(connection.closed))
+        finally:
+            self._slots.release()
+
+    # Closes every connection held by the pool
+    def closeall(self):
+        self._pool.closeall()
+        self._last_used.clear()
+
+    # Connections idle for longer than health_check_interval are pinged before they are handed out
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        last_used = self._last_used.get(id(connection))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+_pool = None
+_pool_lock = threading.Lock()
+_connect_kwargs = DATABASE_CONFIG  # Replaced by configure_pool, e.g. to point the benchmarks at a throwaway database
+
+# Returns the shared connection pool, creating it on first use so importing a module never opens a connection
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # With metrics on, every pooled cursor counts its queries and fetched rows
+                connect_kwargs = dict(_connect_kwargs, cursor_factory=InstrumentedCursor) if metrics.enabled else _connect_kwargs
+                _pool = ConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_CHECKOUT_TIMEOUT, POOL_HEALTH_CHECK_INTERVAL, **connect_kwargs)
+    return _pool
+
+# Closes every pooled connection, the pool is recreated on the next checkout
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+# A forked worker process starts without a pool and opens its own connections on first use
+# The parent's connections are dropped without closing them, closing them here would end the parent's sessions
+def _reset_pool_after_fork():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+# Points the shared pool at another database - closes the current pool, the next checkout connects with connect_kwargs
+def configure_pool(**connect_kwargs):
+    global _connect_kwargs
+    close_pool()
+    _connect_kwargs = connect_kwargs or DATABASE_CONFIG
+
+# Checks a connection out of the shared pool for the duration of a with-block
+@contextmanager
+def pooled_connection():
+    pool = get_pool()
+    connection = pool.getconn()
+    try:
+        yield connection
+    finally:
+        pool.putconn(connection)
+
+# Checks out a connection and yields a cursor on it, committing on success and rolling back on error
+@contextmanager
+def pooled_cursor():
+    with pooled_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+## TABLE SETUP FUNCTIONS
+# Tables ensure_table has seen committed on each connection - entries go away with their connection, like _prepared
+_ready_tables = weakref.WeakKeyDictionary()
+_ready_tables_lock = threading.Lock()
+
+# Runs create(cursor) - a CREATE TABLE IF NOT EXISTS function that does not commit - on the caller's cursor, so the
+# table is made in the caller's database and transaction, until the table is known to exist on that connection
+# A table this transaction just created still holds its ACCESS EXCLUSIVE lock and would vanish on a rollback, so it is
+# only remembered once a later call finds it committed
+def ensure_table(cursor, table_name, create):
+    with _ready_tables_lock:
+        ready = _ready_tables.setdefault(cursor.connection, set())
+    if table_name in ready:
+        return
+    create(cursor)
+    cursor.execute("""
+        SELECT NOT EXISTS (
+            SELECT 1 FROM pg_locks
+            WHERE relation = to_regclass(%s) AND pid = pg_backend_pid() AND mode = 'AccessExclusiveLock'
+        )
+    """, (table_name,))
+    if cursor.fetchone()[0]:
+        ready.add(table_name)
+
+## PREPARED STATEMENT FUNCTIONS
+# Names of the statements prepared on each connection - entries go away with their connection, so a replaced
+# pooled connection simply prepares its statements again
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+# String literals, quoted identifiers, and the % sequences between them
+_QUERY_TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|%%|%s|%")
+
+# Helper function that rewrites a query written with %s placeholders for PREPARE ($1, $2, ...) and for cursor.execute
+# A % inside a string literal (e.g. LIKE 'x%') may be written as % or %%, outside of one a literal % must be %%
+# Returns (prepare_query, execute_query, number of placeholders)
+@functools.lru_cache(maxsize=1024)
+def _placeholder_query(query):
+    numbered, escaped = [], []
+    count = 0
+    position = 0
+    for match in _QUERY_TOKENS.finditer(query):
+        numbered.append(query[position:match.start()])
+        escaped.append(query[position:match.start()])
+        token = match.group()
+        if token[0] in "'\"":
+            numbered.append(re.sub("%%?", "%", token))
+            escaped.append(re.sub("%%?", "%%", token))
+        elif token == "%s":
+            count += 1
+            numbered.append(f"${count}")
+            escaped.append(token)
+        elif token == "%%":
+            numbered.append("%")
+            escaped.append(token)
+        else:
+            raise ValueError(f"Unsupported % in query, use %s placeholders and write a literal % as %%: {query}")
+        position = match.end()
+    numbered.append(query[position:])
+    escaped.append(query[position:])
+    return "".join(numbered), "".join(escaped), count
+
+# Runs query (written with %s placeholders like cursor.execute) as a prepared statement on the cursor's connection
+# The first call on a connection PREPAREs it, later calls only send EXECUTE with the parameters, skipping parse and plan
+# params must be a sequence, one value per %s - runs as plain cursor.execute when PREPARED_STATEMENTS is off
+def execute_prepared(cursor, query, params=()):
+    if isinstance(params, dict):
+        raise ValueError("execute_prepared takes a sequence of parameters for %s placeholders, not a dict")
+    prepare_query, execute_query, count = _placeholder_query(query)
+    if count != len(params):
+        raise ValueError(f"Query has {count} placeholder(s) but {len(params)} parameter(s) were given")
+    if not PREPARED_STATEMENTS:
+        return cursor.execute(execute_query, params)
+    name = f"cardguard_{uuid.uuid5(uuid.NAMESPACE_OID, query).hex}"
+    with _prepared_lock:
+        prepared = _prepared.setdefault(cursor.connection, set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {prepare_query}")
+        prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})" if params else f"EXECUTE {name}", params)
+
+## STREAMING FUNCTIONS
+# Yields the rows of a query one at a time through a named (server-side) cursor on the same connection
+# Rows arrive itersize at a time, so memory use stays constant however large the result is
+# The stream lives inside the current transaction - pass withhold=True to keep it open across commits
+def stream_rows(cursor, query, params=None, itersize=STREAM_ITERSIZE, withhold=False):
+    with cursor.connection.cursor(name=f"stream_{uuid.uuid4().hex}", withhold=withhold) as stream:
+        stream.itersize = itersize
+        stream.execute(query, params)
+        yield from stream
+
+# Same as stream_rows, but yields lists of up to batch_size rows for work that is done a batch at a time
+def stream_batches(cursor, query, params=None, batch_size=STREAM_ITERSIZE, withhold=False):
+    with cursor.connection.cursor(name=f"stream_{uuid.uuid4().hex}", withhold=withhold) as stream:
+        stream.itersize = batch_size
+        stream.execute(query, params)
+        while True:
+            rows = stream.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+
 # Cosmetic function to allow certain text to be highlighted in console
 def highlight(color="blue", string=""):
     if color == "blue":
@@ -41,9 +283,14 @@ def highlight(color="blue", string=""):
         return f"\033[1;36m{string}\033[0m"  # Default to blue if invalid color
 
 # Function for chunking large datasets for batch processing
+# Accepts any iterable, including generators, and yields lists of up to chunk_size items
 def chunk_data(data, chunk_size=1000):
-    for i in range(0, len(data), chunk_size):
-        yield data[i:i + chunk_size]
+    iterator = iter(data)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 # Function for writing a data result to CSV file
 def write_to_csv(data, filename="output.csv"):
@@ -0,0 +1,163 @@
+# CARD GUARD
+# Vectorized Scoring
+# Applies the fraud rules to a whole pandas DataFrame (or Arrow table) of transactions with column operations,
+# for scoring snapshot exports and backtests without a Transaction object or query per row
+# Same rules and thresholds as flag_fraud - category bounds, |Z-Score| > 2, location profile and age/category,
+# plus duplicates when the frame carries a duplicate_count column
+# Usage:
+#   transactions = read_transactions_snapshot()
+#   scored = score_frame(transactions, customer_stats_from_frame(transactions, read_customers_snapshot()))
+
+# Import libraries
+from config import *
+from utils import *
+from fraud_rules import fraud_rules, REASON_AMOUNT_BOUNDS, REASON_Z_SCORE, REASON_DUPLICATE, REASON_LOCATION, REASON_AGE_CATEGORY
+from rule_config import get_rule_config
+import numpy as np
+import pandas as pd
+
+# Columns score_frame reads from the customer stats frame
+STATS_COLUMNS = ("customer_id", "avg_spent", "std_dev", "location", "age")
+
+# Loads the customer stats score_frame needs from the database - spending statistics joined to each customer's profile
+# customer_ids limits the load to those customers, None loads every customer
+def customer_stats_from_db(cursor, customer_ids=None):
+    stats_sql = """
+        SELECT c.customer_id, s.txn_count, s.mean, s.m2, c.location, c.age
+        FROM {customers_table} AS c
+        LEFT JOIN {stats_table} AS s ON s.customer_id = c.customer_id
+    """.format(customers_table=CUSTOMERS_TABLE, stats_table=SPENDING_STATS_TABLE)
+    if customer_ids is not None:
+        stats_sql += " WHERE c.customer_id = ANY(%s)"
+        cursor.execute(stats_sql, (list(customer_ids),))
+    else:
+        cursor.execute(stats_sql)
+    frame = pd.DataFrame(cursor.fetchall(), columns=["customer_id", "txn_count", "mean", "m2", "location", "age"])
+
+    # Same as stats_from_entry - sample standard deviation, 0 for customers with fewer than two transactions
+    count = frame["txn_count"].fillna(0).astype(np.float64).to_numpy()
+    m2 = np.maximum(frame["m2"].fillna(0).astype(np.float64).to_numpy(), 0.0)
+    frame["avg_spent"] = frame["mean"].fillna(0).astype(np.float64)
+    frame["std_dev"] = np.sqrt(np.divide(m2, count - 1, out=np.zeros_like(m2), where=count > 1))
+    return frame[list(STATS_COLUMNS)]
+
+# Builds the customer stats from a transactions frame instead of the database, e.g. for a Parquet snapshot
+# Average and sample standard deviation come from every transaction in the frame, location and age from customers
+def customer_stats_from_frame(transactions, customers):
+    amounts = transactions[["customer_id"]].assign(amount=transactions["amount"].astype(np.float64))
+    spending = amounts.groupby("customer_id")["amount"].agg(avg_spent="mean", std_dev="std").fillna(0.0)
+    frame = customers[["customer_id", "location", "age"]].merge(spending, left_on="customer_id", right_index=True, how="left")
+    frame[["avg_spent", "std_dev"]] = frame[["avg_spent", "std_dev"]].fillna(0.0)
+    return frame[list(STATS_COLUMNS)]
+
+# Loads the per-location transaction counts of the location profiles - customer_id, location and location_count rows
+# customer_ids limits the load to those customers, None loads every customer
+def location_counts_from_db(cursor, customer_ids=None):
+    counts_sql = "SELECT customer_id, location, txn_count FROM {table_name}".format(table_name=LOCATION_COUNTS_TABLE)
+    if customer_ids is not None:
+        counts_sql += " WHERE customer_id = ANY(%s)"
+        cursor.execute(counts_sql, (list(customer_ids),))
+    else:
+        cursor.execute(counts_sql)
+    return pd.DataFrame(cursor.fetchall(), columns=["customer_id", "location", "location_count"])
+
+# Builds the same location counts from a transactions frame instead of the database
+def location_counts_from_frame(transactions):
+    located = transactions[transactions["customer_id"].notna() & transactions["location"].notna()]
+    return located.groupby(["customer_id", "location"]).size().rename("location_count").reset_index()
+
+# Share of each transaction's customer's other transactions made at its location, like LocationProfile.share
+# Only the top_k locations of each customer (ties included) count, other locations get a share of 0
+def location_shares(transactions, location_counts, top_k):
+    counts = location_counts[location_counts["location_count"] > 0]
+    totals = counts.groupby("customer_id")["location_count"].sum()
+    rank = counts.groupby("customer_id")["location_count"].rank(method="min", ascending=False)
+    top = counts[rank <= top_k].set_index(["customer_id", "location"])["location_count"]
+    keys = pd.MultiIndex.from_arrays([transactions["customer_id"], transactions["location"]])
+    count = top.reindex(keys).fillna(0).to_numpy(dtype=np.float64)
+    total = transactions["customer_id"].map(totals).fillna(0).to_numpy(dtype=np.float64)
+    return np.divide(np.maximum(count - 1, 0), total - 1, out=np.zeros_like(count), where=total > 1)
+
+# Scores every transaction in the frame at once - returns a copy with fraud_score, reason_codes, z_score and rule_version columns
+# reason_codes is a bitmask of the REASON_* codes in fraud_rules, is_fraud is set to FRAUD or NOT FRAUD for scoreable rows
+# Rows flag_fraud would skip (non-positive amount, already decided, or declined) keep their is_fraud and score 0
+# rules is the RuleConfig to score with, the current one when None
+# location_counts holds the location profile counts (see location_counts_from_db), None counts the frame's own transactions
+def score_frame(transactions, customer_stats, rules=None, location_counts=None):
+    rules = rules or get_rule_config()
+    if not isinstance(transactions, pd.DataFrame):
+        transactions = transactions.to_pandas()  # Arrow table
+    if not isinstance(customer_stats, pd.DataFrame):
+        customer_stats = customer_stats.to_pandas()
+    scored = transactions.copy()
+
+    # Look each transaction's customer up by position instead of a merge, unknown customers get flag_fraud's defaults
+    stats = customer_stats.drop_duplicates("customer_id").set_index("customer_id")
+    position = stats.index.get_indexer(scored["customer_id"])
+    known = position >= 0
+    avg_spent = np.where(known, stats["avg_spent"].to_numpy(dtype=np.float64)[position], 0.0)
+    std_dev = np.where(known, stats["std_dev"].to_numpy(dtype=np.float64)[position], 0.0)
+    common_location = np.where(known, stats["location"].to_numpy(dtype=object)[position], "Unknown")
+    age = np.where(known, stats["age"].fillna(0).to_numpy(dtype=np.float64)[position], 0.0)
+
+    amount = scored["amount"].to_numpy(dtype=np.float64)
+    category = scored["category"]
+    location = scored["location"].to_numpy(dtype=object)
+
+    # Same eligibility checks as is_scoreable
+    is_fraud = scored["is_fraud"].fillna("Undetermined") if "is_fraud" in scored else pd.Series("Undetermined", index=scored.index)
+    scoreable = ((amount > 0) & (is_fraud == "Undetermined").to_numpy()
+                 & scored["approval_status"].isin(["Pending", "Approved"]).to_numpy())
+
+    # Category bounds looked up by category id, unexpected categories use the "Other" slot
+    category_ids = category.map(rules.category_ids).fillna(len(rules.categories)).to_numpy(dtype=np.int64)
+    max_allowed = rules.bounds_by_id[category_ids]
+    out_of_bounds = amount > max_allowed
+
+    # Z-Score outliers, only for customers with a spread of spending
+    z_score = np.divide(amount - avg_spent, std_dev, out=np.zeros_like(amount), where=std_dev > 0)
+    outlier = np.abs(z_score) > rules.z_score_threshold
+
+    # Away from home and the customer's most used locations, and unexpected category for the customer's age
+    if location_counts is None:
+        location_counts = location_counts_from_frame(scored)
+    elif not isinstance(location_counts, pd.DataFrame):
+        location_counts = location_counts.to_pandas()
+    share = location_shares(scored, location_counts, rules.location_top_k)
+    location_anomaly = (location != common_location) & (location != "Unknown") & (share < rules.location_min_share)
+    age_category = category.isin(rules.age_restricted).to_numpy() & (age < rules.minimum_age)
+
+    # Duplicates need the transaction history, so they only count when the frame already carries them
+    duplicate = scored["duplicate_count"].fillna(0).to_numpy() > 0 if "duplicate_count" in scored else np.zeros(len(scored), dtype=bool)
+
+    reason_codes = (out_of_bounds * REASON_AMOUNT_BOUNDS
+                    | outlier * REASON_Z_SCORE
+                    | duplicate * REASON_DUPLICATE
+                    | location_anomaly * REASON_LOCATION
+                    | age_category * REASON_AGE_CATEGORY).astype(np.int32)
+    reason_codes[~scoreable] = 0
+    # Each rule adds its registered weight, like flag_fraud
+    weights = fraud_rules.reason_weights()
+    fraud_score = (out_of_bounds * weights["amount_bounds"] + outlier * weights["z_score"] + duplicate * weights["duplicates"]
+                   + location_anomaly * weights["location"] + age_category * weights["age_category"]).astype(np.int32)
+    fraud_score[~scoreable] = 0
+
+    scored["fraud_score"] = fraud_score
+    scored["reason_codes"] = reason_codes
+    scored["z_score"] = z_score
+    scored["rule_version"] = rules.version
+    scored["is_fraud"] = np.where(scoreable, np.where(fraud_score > 0, "FRAUD", "NOT FRAUD"), is_fraud.to_numpy(dtype=object))
+    return scored
+
+# Running this file directly scores the local Parquet snapshot and prints a summary of the reasons
+if __name__ == "__main__":
+    from snapshot import read_transactions_snapshot, read_customers_snapshot
+    from fraud_rules import REASON_CODES
+    import time
+    transactions = read_transactions_snapshot()
+    start = time.perf_counter()
+    scored = score_frame(transactions, customer_stats_from_frame(transactions, read_customers_snapshot()))
+    elapsed = time.perf_counter() - start
+    print(f"Scored {highlight('blue', len(scored))} transaction(s) in {highlight('blue', f'{elapsed:.2f}')}s, {highlight('red', int((scored['fraud_score'] > 0).sum()))} flagged.")
+    for name, code in REASON_CODES.items():
+        print(f"{highlight('blue', '-')} {name}: {highlight('yellow', int(((scored['reason_codes'] & code) > 0).sum()))}")
@@ -0,0 +1,192 @@
+# CARD GUARD
+# Write-Behind Verdict Writer
+# flag_fraud hands its verdict to a queue instead of committing it, and a background thread writes the queued
+# verdicts with one UPDATE ... FROM (VALUES ...) and one commit per batch - a batch is written once it holds
+# batch_size verdicts or its oldest verdict has waited max_latency seconds
+# Everything queued is written before the process exits, a batch that still cannot be written after
+# VERDICT_WRITE_RETRIES attempts is saved to VERDICT_SPILL_FILE instead and replayed by running this file
+# Usage:
+#   verdict_writer.submit(transaction_id, "FRAUD", fraud_score, rules.version, reason_mask, params)
+#   verdict_writer.flush()           (waits until every verdict submitted so far is committed)
+
+# Import libraries
+from config import *
+from utils import *
+from metrics import metrics
+from verdicts import write_verdicts, create_transaction_scores_table
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+# Marks the end of the queue for the writer thread
+_STOP = object()
+
+# Buffers (transaction_id, is_fraud, fraud_score, rule_version, reason_mask, params, scored_at) verdicts and writes
+# them on its own pooled connection
+# The thread starts with the first submitted verdict, and submit() waits up to submit_timeout seconds for room once
+# queue_size verdicts are pending before writing the verdict itself
+class VerdictWriter:
+    def __init__(self, batch_size=VERDICT_BATCH_SIZE, max_latency=VERDICT_MAX_LATENCY, queue_size=VERDICT_QUEUE_SIZE,
+                 retries=VERDICT_WRITE_RETRIES, submit_timeout=VERDICT_SUBMIT_TIMEOUT, spill_file=VERDICT_SPILL_FILE):
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.retries = retries
+        self.submit_timeout = submit_timeout
+        self.spill_file = spill_file
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.written_directly = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._table_checked = False
+        self._lock = threading.Lock()
+
+    # Queues a verdict, starting the writer thread if it is not running - returns True once it is queued
+    # When the queue stays full for submit_timeout seconds the verdict is written on cursor instead, left for the
+    # caller to commit (on a pooled connection and committed when cursor is None), so a stalled writer slows callers
+    # down rather than blocking them - returns False
+    # Every verdict is stamped with the time it was submitted, and write_verdicts skips one older than the verdict
+    # already saved, so a queued verdict written after a newer direct write does not overwrite it
+    def submit(self, transaction_id, is_fraud, fraud_score, rule_version, reason_mask=0, params=None, cursor=None):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="verdict-writer", daemon=True)
+                self._thread.start()
+        verdict = (transaction_id, is_fraud, fraud_score, rule_version, reason_mask, params, datetime.now(timezone.utc))
+        try:
+            self._queue.put(verdict, timeout=self.submit_timeout)
+            return True
+        except queue.Full:
+            pass
+
+        if cursor is None:
+            with pooled_cursor() as cursor:
+                write_verdicts(cursor, [verdict])
+        else:
+            write_verdicts(cursor, [verdict])
+        self.written_directly += 1
+        metrics.inc("cardguard_verdicts_written_directly_total", "Verdicts written by their caller because the write-behind queue was full")
+        return False
+
+    # Blocks until every verdict submitted so far has been committed (or spilled)
+    def flush(self):
+        self._queue.join()
+
+    # Writes everything still queued and stops the thread, a later submit() starts it again
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+        self._queue.put(_STOP)
+        thread.join()
+
+    # Number of verdicts waiting to be written
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    # Writer thread - collects a batch, writes it, and repeats until it reaches the stop marker
+    def _run(self):
+        self._check_table()
+        while True:
+            batch = []
+            stopping = False
+            item = self._queue.get()
+            deadline = time.monotonic() + self.max_latency
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + stopping):
+                self._queue.task_done()
+            if stopping:
+                return
+
+    # Helper function that creates the scores table if it is missing, once per writer rather than once per batch
+    # A database that cannot be reached yet is left to the batch retries
+    def _check_table(self):
+        if self._table_checked:
+            return
+        try:
+            with pooled_cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", (TRANSACTION_SCORES_TABLE,))
+                if cursor.fetchone()[0] is None:
+                    create_transaction_scores_table(cursor)
+            self._table_checked = True
+        except Exception as e:
+            print(f"Error checking the {highlight('blue', TRANSACTION_SCORES_TABLE)} table: {e}")
+
+    # Helper function that commits one batch, giving up after retries attempts and spilling the batch to a file
+    # instead, so a batch that can never be written does not hold up the ones behind it
+    def _write(self, batch):
+        verdicts = list({verdict[0]: verdict for verdict in batch}.values())  # The latest verdict for each transaction wins
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer("cardguard_verdict_flush_seconds", "Wall time of each write-behind verdict batch"):
+                    with pooled_cursor() as cursor:
+                        write_verdicts(cursor, verdicts)
+                self.written += len(verdicts)
+                self.batches += 1
+                metrics.inc("cardguard_verdicts_written_total", "Verdicts committed by the write-behind writer", len(verdicts))
+                return
+            except Exception as e:
+                attempt += 1
+                print(f"Error writing {highlight('blue', len(verdicts))} verdict(s), attempt {attempt}: {e}")
+                if attempt >= self.retries:
+                    self._spill(verdicts)
+                    return
+                time.sleep(min(attempt, 10))
+
+    # Helper function that appends verdicts that could not be written to the spill file
+    def _spill(self, verdicts):
+        with open(self.spill_file, "a", encoding="utf-8") as spill:
+            for verdict in verdicts:
+                spill.write(json.dumps(verdict, default=str) + "\n")  # scored_at is saved as text, PostgreSQL parses it back
+        self.spilled += len(verdicts)
+        print(f"Saved {highlight('red', len(verdicts))} unwritten verdict(s) to {highlight('blue', self.spill_file)}, run verdict_writer.py to replay them.")
+
+# Writes the verdicts saved in a spill file and deletes it - returns the number of verdicts written
+def replay_spilled_verdicts(cursor, spill_file=VERDICT_SPILL_FILE):
+    if not os.path.exists(spill_file):
+        return 0
+    try:
+        with open(spill_file, encoding="utf-8") as spill:
+            verdicts = list({verdict[0]: tuple(verdict) for verdict in map(json.loads, filter(str.strip, spill))}.values())
+        for chunk in chunk_data(verdicts, VERDICT_BATCH_SIZE):
+            write_verdicts(cursor, chunk)
+        cursor.connection.commit()
+        os.remove(spill_file)
+        print(f"Replayed {highlight('blue', len(verdicts))} verdict(s) from {highlight('blue', spill_file)}.")
+        return len(verdicts)
+    except Exception as e:
+        print(f"Error replaying verdicts: {e}")
+        cursor.connection.rollback()
+        raise
+
+# Writer shared by every module in this process, closed on interpreter exit so queued verdicts are not lost
+verdict_writer = VerdictWriter()
+atexit.register(verdict_writer.close)
+
+# Queue depth exported with the rest of the metrics
+metrics.gauge("cardguard_verdicts_pending", "Verdicts queued but not yet committed", verdict_writer.pending)
+
+# Running this file directly replays the spill file
+if __name__ == "__main__":
+    with pooled_cursor() as cursor:
+        replay_spilled_verdicts(cursor)
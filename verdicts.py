@@ -0,0 +1,146 @@
+# CARD GUARD
+# Verdict Functions
+# Fraud scores are kept next to the transactions table in transaction_scores, one row per scored transaction,
+# stamped with the version of the rule config that produced them
+# Each score also keeps why the transaction was flagged - a reason_mask with one REASON_* bit (see fraud_rules) per rule
+# that fired and the params those rules recorded, e.g. {"z_score": 3.42} - so analysts never have to rerun the checks
+
+# Import libraries
+from config import *
+from utils import ensure_table, execute_prepared, pooled_cursor
+from fraud_rules import REASON_CODES
+from psycopg2.extras import execute_values, Json
+
+# Creates the table holding fraud scores if it does not already exist, adding columns newer versions need
+# Every reason gets a partial index on the transaction timestamp, so find_transactions_by_reason only reads matching rows
+def create_transaction_scores_table(cursor):
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            transaction_id TEXT PRIMARY KEY,
+            fraud_score INTEGER NOT NULL,
+            scored_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS rule_version TEXT;
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS reason_mask INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS params JSONB;
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS transaction_ts TIMESTAMP;
+    """.format(table_name=TRANSACTION_SCORES_TABLE)
+    for name, code in REASON_CODES.items():
+        create_sql += """
+            CREATE INDEX IF NOT EXISTS {table_name}_{name}_idx ON {table_name} (transaction_ts) WHERE reason_mask & {code} <> 0;
+        """.format(table_name=TRANSACTION_SCORES_TABLE, name=name, code=code)
+    # Scores saved before transaction_ts existed pick up their transaction's timestamp
+    create_sql += """
+        UPDATE {table_name} AS s
+        SET transaction_ts = t.timestamp
+        FROM {transactions_table} AS t
+        WHERE s.transaction_id = t.transaction_id AND s.transaction_ts IS NULL AND t.timestamp IS NOT NULL;
+    """.format(table_name=TRANSACTION_SCORES_TABLE, transactions_table=TRANSACTIONS_TABLE)
+    cursor.execute(create_sql)
+    cursor.connection.commit()
+
+# Creates the scores table with its current columns and reason indexes when it does not exist yet, does not commit
+# Used by the write paths through ensure_table - an existing table is left alone, so no lock is taken on it
+# (create_transaction_scores_table upgrades older tables)
+def create_missing_scores_table(cursor):
+    cursor.execute("SELECT to_regclass(%s)", (TRANSACTION_SCORES_TABLE,))
+    if cursor.fetchone()[0] is not None:
+        return
+    create_sql = """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            transaction_id TEXT PRIMARY KEY,
+            fraud_score INTEGER NOT NULL,
+            scored_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            rule_version TEXT,
+            reason_mask INTEGER NOT NULL DEFAULT 0,
+            params JSONB,
+            transaction_ts TIMESTAMP
+        );
+    """.format(table_name=TRANSACTION_SCORES_TABLE)
+    for name, code in REASON_CODES.items():
+        create_sql += """
+            CREATE INDEX IF NOT EXISTS {table_name}_{name}_idx ON {table_name} (transaction_ts) WHERE reason_mask & {code} <> 0;
+        """.format(table_name=TRANSACTION_SCORES_TABLE, name=name, code=code)
+    cursor.execute(create_sql)
+
+# Saves fraud scores from a list of (transaction_id, fraud_score, rule_version, reason_mask, params[, scored_at]) tuples,
+# replacing earlier scores - params is a dict or None, and each score is stamped with its transaction's timestamp
+# scored_at is when the score was decided (now() when left out), a score decided before the one already saved is
+# skipped, so a verdict written late by a queue never overwrites a newer one - returns the IDs whose score was saved
+# A transaction listed more than once keeps its last score, one INSERT ... ON CONFLICT cannot update a row twice
+# Does not commit, so scores are committed together with the verdicts they belong to
+def record_scores(cursor, scores):
+    if not scores:
+        return set()
+    scores = list({score[0]: score for score in scores}.values())
+    ensure_table(cursor, TRANSACTION_SCORES_TABLE, create_missing_scores_table)
+    scores_sql = """
+        INSERT INTO {table_name} AS s (transaction_id, fraud_score, rule_version, reason_mask, params, transaction_ts, scored_at)
+        SELECT v.transaction_id, v.fraud_score, v.rule_version, v.reason_mask, v.params, t.timestamp, COALESCE(v.scored_at, now())
+        FROM (VALUES %s) AS v(transaction_id, fraud_score, rule_version, reason_mask, params, scored_at)
+        LEFT JOIN {transactions_table} AS t ON t.transaction_id = v.transaction_id
+        ON CONFLICT (transaction_id) DO UPDATE
+        SET fraud_score = EXCLUDED.fraud_score, rule_version = EXCLUDED.rule_version, reason_mask = EXCLUDED.reason_mask,
+            params = EXCLUDED.params, transaction_ts = EXCLUDED.transaction_ts, scored_at = EXCLUDED.scored_at
+        WHERE s.scored_at <= EXCLUDED.scored_at
+        RETURNING transaction_id
+    """.format(table_name=TRANSACTION_SCORES_TABLE, transactions_table=TRANSACTIONS_TABLE)
+    rows = [(score[0], score[1], score[2], score[3], Json(score[4]) if score[4] else None, score[5] if len(score) > 5 else None)
+            for score in scores]
+    saved = execute_values(cursor, scores_sql, rows, template="(%s, %s::integer, %s, %s::integer, %s::jsonb, %s::timestamptz)",
+                           page_size=len(rows), fetch=True)
+    return {transaction_id for (transaction_id,) in saved}
+
+# Writes verdicts from a list of (transaction_id, is_fraud, fraud_score, rule_version, reason_mask, params[, scored_at])
+# tuples - saves the scores, then sets only is_fraud with a single UPDATE on the transactions whose score was saved,
+# does not commit
+# A transaction listed more than once keeps its last verdict
+def write_verdicts(cursor, verdicts):
+    if not verdicts:
+        return
+    verdicts = list({verdict[0]: verdict for verdict in verdicts}.values())
+    saved = record_scores(cursor, [(verdict[0],) + tuple(verdict[2:]) for verdict in verdicts])
+    verdicts = [verdict for verdict in verdicts if verdict[0] in saved]
+    if not verdicts:
+        return
+    update_sql = """
+        UPDATE {table_name} AS t
+        SET is_fraud = v.is_fraud
+        FROM (VALUES %s) AS v(transaction_id, is_fraud)
+        WHERE t.transaction_id = v.transaction_id
+    """.format(table_name=TRANSACTIONS_TABLE)
+    execute_values(cursor, update_sql, [verdict[:2] for verdict in verdicts], page_size=len(verdicts))
+
+# Keeps the transaction_ts of scores in step after transactions' timestamps change, does not commit
+def refresh_score_timestamps(cursor, transactionIDs):
+    ensure_table(cursor, TRANSACTION_SCORES_TABLE, create_missing_scores_table)
+    refresh_sql = """
+        UPDATE {table_name} AS s
+        SET transaction_ts = t.timestamp
+        FROM {transactions_table} AS t
+        WHERE s.transaction_id = t.transaction_id AND s.transaction_id = ANY(%s)
+    """.format(table_name=TRANSACTION_SCORES_TABLE, transactions_table=TRANSACTIONS_TABLE)
+    cursor.execute(refresh_sql, (list(transactionIDs),))
+
+# Lists the scored transactions a rule flagged with a transaction timestamp in [start, end), oldest first
+# reason is a name from REASON_CODES (e.g. "z_score") or its code, start and end may be None for an open range
+# Returns (transaction_id, transaction_ts, fraud_score, reason_mask, params) rows
+def find_transactions_by_reason(cursor, reason, start=None, end=None, limit=None):
+    code = REASON_CODES.get(reason) if isinstance(reason, str) else reason
+    if not isinstance(code, int) or code <= 0:
+        raise ValueError(f"Unknown reason: {reason!r}, expected one of {', '.join(REASON_CODES)}")
+    # The code is written into the query, not passed as a parameter, so the planner can match the reason's partial index
+    reason_sql = """
+        SELECT transaction_id, transaction_ts, fraud_score, reason_mask, params
+        FROM {table_name}
+        WHERE reason_mask & {code} <> 0 AND transaction_ts >= %s AND transaction_ts < %s
+        ORDER BY transaction_ts
+        LIMIT %s
+    """.format(table_name=TRANSACTION_SCORES_TABLE, code=code)
+    execute_prepared(cursor, reason_sql, (start or "-infinity", end or "infinity", limit))
+    return cursor.fetchall()
+
+# Running this file directly creates the scores table
+if __name__ == "__main__":
+    with pooled_cursor() as cursor:
+        create_transaction_scores_table(cursor)